@@ -0,0 +1,189 @@
+"""Load testing for the webhook server.
+
+Starts a `Webhook` on a local port with a stand-in for the Matrix side
+(or a throwaway outbox), sends it realistic payloads at a given
+concurrency and reports throughput, latency percentiles and memory use.
+
+Run with `notflixbot bench`, a short run is also part of the tests.
+"""
+
+import asyncio
+import math
+import resource
+import tempfile
+import time
+from itertools import cycle
+
+import aiohttp
+from aiohttp.web import AppRunner, TCPSite
+
+from notflixbot.outbox import Outbox
+from notflixbot.webhook import Webhook
+
+JELLYFIN_SERVER = "https://jellyfin.example.com"
+
+
+def radarr_download(i):
+    # from webhook_examples.md
+    return "radarr", {
+        "movie": {
+            "id": i, "title": f"Movie {i}", "year": 2019, "releaseDate": "2020-01-01",
+            "folderPath": f"/path/to/Movie {i}", "tmdbId": 575776 + i, "imdbId": f"tt{i:07d}"
+        },
+        "remoteMovie": {"tmdbId": 575776 + i, "imdbId": f"tt{i:07d}", "title": f"Movie {i}", "year": 2019},
+        "movieFile": {
+            "id": 371, "relativePath": "Movie.mp4", "path": "/data/Movie.mp4",
+            "quality": "Bluray-1080p", "qualityVersion": 1, "releaseGroup": "RARBG",
+            "sceneName": "Movie.2019.1080p.BluRay.H264.AAC-RARBG", "indexerFlags": "G_Freeleech",
+            "size": 1727065263
+        },
+        "isUpgrade": False,
+        "downloadId": "ABC123",
+        "eventType": "Download",
+    }
+
+
+def incoming(i):
+    return "incoming", {"text": f"backup job {i} finished", "prefix": "cron"}
+
+
+def jellyfin_episode_added(i):
+    return "jellyfin", {
+        "NotificationType": "ItemAdded", "ItemType": "Episode", "ServerUrl": JELLYFIN_SERVER,
+        "ItemId": f"{i:032x}", "Name": f"Episode {i % 24 + 1}", "SeriesName": "Twin Peaks",
+        "SeasonNumber00": f"{i // 24 + 1:02d}", "EpisodeNumber00": f"{i % 24 + 1:02d}",
+        "Year": 1990, "Overview": "Cooper dreams. " * 20,
+    }
+
+
+def jellyfin_season_added(i):
+    return "jellyfin", {
+        "NotificationType": "ItemAdded", "ItemType": "Season", "ServerUrl": JELLYFIN_SERVER,
+        "ItemId": f"{i:032x}", "Name": f"Season {i}", "SeriesName": "Twin Peaks",
+    }
+
+
+def jellyfin_playback_start(i):
+    return "jellyfin", {
+        "NotificationType": "PlaybackStart", "ItemType": "Movie", "ServerUrl": JELLYFIN_SERVER,
+        "ItemId": f"{i:032x}", "Name": f"Movie {i}", "NotificationUsername": f"user{i % 5}",
+        "DeviceName": "tv", "ClientName": "Jellyfin Web",
+    }
+
+
+SCENARIOS = {
+    'mixed': [radarr_download, incoming, jellyfin_episode_added, jellyfin_playback_start],
+    'jellyfin_scan': [jellyfin_episode_added, jellyfin_episode_added, jellyfin_season_added],
+    'jellyfin_playback': [jellyfin_playback_start],
+    'radarr': [radarr_download],
+    'incoming': [incoming],
+}
+
+
+class CountingSink:
+    """Stands in for the Matrix side, only counts messages"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.received = 0
+
+    async def put(self, room, msg, plain=None):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.received += 1
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    i = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[i]
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def _run(config, sink, requests, concurrency, scenario):
+    token = next(iter(config.webhook_tokens))
+    webhook = Webhook(config, sink)
+
+    runner = AppRunner(webhook._app, access_log=None)
+    await runner.setup()
+    site = TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    base_url = f"http://{host}:{port}{config.webhook_base_url}"
+
+    payloads = cycle(SCENARIOS[scenario])
+    work = [next(payloads)(i) for i in range(requests)]
+    latencies = []
+    errors = 0
+
+    async def worker(session, queue):
+        nonlocal errors
+        headers = {'Webhook-Token': token}
+        while queue:
+            route, payload = queue.pop()
+            start = time.perf_counter()
+            async with session.post(f"{base_url}{route}", json=payload, headers=headers) as r:
+                await r.read()
+                if r.status != 200:
+                    errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            start = time.perf_counter()
+            await asyncio.gather(*[worker(session, work) for _ in range(concurrency)])
+            elapsed = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+
+    latencies.sort()
+    return {
+        'scenario': scenario,
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'elapsed': elapsed,
+        'throughput': requests / elapsed,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max_rss_mb': max_rss_mb(),
+    }
+
+
+async def run_benchmark(config, requests=1000, concurrency=32, scenario="mixed",
+                        sink="fake"):
+    """Returns a dict with the results. `sink` is either "fake" (just
+    counts messages) or "outbox" (a real Outbox in a temporary directory).
+    """
+    if sink == "outbox":
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outbox = Outbox(f"{tmpdir}/outbox.db")
+            try:
+                results = await _run(config, outbox, requests, concurrency, scenario)
+                results['delivered'] = len(outbox)
+            finally:
+                outbox.close()
+    else:
+        counting = CountingSink()
+        results = await _run(config, counting, requests, concurrency, scenario)
+        results['delivered'] = counting.received
+
+    results['sink'] = sink
+    return results
+
+
+def format_results(r):
+    return "\n".join([
+        f"scenario:    {r['scenario']} ({r['requests']} requests, concurrency {r['concurrency']}, sink: {r['sink']})",
+        f"throughput:  {r['throughput']:.0f} req/s",
+        f"latency:     p50 {r['p50'] * 1000:.2f}ms, p95 {r['p95'] * 1000:.2f}ms, p99 {r['p99'] * 1000:.2f}ms",
+        f"delivered:   {r['delivered']} messages, {r['errors']} errors",
+        f"max rss:     {r['max_rss_mb']:.1f}MB",
+    ])
@@ -0,0 +1,198 @@
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+
+class TTLCache:
+    """A small in-memory cache bounded by number of entries, where each
+    entry expires after `ttl` seconds (or never, if `ttl` is None).
+
+    Least recently used entries are evicted first when the cache is full.
+    Counts hits, misses and evictions so they can be shown with `!stats`.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        # key -> (expires_at, value)
+        self._data = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            return None
+
+        if expires_at is not None and expires_at <= self._clock():
+            del self._data[key]
+            return None
+
+        return (value,)
+
+    def get(self, key, default=None):
+        found = self._lookup(key)
+        if found is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._data.move_to_end(key)
+        return found[0]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            expires_at = None
+        else:
+            expires_at = self._clock() + ttl
+
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        return self._data.pop(key, None) is not None
+
+    def invalidate_value(self, value):
+        """Drops every entry that maps to `value`, returns how many were
+        dropped.
+        """
+        keys = [k for k, (_, v) in self._data.items() if v == value]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class SqliteCache:
+    """A cache of JSON values in SQLite, so it survives restarts.
+
+    Entries are fresh for `ttl` seconds, and can still be used (while
+    they are refreshed) for `stale_ttl` seconds after that. `get()`
+    returns `(value, fresh)`, or None if there is nothing usable. When
+    there are more than `maxsize` entries the oldest ones are dropped.
+
+    Uses the wall clock, since entries outlive the process.
+    """
+
+    def __init__(self, path, maxsize=10000, ttl=7 * 86400, stale_ttl=30 * 86400,
+                 clock=time.time):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # losing the last few entries in a crash only means looking them up again
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "  key TEXT PRIMARY KEY,"
+            "  value TEXT,"
+            "  fresh_until REAL NOT NULL,"
+            "  updated_at REAL NOT NULL"
+            ")"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_updated_at ON cache (updated_at)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return self._size
+
+    def get(self, key):
+        row = self._db.execute(
+            "SELECT value, fresh_until FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        now = self._clock()
+        if row is None or row[1] + self.stale_ttl <= now:
+            self.misses += 1
+            return None
+
+        fresh = row[1] > now
+        if fresh:
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+        return (json.loads(row[0]), fresh)
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        now = self._clock()
+        exists = self._db.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone()
+        self._db.execute(
+            "INSERT OR REPLACE INTO cache (key, value, fresh_until, updated_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + ttl, now)
+        )
+        if exists is None:
+            self._size += 1
+
+        if self._size > self.maxsize:
+            excess = self._size - self.maxsize
+            self._db.execute(
+                "DELETE FROM cache WHERE key IN"
+                " (SELECT key FROM cache ORDER BY updated_at LIMIT ?)", (excess,))
+            self._size -= excess
+            self.evictions += excess
+        self._db.commit()
+
+    def invalidate(self, key):
+        cur = self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+        self._db.commit()
+        self._size -= cur.rowcount
+        return cur.rowcount > 0
+
+    def close(self):
+        self._db.close()
+        logger.debug(f"Closed cache '{self.path}'")
+
+    def stats(self):
+        return {
+            'size': self._size,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
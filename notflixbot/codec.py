@@ -0,0 +1,91 @@
+"""JSON decoding/encoding for webhook payloads, using orjson if it is
+installed and the json module from the standard library if not, and the
+envelope format for messages sent from webhook processes to the bot.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    BACKEND = "orjson"
+    # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+    DecodeError = orjson.JSONDecodeError
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+
+else:
+    BACKEND = "json"
+    DecodeError = json.JSONDecodeError
+
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+
+# bumped if the envelope changes, so an old webhook process talking to a
+# new bot (or the other way around) is noticed
+ENVELOPE_VERSION = b"1"
+
+
+def pack(room, msg, plain=None):
+    """Envelope for a message as a list of ZMQ frames, no json involved.
+    `plain` is left out if it is None.
+    """
+    frames = [ENVELOPE_VERSION, room.encode(), msg.encode()]
+    if plain is not None:
+        frames.append(plain.encode())
+    return frames
+
+
+def unpack(frames):
+    """Returns (room, msg, plain) from the frames made by `pack`, raises
+    ValueError if they aren't valid
+    """
+    if len(frames) not in (3, 4) or frames[0] != ENVELOPE_VERSION:
+        raise ValueError(f"invalid envelope with {len(frames)} frames")
+
+    room = bytes(frames[1]).decode()
+    msg = bytes(frames[2]).decode()
+    if len(frames) == 4:
+        plain = bytes(frames[3]).decode()
+    else:
+        plain = None
+    return (room, msg, plain)
+
+
+# the first frame of a metrics snapshot from a webhook process, never the
+# same as ENVELOPE_VERSION
+METRICS_ENVELOPE = b"metrics-1"
+
+
+def pack_metrics(worker, snapshot):
+    """Envelope for a `Registry.snapshot()` from the webhook process named
+    `worker`"""
+    return [METRICS_ENVELOPE, worker.encode(), dumps(snapshot)]
+
+
+def is_metrics(frames):
+    return bytes(frames[0]) == METRICS_ENVELOPE
+
+
+def unpack_metrics(frames):
+    """Returns (worker, snapshot) from the frames made by `pack_metrics`,
+    raises ValueError if they aren't valid
+    """
+    if len(frames) != 3 or not is_metrics(frames):
+        raise ValueError(f"invalid metrics envelope with {len(frames)} frames")
+    try:
+        snapshot = loads(bytes(frames[2]))
+    except DecodeError as e:
+        raise ValueError(f"invalid metrics snapshot: {e}") from e
+    return (bytes(frames[1]).decode(), snapshot)
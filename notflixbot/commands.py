@@ -0,0 +1,129 @@
+import asyncio
+from collections import deque, namedtuple
+
+from loguru import logger
+
+from notflixbot.emojis import ERROR
+
+Command = namedtuple("Command", ["name", "user_id", "handler"])
+
+
+class CommandRunner:
+    """Runs command handlers in background tasks, so a slow command (like
+    `!add`) doesn't hold up the sync loop and every other room.
+
+    Commands in the same room run one at a time in the order they were
+    received, so replies come in order. At most `max_concurrent` commands
+    run at the same time, each user can have at most `max_per_user`
+    commands queued or running (more are rejected), and a command that
+    takes longer than `timeout` seconds is cancelled.
+
+    `notify(room_id, msg)` is used to tell the room when a command was
+    rejected, timed out or failed.
+    """
+
+    def __init__(self, notify, timeout=60.0, max_concurrent=4, max_per_user=2):
+        self._notify = notify
+        self.timeout = timeout
+        self.max_per_user = max_per_user
+        self._sem = asyncio.Semaphore(max_concurrent)
+
+        self._queues = dict()
+        self._workers = dict()
+        # user_id -> commands queued or running
+        self._per_user = dict()
+        self._notifying = set()
+
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.failed = 0
+
+    @classmethod
+    def from_config(cls, notify, commands):
+        return cls(notify, **commands)
+
+    def submit(self, room_id, user_id, name, handler):
+        """Queues `handler()` to run in `room_id`, returns False if the
+        user already has too many commands queued"""
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            self.rejected += 1
+            logger.warning(f"Rejected '{name}' from {user_id}, too many commands running")
+            self._spawn_notify(room_id, f"{ERROR} `{name}`: you have too many commands running")
+            return False
+
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self._queues.setdefault(room_id, deque()).append(Command(name, user_id, handler))
+        if room_id not in self._workers:
+            self._workers[room_id] = asyncio.ensure_future(self._drain(room_id))
+        return True
+
+    def _spawn_notify(self, room_id, msg):
+        # the sync loop doesnt wait for this either
+        task = asyncio.ensure_future(self._safe_notify(room_id, msg))
+        self._notifying.add(task)
+        task.add_done_callback(self._notifying.discard)
+
+    async def _safe_notify(self, room_id, msg):
+        try:
+            await self._notify(room_id, msg)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Could not notify {room_id}: {e!r}")
+
+    async def _run(self, room_id, cmd):
+        try:
+            async with self._sem:
+                await asyncio.wait_for(cmd.handler(), self.timeout)
+            self.completed += 1
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            logger.error(f"'{cmd.name}' from {cmd.user_id} timed out after {self.timeout:.0f}s")
+            await self._safe_notify(room_id, f"{ERROR} `{cmd.name}` timed out")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failed += 1
+            logger.exception(f"'{cmd.name}' from {cmd.user_id} failed")
+            await self._safe_notify(room_id, f"{ERROR} `{cmd.name}` failed")
+
+    async def _drain(self, room_id):
+        q = self._queues[room_id]
+        try:
+            while q:
+                cmd = q[0]
+                try:
+                    await self._run(room_id, cmd)
+                finally:
+                    q.popleft()
+                    self._release(cmd.user_id)
+        finally:
+            del self._workers[room_id]
+            # commands that never ran because this was cancelled
+            while q:
+                self._release(q.popleft().user_id)
+            del self._queues[room_id]
+
+    def _release(self, user_id):
+        n = self._per_user[user_id] - 1
+        if n == 0:
+            del self._per_user[user_id]
+        else:
+            self._per_user[user_id] = n
+
+    def stats(self):
+        return {
+            'rooms': len(self._workers),
+            'queued': sum(len(q) for q in self._queues.values()),
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'failed': self.failed,
+        }
+
+    async def close(self):
+        workers = list(self._workers.values()) + list(self._notifying)
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
@@ -8,6 +8,7 @@ from json.decoder import JSONDecodeError
 from loguru import logger
 
 from notflixbot.errors import ConfigError
+from notflixbot.logsink import BatchSink, Destination
 
 
 class Config(object):
@@ -68,7 +69,15 @@ class Config(object):
             'json': self._get_cfg(["log", "json"], default=False),
             'stderr': self._get_cfg(["log", "stderrr"], default=True),
             'webhook_access_log': self._get_cfg(
-                ["log", "webhook_access_log"], default=None)
+                ["log", "webhook_access_log"], default=None),
+            # "enqueue": a loguru queue per sink, "batch": one BatchSink
+            'mode': self._get_cfg(["log", "mode"], default="enqueue"),
+            'batch_size': int(self._get_cfg(["log", "batch_size"], default=512)),
+            'flush_interval': float(self._get_cfg(["log", "flush_interval"], default=0.5)),
+            'max_queue': int(self._get_cfg(["log", "max_queue"], default=10000)),
+            # route -> share of successful requests in the access log
+            'access_log_sample': self._get_cfg(
+                ["log", "access_log_sample"], default={'/ruok': 0.0}),
         }
         setup_logger(self.log, self._debug_arg)
 
@@ -83,6 +92,46 @@ class Config(object):
             ["matrix", "avatar"], required=False)
         self.rooms = self._get_cfg(
             ["matrix", "rooms"], default=list())
+        self.alias_cache_ttl = float(self._get_cfg(
+            ["matrix", "alias_cache_ttl"], default=3600))
+        self.alias_cache_negative_ttl = float(self._get_cfg(
+            ["matrix", "alias_cache_negative_ttl"], default=60))
+        self.room_workers = int(self._get_cfg(
+            ["matrix", "room_workers"], default=4))
+        # how many rooms are warmed up at once after the first sync
+        self.startup_concurrency = int(self._get_cfg(
+            ["matrix", "startup_concurrency"], default=8))
+        # should be sized to the homeserver's rc_message limits
+        self.send_ratelimit = {
+            'rate': float(self._get_cfg(
+                ["matrix", "ratelimit", "rate"], default=5.0)),
+            'burst': int(self._get_cfg(
+                ["matrix", "ratelimit", "burst"], default=10)),
+            'room_rate': float(self._get_cfg(
+                ["matrix", "ratelimit", "room_rate"], default=1.0)),
+            'room_burst': int(self._get_cfg(
+                ["matrix", "ratelimit", "room_burst"], default=5)),
+            'max_retries': int(self._get_cfg(
+                ["matrix", "ratelimit", "max_retries"], default=5)),
+        }
+        # commands run in the background, see notflixbot.commands
+        self.commands = {
+            'timeout': float(self._get_cfg(
+                ["matrix", "commands", "timeout"], default=60.0)),
+            'max_concurrent': int(self._get_cfg(
+                ["matrix", "commands", "max_concurrent"], default=4)),
+            'max_per_user': int(self._get_cfg(
+                ["matrix", "commands", "max_per_user"], default=2)),
+        }
+        # long-poll timeout for sync requests, in milliseconds. it is
+        # lowered (down to min_timeout) when sync requests time out, in
+        # case something between us and the homeserver drops long requests
+        self.sync_timeout = int(self._get_cfg(
+            ["matrix", "sync", "timeout"], default=30000))
+        self.sync_min_timeout = int(self._get_cfg(
+            ["matrix", "sync", "min_timeout"], default=3000))
+        if self.sync_min_timeout > self.sync_timeout:
+            raise ConfigError("matrix.sync.min_timeout can't be larger than matrix.sync.timeout")
 
         self.webhook_port = int(self._get_cfg(
             ["webhook", "port"], default=3000))
@@ -96,6 +145,39 @@ class Config(object):
             self.webhook_base_url = self.webhook_base_url + "/"
         self.webhook_tokens = self._get_cfg(
             ["webhook", "tokens"], default=dict())
+        # set to an ipc:// or tcp:// address to run the webhook server
+        # in separate processes from the bot
+        self.webhook_zmq = self._get_cfg(["webhook", "zmq"], default=None)
+        self.webhook_zmq_hwm = int(self._get_cfg(
+            ["webhook", "zmq_hwm"], default=1000))
+        self.webhook_workers = int(self._get_cfg(
+            ["webhook", "workers"], default=1))
+        self.webhook_reuse_port = self._get_cfg(
+            ["webhook", "reuse_port"], default=self.webhook_workers > 1)
+        # where `notflixbot bot` serves /metrics for itself and the
+        # webhook processes, since it doesn't run the webhook server
+        self.webhook_metrics_host = self._get_cfg(
+            ["webhook", "metrics", "host"], default=self.webhook_host)
+        self.webhook_metrics_port = int(self._get_cfg(
+            ["webhook", "metrics", "port"], default=self.webhook_port + 1))
+
+        # merge bursts of messages to the same room, off by default
+        self.webhook_coalesce_window = float(self._get_cfg(
+            ["webhook", "coalesce", "window"], default=0.0))
+        self.webhook_coalesce_max_batch = int(self._get_cfg(
+            ["webhook", "coalesce", "max_batch"], default=1))
+
+        # duplicate notifications, see notflixbot.dedup
+        self.webhook_dedup = {
+            'window': float(self._get_cfg(
+                ["webhook", "dedup", "window"], default=600.0)),
+            'maxsize': int(self._get_cfg(
+                ["webhook", "dedup", "maxsize"], default=4096)),
+            'max_bytes': int(self._get_cfg(
+                ["webhook", "dedup", "max_bytes"], default=1024 * 1024)),
+            'policies': self._get_cfg(
+                ["webhook", "dedup", "sources"], default=dict()),
+        }
 
         self.notflixbot = self._get_cfg(["notflixbot"], default=dict())
         self.autotrust = self._get_cfg(["autotrust"], default=False)
@@ -110,6 +192,28 @@ class Config(object):
 
         self.storage_path = self._get_cfg(["storage_path"], required=True)
 
+        self.outbox_path = self._get_cfg(
+            ["outbox", "path"],
+            default=os.path.join(self.storage_path, "outbox.db"))
+        self.outbox_maxsize = int(self._get_cfg(
+            ["outbox", "maxsize"], default=10000))
+        self.outbox_flush_interval = float(self._get_cfg(
+            ["outbox", "flush_interval"], default=0.05))
+
+        self.tmdb_cache_path = self._get_cfg(
+            ["tmdb_cache", "path"],
+            default=os.path.join(self.storage_path, "tmdb.db"))
+        self.tmdb_cache_maxsize = int(self._get_cfg(
+            ["tmdb_cache", "maxsize"], default=10000))
+        # in seconds. stale entries are used while they are refreshed
+        self.tmdb_cache_ttl = float(self._get_cfg(
+            ["tmdb_cache", "ttl"], default=7 * 86400))
+        self.tmdb_cache_stale_ttl = float(self._get_cfg(
+            ["tmdb_cache", "stale_ttl"], default=30 * 86400))
+        # for imdb ids that TheMovieDB has nothing for
+        self.tmdb_cache_negative_ttl = float(self._get_cfg(
+            ["tmdb_cache", "negative_ttl"], default=86400))
+
     def update_creds(self, credentials):
         self.creds = Credentials(credentials, self.credentials_path)
         self.creds.write()
@@ -141,6 +245,11 @@ def setup_logger(logconf, debug_arg):
     logger.remove()
 
     loglevel = logconf['level']
+    mode = logconf.get('mode', "enqueue")
+    if mode == "batch":
+        return setup_batch_logger(logconf, debug_arg)
+    elif mode != "enqueue":
+        raise ConfigError(f"log.mode must be 'enqueue' or 'batch', not '{mode}'")
 
     # --debug has precedence, but only affects stderr
     if debug_arg:
@@ -177,3 +286,34 @@ def setup_logger(logconf, debug_arg):
             enqueue=True,
             filter=lambda r: 'access_log' in r['extra'],
         )
+
+
+def setup_batch_logger(logconf, debug_arg):
+    """All destinations are written by one BatchSink"""
+    loglevel = logger.level(logconf['level']).no
+    destinations = list()
+
+    if debug_arg:
+        destinations.append(Destination(sys.stderr, logger.level("DEBUG").no))
+    elif logconf.get('stderr', False) is True:
+        destinations.append(Destination(sys.stderr, loglevel))
+
+    if logconf.get('logfile') is not None:
+        destinations.append(
+            Destination(logconf['logfile'], loglevel, serialize=logconf['json']))
+
+    if logconf.get('webhook_access_log') is not None:
+        destinations.append(Destination(
+            logconf['webhook_access_log'], logger.level("INFO").no, access_log=True))
+
+    if not destinations:
+        return None
+
+    sink = BatchSink(
+        destinations,
+        batch_size=logconf.get('batch_size', 512),
+        flush_interval=logconf.get('flush_interval', 0.5),
+        max_queue=logconf.get('max_queue', 10000),
+    )
+    logger.add(sink, level=min(d.level_no for d in destinations), format="{message}")
+    return sink
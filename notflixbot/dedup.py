@@ -0,0 +1,137 @@
+import hashlib
+import heapq
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+from notflixbot.metrics import WEBHOOK_DEDUPED
+
+# which webhook sources are deduplicated, and how. a notification is a
+# duplicate of an earlier one to the same room within `window` seconds
+# if the payload `fields` are the same, or if the message is the same
+# when `fields` is None
+DEFAULT_POLICIES = {
+    'jellyfin_playback': {'fields': ["NotificationUsername", "ItemId", "DeviceName"]},
+    'jellyfin_session': {'fields': ["NotificationUsername", "DeviceName", "Client"]},
+}
+
+
+class Dedup:
+    """Suppresses duplicate webhook notifications, like the same Jellyfin
+    client starting to play the same thing several times.
+
+    Only sources that have a policy are deduplicated. What has been sent
+    is remembered by a hash in an LRU that is bounded both by number of
+    entries and bytes (room names come from the request, so they can be
+    anything), entries expire after the policy's window. Policies can
+    have different windows, so the entries are expired from a heap
+    ordered by when they expire, not in the order they were added.
+
+    Every process has its own, so when the webhook server runs in
+    several processes (`SO_REUSEPORT`), duplicates that arrive at
+    different processes aren't caught.
+    """
+
+    def __init__(self, window=600.0, policies=None, maxsize=4096,
+                 max_bytes=1024 * 1024, clock=time.monotonic):
+        self.window = window
+        self.policies = dict(DEFAULT_POLICIES)
+        if policies is not None:
+            self.policies.update(policies)
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._clock = clock
+
+        # (room, digest) -> (expires_at, nbytes)
+        self._seen = OrderedDict()
+        self._bytes = 0
+        # (expires_at, key). entries that were removed or replaced are
+        # left in it, and skipped when they come up
+        self._expiry = list()
+
+        self.suppressed = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**config.webhook_dedup)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _key(self, source, room, msg, payload):
+        policy = self.policies[source]
+        fields = policy.get('fields')
+        h = hashlib.blake2b(source.encode(), digest_size=16)
+        if fields is None or payload is None:
+            h.update(msg.encode())
+        else:
+            for field in fields:
+                h.update(b"\0")
+                h.update(str(payload.get(field)).encode())
+        return (room, h.digest())
+
+    def _remove(self, key):
+        _, nbytes = self._seen.pop(key)
+        self._bytes -= nbytes
+
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry)
+            found = self._seen.get(key)
+            if found is not None and found[0] == expires_at:
+                self._remove(key)
+
+        if len(self._expiry) > 2 * len(self._seen) + 64:
+            # mostly entries that are gone already
+            self._expiry = [(found[0], key) for key, found in self._seen.items()]
+            heapq.heapify(self._expiry)
+
+    def _evict(self):
+        self._expire(self._clock())
+        while len(self._seen) > self.maxsize or self._bytes > self.max_bytes:
+            # the least recently added
+            self._remove(next(iter(self._seen)))
+            self.evictions += 1
+
+    def is_duplicate(self, source, room, msg, payload=None):
+        """Returns True if this was already sent to `room`, otherwise it is
+        remembered as sent.
+        """
+        if source not in self.policies:
+            return False
+
+        key = self._key(source, room, msg, payload)
+        now = self._clock()
+        found = self._seen.get(key)
+        if found is not None and found[0] > now:
+            self.suppressed += 1
+            WEBHOOK_DEDUPED.inc(source=source)
+            logger.debug(f"Suppressed duplicate from {source} to {room}: '{msg[:30]}..'")
+            return True
+        elif found is not None:
+            self._remove(key)
+
+        window = self.policies[source].get('window', self.window)
+        nbytes = len(room) + len(key[1])
+        self._seen[key] = (now + window, nbytes)
+        self._bytes += nbytes
+        heapq.heappush(self._expiry, (now + window, key))
+        self._evict()
+        return False
+
+    def forget(self, source, room, msg, payload=None):
+        """For when sending failed after all"""
+        if source in self.policies:
+            key = self._key(source, room, msg, payload)
+            if key in self._seen:
+                self._remove(key)
+
+    def stats(self):
+        return {
+            'size': len(self._seen),
+            'bytes': self._bytes,
+            'suppressed': self.suppressed,
+            'evictions': self.evictions,
+        }
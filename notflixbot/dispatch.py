@@ -0,0 +1,98 @@
+import asyncio
+from collections import deque
+
+from loguru import logger
+
+
+class RoomDispatcher:
+    """Fans messages out to one ordered queue per room.
+
+    Each room with queued messages gets a worker task that delivers them
+    in order, and at most `max_workers` rooms are delivering at the same
+    time, so a slow room doesn't hold up the others. `submit()` waits when
+    `max_pending` messages are queued, to bound memory use.
+
+    `deliver` is called with a list of up to `max_batch` queued messages
+    for the same room. If `batch_window` is set, a worker waits up to that
+    many seconds for a batch to fill up before delivering, so that bursts
+    can be sent as one message.
+
+    If `deliver` raises, the messages stay at the head of the room queue
+    and are retried with a growing delay.
+    """
+
+    def __init__(self, deliver, max_workers=4, max_pending=1000,
+                 max_batch=1, batch_window=0.0, retry_delay=1.0,
+                 max_retry_delay=60.0):
+        self._deliver = deliver
+        self._sem = asyncio.Semaphore(max_workers)
+        self._pending = asyncio.Semaphore(max_pending)
+        self.max_workers = max_workers
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self._queues = dict()
+        self._workers = dict()
+        self._batch_full = dict()
+
+    async def submit(self, room, item):
+        await self._pending.acquire()
+        q = self._queues.setdefault(room, deque())
+        q.append(item)
+        if room not in self._workers:
+            self._batch_full[room] = asyncio.Event()
+            self._workers[room] = asyncio.ensure_future(self._drain(room))
+        if len(q) >= self.max_batch:
+            self._batch_full[room].set()
+
+    async def _wait_for_batch(self, room):
+        batch_full = self._batch_full[room]
+        if len(self._queues[room]) >= self.max_batch:
+            return
+        batch_full.clear()
+        try:
+            await asyncio.wait_for(batch_full.wait(), self.batch_window)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _deliver_with_retry(self, room, items):
+        delay = self.retry_delay
+        while True:
+            try:
+                async with self._sem:
+                    return await self._deliver(items)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Delivery to {room} failed, retrying in {delay:.0f}s: {e!r}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    async def _drain(self, room):
+        q = self._queues[room]
+        try:
+            while q:
+                if self.batch_window > 0 and self.max_batch > 1:
+                    await self._wait_for_batch(room)
+
+                batch = [q[i] for i in range(min(len(q), self.max_batch))]
+                await self._deliver_with_retry(room, batch)
+                for _ in batch:
+                    q.popleft()
+                    self._pending.release()
+        finally:
+            del self._workers[room]
+            del self._batch_full[room]
+            if not q:
+                del self._queues[room]
+
+    def depths(self):
+        return {room: len(q) for room, q in self._queues.items()}
+
+    async def close(self):
+        workers = list(self._workers.values())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
@@ -12,9 +12,22 @@ class MatrixError(NotflixbotError):
     ...
 
 
+class MatrixUnavailableError(NotflixbotError):
+    """The homeserver failed in a way that might work later (5xx, rate
+    limited), not a MatrixError so it isnt handled like one"""
+
+
 class ImdbError(NotflixbotError):
     ...
 
 
 class TvdbError(NotflixbotError):
     ...
+
+
+class UpstreamError(NotflixbotError):
+    ...
+
+
+class RelayError(NotflixbotError):
+    ...
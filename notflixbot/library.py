@@ -0,0 +1,144 @@
+import time
+
+from loguru import logger
+
+# the source of the titles in the TitleIndex
+SOURCE = "radarr"
+
+
+def from_radarr(movie):
+    """A movie from the Radarr API (or a Radarr webhook) in the same shape
+    as the items from `TheMovieDB.search_imdb_id`, or None if it doesn't
+    have a tmdb id"""
+    try:
+        tmdb_id = int(movie['tmdbId'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return {
+        't': "movie",
+        'title': movie.get('title', ""),
+        'release_year': str(movie.get('year', "")),
+        'tmdb_id': tmdb_id,
+        'imdb_id': movie.get('imdbId') or None,
+        'radarr_id': movie.get('id'),
+    }
+
+
+class Library:
+    """The movies that are in Radarr, by tmdb id and imdb id.
+
+    It is loaded from Radarr in one request, and kept up to date from the
+    Radarr webhooks and from the movies that the bot adds itself, so that
+    `!add` can tell that a movie already exists without asking Radarr. It
+    is reloaded when it is older than `ttl` seconds, to pick up what has
+    changed in Radarr without a webhook.
+
+    The titles are added to `titles` (a `TitleIndex`) too, if it is given.
+    """
+
+    def __init__(self, ttl=3600.0, titles=None, clock=time.monotonic):
+        self.ttl = ttl
+        self.titles = titles
+        self._clock = clock
+        # tmdb_id -> item
+        self._by_tmdb = dict()
+        # imdb_id -> tmdb_id
+        self._by_imdb = dict()
+        self.loaded_at = None
+
+        self.loads = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._by_tmdb)
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    def is_stale(self):
+        return self.loaded_at is None or self._clock() - self.loaded_at > self.ttl
+
+    def replace(self, movies):
+        """Replaces everything with `movies` from the Radarr API"""
+        old = self._by_tmdb
+        self._by_tmdb = dict()
+        self._by_imdb = dict()
+        for movie in movies:
+            item = from_radarr(movie)
+            if item is None:
+                logger.warning(f"radarr movie without a tmdbId: '{movie.get('title')}'")
+                continue
+            self._by_tmdb[item['tmdb_id']] = item
+            if item['imdb_id'] is not None:
+                self._by_imdb[item['imdb_id']] = item['tmdb_id']
+
+        if self.titles is not None:
+            # only what changed, not the whole index
+            before = {(i['title'], i['release_year']) for i in old.values()}
+            after = {(i['title'], i['release_year']) for i in self._by_tmdb.values()}
+            for title, year in before - after:
+                self.titles.remove(title, year, SOURCE)
+            for title, year in after - before:
+                self.titles.add(title, year, SOURCE)
+
+        self.loaded_at = self._clock()
+        self.loads += 1
+        logger.info(f"Loaded {len(self)} movies from radarr")
+
+    def add(self, movie):
+        """Adds a movie from the Radarr API or a webhook, returns the item"""
+        item = from_radarr(movie)
+        if item is None:
+            logger.warning(f"radarr movie without a tmdbId: '{movie.get('title')}'")
+            return None
+        self.add_item(item)
+        return item
+
+    def add_item(self, item):
+        """Adds an item from `TheMovieDB.search_imdb_id`"""
+        old = self._by_tmdb.get(item['tmdb_id'])
+        if old is not None:
+            self._forget(old)
+        self._by_tmdb[item['tmdb_id']] = item
+        if item['imdb_id'] is not None:
+            self._by_imdb[item['imdb_id']] = item['tmdb_id']
+        if self.titles is not None:
+            self.titles.add(item['title'], item['release_year'], SOURCE)
+
+    def _forget(self, item):
+        if item['imdb_id'] is not None:
+            self._by_imdb.pop(item['imdb_id'], None)
+        if self.titles is not None:
+            self.titles.remove(item['title'], item['release_year'], SOURCE)
+
+    def remove(self, tmdb_id):
+        item = self._by_tmdb.pop(tmdb_id, None)
+        if item is not None:
+            self._forget(item)
+        return item
+
+    def get(self, imdb_id=None, tmdb_id=None):
+        """Returns the item if the movie is in Radarr, otherwise None"""
+        if tmdb_id is None and imdb_id is not None:
+            tmdb_id = self._by_imdb.get(imdb_id)
+        item = self._by_tmdb.get(tmdb_id)
+        if item is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return item
+
+    def stats(self):
+        if self.loaded_at is None:
+            age = None
+        else:
+            age = int(self._clock() - self.loaded_at)
+        return {
+            'movies': len(self._by_tmdb),
+            'age': age,
+            'loads': self.loads,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,190 @@
+"""A loguru sink that writes in batches from a background thread.
+
+With `enqueue=True`, every sink has its own multiprocessing queue, and
+every record is formatted (and serialized, for JSON) by loguru before it
+is queued. `BatchSink` is added as one sink for all of the destinations,
+only appends the record to a deque on the logging side, and a writer
+thread formats and writes everything that has been queued, one write per
+destination for every batch.
+"""
+
+import json
+import os
+import sys
+import threading
+from collections import deque
+
+from notflixbot.metrics import LOG_BATCH_SECONDS, LOG_DROPPED, LOG_QUEUE
+
+
+class Destination:
+    """Where the batch writer writes records to. `access_log` selects
+    either only the webhook access log records or only the others."""
+
+    def __init__(self, path, level_no, access_log=False, serialize=False):
+        self.path = path
+        self.level_no = level_no
+        self.access_log = access_log
+        self.serialize = serialize
+        self._stream = None
+
+    def open(self):
+        if self._stream is None:
+            if self.path is sys.stderr:
+                self._stream = sys.stderr
+            else:
+                self._stream = open(self.path, "a", encoding="utf-8")
+        return self._stream
+
+    def close(self):
+        if self._stream is not None and self._stream is not sys.stderr:
+            self._stream.close()
+        self._stream = None
+
+    def wants(self, record):
+        return (record['level'].no >= self.level_no
+                and ('access_log' in record['extra']) == self.access_log)
+
+    def format(self, message):
+        record = message.record
+        if self.serialize:
+            return serialize(message) + "\n"
+        if self.access_log:
+            return f"{record['time'].isoformat()} | {record['level'].name} - {record['message']}\n"
+        # `message` is "{message}", plus the traceback if there was one
+        return (f"{record['time']:%Y-%m-%d %H:%M:%S.%f} | {record['level'].name: <8} | "
+                f"{record['name']}:{record['function']}:{record['line']} - {message}")
+
+
+def serialize(message):
+    record = message.record
+    exception = record['exception']
+    return json.dumps({
+        'time': record['time'].isoformat(),
+        'level': record['level'].name,
+        'message': record['message'],
+        'name': record['name'],
+        'function': record['function'],
+        'line': record['line'],
+        'process': record['process'].id,
+        'thread': record['thread'].name,
+        'extra': record['extra'],
+        'exception': None if exception is None else message[len(record['message']) + 1:],
+    }, default=str)
+
+
+class BatchSink:
+    """Add with `logger.add(sink, format="{message}", level=...)`.
+
+    Writing a record is a `deque.append`. The writer thread wakes up
+    every `flush_interval` seconds, or when `batch_size` records are
+    queued. When `max_queue` records are waiting (f.ex. the disk is slow),
+    new records are dropped and counted instead of making the logging
+    side wait, so logging never costs more than an append.
+    """
+
+    def __init__(self, destinations, batch_size=512, flush_interval=0.5, max_queue=10000):
+        self.destinations = destinations
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        # a forked process doesnt have the writer thread
+        self._pid = os.getpid()
+
+        self.records = 0
+        self.dropped = 0
+        self.batches = 0
+
+        LOG_QUEUE.set_function(lambda: len(self._queue))
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, message):
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            LOG_DROPPED.inc()
+            return
+        self._queue.append(message)
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._drain()
+
+    def _drain(self):
+        if not self._queue:
+            return
+        with LOG_BATCH_SECONDS.time():
+            batch = [self._queue.popleft() for _ in range(len(self._queue))]
+            for dest in self.destinations:
+                lines = [dest.format(m) for m in batch if dest.wants(m.record)]
+                if not lines:
+                    continue
+                try:
+                    stream = dest.open()
+                    stream.write("".join(lines))
+                    stream.flush()
+                except (OSError, ValueError) as e:
+                    # there is no logging this
+                    print(f"log-writer: could not write to {dest.path}: {e!r}", file=sys.stderr)
+            self.records += len(batch)
+            self.batches += 1
+
+    def stop(self):
+        """Called by loguru when the sink is removed (and at exit), writes
+        what is still queued"""
+        if os.getpid() != self._pid:
+            # queued by the parent process, which writes them itself
+            self._queue.clear()
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        self._drain()
+        for dest in self.destinations:
+            dest.close()
+
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'records': self.records,
+            'dropped': self.dropped,
+            'batches': self.batches,
+        }
+
+
+class AccessLogSampler:
+    """Decides which access log lines for successful requests are logged.
+
+    `rates` maps routes (f.ex. "/ruok") to the share of their successful
+    requests that are logged, from 0.0 (none) to 1.0 (all, the default
+    for routes that aren't in it). Every n-th request is logged rather
+    than a random one, so the lines are evenly spread out.
+
+    The request path is looked up when the route isn't in `rates`, since
+    `/ruok` is answered at that path whatever `base_url` is, without a
+    route of its own then.
+    """
+
+    def __init__(self, rates=None):
+        self.rates = dict(rates or {})
+        # route -> successful requests seen
+        self._seen = dict()
+
+    def keep(self, route, status, path=None):
+        key = route if route in self.rates else path
+        rate = self.rates.get(key)
+        if rate is None or rate >= 1.0 or status >= 400:
+            return True
+        if rate <= 0.0:
+            return False
+        n = self._seen.get(key, 0) + 1
+        self._seen[key] = n
+        return int(n * rate) > int((n - 1) * rate)
@@ -1,5 +1,6 @@
 import argparse
 import asyncio
+import multiprocessing
 from asyncio import TimeoutError
 from asyncio.exceptions import CancelledError
 from time import sleep
@@ -9,10 +10,13 @@ from aiohttp import ClientConnectionError, ServerDisconnectedError
 from loguru import logger
 
 from notflixbot import version_dict
+from notflixbot.bench import SCENARIOS, format_results, run_benchmark
 from notflixbot.config import Config
 from notflixbot.errors import ConfigError
 from notflixbot.healthcheck import healthcheck
 from notflixbot.matrix import MatrixClient
+from notflixbot.outbox import Outbox
+from notflixbot.relay import ZmqSink, ZmqSource
 from notflixbot.webhook import Webhook
 
 
@@ -27,9 +31,16 @@ def get_parser():
 
     subparser.add_parser("start", help="Start Matrix bot and webhook HTTP server")
     subparser.add_parser("restore_login", help="Start a new Matrix session")
-    subparser.add_parser("webhook", help="Start webhook HTTP server")
+    subparser.add_parser("bot", help="Start Matrix bot, receiving webhooks from 'webhook' processes")
+    subparser.add_parser("webhook", help="Start webhook HTTP server processes, sending to 'bot'")
     healthcheck_parser = subparser.add_parser("Healthcheck", help="Run healthcheck for webhook HTTP server")
     healthcheck_parser.add_argument("--quiet", action="store_true")
+    bench_parser = subparser.add_parser("bench", help="Load test the webhook HTTP server")
+    bench_parser.add_argument("--requests", type=int, default=5000, help="Number of requests to send")
+    bench_parser.add_argument("--concurrency", type=int, default=32, help="Number of requests in flight")
+    bench_parser.add_argument("--scenario", choices=list(SCENARIOS), default="mixed", help="Which payloads to send")
+    bench_parser.add_argument("--sink", choices=["fake", "outbox"], default="fake",
+                              help="Count messages, or write them to a temporary outbox")
     nio_parser = subparser.add_parser("nio", help="Low-level stuff, helpful for dev")
     nio_parser.add_argument("--forget-room", type=str, required=True, help="The canonical_alias or room_id of a room to forget")
 
@@ -41,25 +52,33 @@ def get_parser():
 async def async_main(args, config):
     logger.success(f"{version_dict['name']} {version_dict['version']}")
 
+    outbox = Outbox.from_config(config)
     ctx = zmq.asyncio.Context()
     try:
-        webhook = Webhook(config, ctx)
+        async with MatrixClient(config, outbox) as matrix:
+            # shares the radarr library with the matrix client
+            webhook = Webhook(config, outbox, matrix.notflix)
 
-        if args.subcmd == "webhook":
-            await webhook.serve()
-            await asyncio.sleep(3600)
-
-        async with MatrixClient(config, ctx) as matrix:
-            if args.subcmd == "start":
+            if args.subcmd in ["start", "bot"]:
 
                 await matrix.auth()
 
-                await asyncio.gather(
+                tasks = [
                     asyncio.create_task(matrix._after_first_sync()),
                     asyncio.create_task(matrix.sync_forever()),
                     asyncio.create_task(matrix.webhook_poller()),
-                    asyncio.create_task(webhook.serve())
-                )
+                ]
+                if args.subcmd == "start":
+                    tasks.append(asyncio.create_task(webhook.serve()))
+                else:
+                    tasks.append(asyncio.create_task(webhook.serve_metrics(
+                        config.webhook_metrics_host, config.webhook_metrics_port)))
+                if config.webhook_zmq is not None:
+                    source = ZmqSource(ctx, config.webhook_zmq, outbox)
+                    webhook.worker_metrics = source.metrics
+                    tasks.append(asyncio.create_task(source.run()))
+
+                await asyncio.gather(*tasks)
 
             if args.subcmd == "restore_login":
                 await matrix.restore_login()
@@ -76,12 +95,76 @@ async def async_main(args, config):
 
     except CancelledError:
         logger.info("Cancelled")
-        ctx.destroy()
 
     except (ClientConnectionError, ServerDisconnectedError, TimeoutError):
         logger.warning("Unable to connect to homeserver, retrying in 15s...")
         sleep(15)
 
+    finally:
+        outbox.close()
+        ctx.destroy(linger=0)
+
+
+@logger.catch
+async def webhook_frontend(config):
+    ctx = zmq.asyncio.Context()
+    sink = ZmqSink(ctx, config.webhook_zmq, hwm=config.webhook_zmq_hwm)
+    try:
+        webhook = Webhook(config, sink, metrics=False)
+        await webhook.serve(reuse_port=config.webhook_reuse_port)
+        # serve until we are killed
+        await sink.push_metrics(multiprocessing.current_process().name)
+    finally:
+        sink.close()
+        ctx.destroy()
+
+
+def _webhook_process(config_path, debug_arg):
+    # read the config again, to set up logging in this process
+    config = Config.read(config_path, debug_arg)
+    try:
+        asyncio.run(webhook_frontend(config))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_webhook_frontends(args, config):
+    """Runs `webhook.workers` webhook HTTP server processes that send
+    messages to the bot over ZMQ, and restarts them if they exit.
+    """
+    if config.webhook_zmq is None:
+        logger.error("Set 'webhook.zmq' to an ipc:// or tcp:// address to run webhook processes")
+        raise SystemExit(2)
+
+    logger.success(f"{version_dict['name']} {version_dict['version']}")
+    logger.info(f"Starting {config.webhook_workers} webhook processes, sending to {config.webhook_zmq}")
+
+    procs = dict()
+    try:
+        while True:
+            for i in range(config.webhook_workers):
+                proc = procs.get(i)
+                if proc is not None and proc.is_alive():
+                    continue
+                if proc is not None:
+                    logger.warning(f"{proc.name} exited ({proc.exitcode}), restarting")
+
+                proc = multiprocessing.Process(
+                    target=_webhook_process,
+                    args=(args.config, args.debug),
+                    name=f"webhook-{i}",
+                    daemon=True
+                )
+                proc.start()
+                procs[i] = proc
+            sleep(1.0)
+    except KeyboardInterrupt:
+        logger.warning("C-c was passed, exiting..")
+        for proc in procs.values():
+            proc.terminate()
+            proc.join()
+        raise SystemExit(1)
+
 
 def main():
     try:
@@ -95,6 +178,16 @@ def main():
     if args.subcmd == "healthcheck":
         return healthcheck(config.webhook_host, config.webhook_port, args.quiet)
 
+    if args.subcmd == "webhook":
+        return run_webhook_frontends(args, config)
+
+    if args.subcmd == "bench":
+        results = asyncio.run(run_benchmark(
+            config, args.requests, args.concurrency, args.scenario, args.sink))
+        for line in format_results(results).splitlines():
+            logger.info(line)
+        return
+
     while True:
         try:
             asyncio.run(
@@ -1,26 +1,298 @@
 import asyncio
 import getpass
 import json
+import random
 import time
+import uuid
+from functools import partial
 
 import aiohttp.client_exceptions
 import click
-import zmq.asyncio
 from loguru import logger
-from markdown import markdown
-from nio import AsyncClient, AsyncClientConfig, InviteMemberEvent, JoinError
-from nio import LoginError, MatrixRoom, MegolmEvent, ProfileSetAvatarError
+from nio import AsyncClient, AsyncClientConfig, InviteMemberEvent
+from nio import JoinedMembersError, JoinedRoomsError, JoinError, LoginError
+from nio import MatrixRoom, MegolmEvent, ProfileSetAvatarError
 from nio import RoomMemberEvent, RoomMessageText, RoomResolveAliasError
-from nio.crypto import TrustState
+from nio import RoomSendError, RoomSendResponse, SyncError, UploadFilterError
 from nio.exceptions import OlmUnverifiedDeviceError
 from nio.responses import WhoamiError
 
 from notflixbot import version_dict
+from notflixbot.cache import TTLCache
+from notflixbot.commands import CommandRunner
+from notflixbot.dispatch import RoomDispatcher
 from notflixbot.emojis import ERROR, ROBOT
-from notflixbot.errors import ImdbError, MatrixError, NotflixbotError
-from notflixbot.notflix import Notflix
+from notflixbot.errors import ImdbError, MatrixError, MatrixUnavailableError
+from notflixbot.errors import NotflixbotError
+from notflixbot.metrics import FIRST_SYNC_SECONDS, SEND_LATENCY, SYNC_LATENCY
+from notflixbot.notflix import Notflix, format_add_results, format_have_results
+from notflixbot.phrases import PhraseMatcher
+from notflixbot.render import MarkdownRenderer
+from notflixbot.trust import TrustManager
+from notflixbot.upstream import Upstream
 from notflixbot.youtube import Youtube
 
+# sentinel for cache lookups, since None is a cached negative result
+_MISSING = object()
+
+# the event types that each nio event class is parsed from, for the
+# callbacks that the bot installs
+EVENT_TYPES = {
+    # messages in encrypted rooms are decrypted into RoomMessageText
+    RoomMessageText: ["m.room.message", "m.room.encrypted"],
+    RoomMemberEvent: ["m.room.member"],
+    InviteMemberEvent: ["m.room.member"],
+    MegolmEvent: ["m.room.encrypted"],
+}
+# room state that nio needs, whatever callbacks are installed
+STATE_EVENT_TYPES = [
+    "m.room.create", "m.room.member", "m.room.encryption",
+    "m.room.canonical_alias", "m.room.name",
+]
+
+
+def sync_filter(event_callbacks):
+    """Builds a sync filter that only asks for the event types that the
+    `event_callbacks` (nio's `ClientCallback`s) handle, and no presence,
+    typing, receipts or account data.
+
+    Only the members that sent something in the timeline are synced, the
+    rest are fetched by nio with joined_members when it needs them.
+    """
+    types = set(STATE_EVENT_TYPES)
+    for cb in event_callbacks:
+        classes = cb.filter if isinstance(cb.filter, tuple) else (cb.filter,)
+        for cls in classes:
+            if cls not in EVENT_TYPES:
+                logger.debug(f"No event types known for {cls}, not filtering the timeline")
+                types = None
+                break
+            types.update(EVENT_TYPES[cls])
+        if types is None:
+            break
+
+    timeline = {'lazy_load_members': True}
+    if types is not None:
+        timeline['types'] = sorted(types)
+    nothing = {'not_types': ["*"]}
+    return {
+        'presence': nothing,
+        'account_data': nothing,
+        'room': {
+            'state': {'types': STATE_EVENT_TYPES, 'lazy_load_members': True},
+            'timeline': timeline,
+            'ephemeral': nothing,
+            'account_data': nothing,
+        },
+    }
+
+
+async def _timed_phase(name, coro):
+    start = time.monotonic()
+    try:
+        return await coro
+    finally:
+        logger.debug(f"Startup: {name} took {(time.monotonic() - start) * 1000:.0f}ms")
+
+
+class InstrumentedClient(AsyncClient):
+    """AsyncClient that records how long sending a message takes,
+    split into phases (sharing megolm keys, encrypting and the HTTP
+    request), and how long sync requests take.
+    """
+
+    async def sync(self, *args, **kwargs):
+        with SYNC_LATENCY.time():
+            return await super().sync(*args, **kwargs)
+
+    async def share_group_session(self, *args, **kwargs):
+        with SEND_LATENCY.time(phase="share_keys"):
+            return await super().share_group_session(*args, **kwargs)
+
+    def encrypt(self, *args, **kwargs):
+        with SEND_LATENCY.time(phase="encrypt"):
+            return super().encrypt(*args, **kwargs)
+
+    async def _send(self, response_class, *args, **kwargs):
+        # _send is used for every request, only time room_send
+        if response_class is RoomSendResponse:
+            with SEND_LATENCY.time(phase="http"):
+                return await super()._send(response_class, *args, **kwargs)
+        return await super()._send(response_class, *args, **kwargs)
+
+
+class TokenBucket:
+    """Allows `rate` sends per second on average, with bursts of up to
+    `burst` sends.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """Takes a token and returns 0 if one is available, otherwise
+        returns how many seconds to wait before trying again
+        """
+        now = self._clock()
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        self._refill()
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return 0.0
+        return (1.0 - self._tokens) / self.rate
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    async def acquire(self):
+        while True:
+            wait = self.delay()
+            if wait <= 0.0:
+                return
+            await asyncio.sleep(wait)
+
+
+class PollTimeout:
+    """The long-poll timeout for sync requests (in milliseconds). Starts
+    at `max_timeout`, is halved (down to `min_timeout`) every time a sync
+    request fails, and doubles again with every sync that succeeds.
+    """
+
+    def __init__(self, min_timeout=3000, max_timeout=30000):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout = max_timeout
+
+    def succeeded(self):
+        self.timeout = min(self.max_timeout, self.timeout * 2)
+
+    def failed(self):
+        timeout = max(self.min_timeout, self.timeout // 2)
+        if timeout != self.timeout:
+            logger.info(f"Sync long-poll timeout lowered to {timeout}ms")
+        self.timeout = timeout
+
+
+class SendScheduler:
+    """Sends room events through per-room and global token buckets,
+    honours `retry_after_ms` on M_LIMIT_EXCEEDED and retries transient
+    failures with jittered exponential backoff.
+
+    The nio client is configured to not retry by itself
+    (`max_limit_exceeded=0` and `max_timeouts=0`), this does it instead.
+    Every attempt uses the same `tx_id`, so the homeserver deduplicates
+    retries.
+    """
+
+    def __init__(self, send, rate=5.0, burst=10, room_rate=1.0, room_burst=5,
+                 max_retries=5, backoff=0.5, max_backoff=30.0):
+        self._send = send
+        self._global = TokenBucket(rate, burst)
+        self._rooms = dict()
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.sent = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_config(cls, send, ratelimit):
+        return cls(send, **ratelimit)
+
+    def _room_bucket(self, room_id):
+        try:
+            return self._rooms[room_id]
+        except KeyError:
+            bucket = TokenBucket(self.room_rate, self.room_burst)
+            self._rooms[room_id] = bucket
+            return bucket
+
+    def _backoff(self, attempt):
+        wait = self.backoff * (2 ** attempt)
+        return min(wait, self.max_backoff) * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    def is_transient(resp):
+        """If sending again later might work, like after a 5xx or a rate
+        limit, rather than a 4xx that will fail again"""
+        if getattr(resp, 'status_code', None) == "M_LIMIT_EXCEEDED":
+            return True
+        transport = getattr(resp, 'transport_response', None)
+        status = getattr(transport, 'status', None)
+        return status is None or status >= 500
+
+    async def send(self, room_id, *args, **kwargs):
+        bucket = self._room_bucket(room_id)
+        # the same transaction id for every attempt, so that a retry after
+        # a timeout (when the homeserver got it after all) isnt sent twice
+        kwargs.setdefault('tx_id', str(uuid.uuid4()))
+
+        for attempt in range(self.max_retries + 1):
+            await self._global.acquire()
+            await bucket.acquire()
+
+            try:
+                resp = await self._send(room_id, *args, **kwargs)
+            except (aiohttp.client_exceptions.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    # the message is still in the outbox, and the
+                    # dispatcher tries again later
+                    raise
+                wait = self._backoff(attempt)
+                logger.warning(f"Sending to {room_id} failed, retrying in {wait:.1f}s: {e!r}")
+                self.retried += 1
+                await asyncio.sleep(wait)
+                continue
+
+            if not isinstance(resp, RoomSendError):
+                self.sent += 1
+                return resp
+
+            if resp.status_code == "M_LIMIT_EXCEEDED":
+                wait = (resp.retry_after_ms or 5000) / 1000
+                logger.warning(f"Rate limited in {room_id}, waiting {wait:.1f}s")
+                self.rate_limited += 1
+                # everything else would get rate limited too
+                self._global.pause(wait)
+            elif self.is_transient(resp):
+                wait = self._backoff(attempt)
+                logger.warning(f"Sending to {room_id} failed, retrying in {wait:.1f}s: {resp}")
+            else:
+                break
+
+            if attempt < self.max_retries:
+                self.retried += 1
+                await asyncio.sleep(wait)
+
+        self.dropped += 1
+        logger.error(f"Gave up sending to {room_id}: {resp}")
+        return resp
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+            'dropped': self.dropped,
+        }
+
 
 class MatrixClient:
 
@@ -38,7 +310,7 @@ class MatrixClient:
 
         return inner
 
-    def __init__(self, config, ctx):
+    def __init__(self, config, outbox):
         self.config = config
         self.homeserver = config.homeserver
         self.user_id = config.user_id
@@ -51,20 +323,37 @@ class MatrixClient:
             self._default_room = None
             logger.warning("Do rooms in config, 'default_room' not set")
 
-        self._context = ctx
-        self._socket = self._context.socket(zmq.PAIR)
-        self._socket.bind("inproc://webhook")
-        self._poller = zmq.asyncio.Poller()
-        self._poller.register(self._socket, zmq.POLLIN)
+        self.outbox = outbox
+        self._dispatcher = RoomDispatcher(
+            self._deliver,
+            max_workers=config.room_workers,
+            max_batch=config.webhook_coalesce_max_batch,
+            batch_window=config.webhook_coalesce_window
+        )
 
-        self.nio = AsyncClient(self.homeserver, self.user_id)
+        self._markdown = MarkdownRenderer()
+
+        # room_alias -> room_id, or None if the alias failed to resolve
+        self._alias_cache = TTLCache(maxsize=512, ttl=config.alias_cache_ttl)
+        self._first_sync_stats = {'ms': None, 'full_state': None, 'rooms': 0}
+        # filter id, or the filter itself if it couldn't be uploaded
+        self._sync_filter = None
+        self._poll = PollTimeout(config.sync_min_timeout, config.sync_timeout)
+
+        self.nio = InstrumentedClient(self.homeserver, self.user_id)
+        self._scheduler = SendScheduler.from_config(
+            self.nio.room_send, config.send_ratelimit)
+        self._trust = TrustManager(self.nio, enabled=config.autotrust)
+        self._commands = CommandRunner.from_config(self.send_msg, config.commands)
         self.cmd_handlers = dict()
         self.help_text = dict()
         self._callbacks()
         self._cmd_handlers()
 
-        self.notflix = Notflix(config.notflixbot)
-        self.youtube = Youtube(config.notflixbot)
+        self.upstream = Upstream.from_config(config.notflixbot)
+        self.notflix = Notflix.from_config(config, self.upstream)
+        self.youtube = Youtube(config.notflixbot, self.upstream)
+        self._phrases = PhraseMatcher.from_config(config.notflixbot)
 
     async def __aenter__(self):
         return self
@@ -73,10 +362,14 @@ class MatrixClient:
         await self.close()
 
     async def close(self):
+        await self._commands.close()
         if self.nio.logged_in:
             if self._default_room is not None:
                 await self.send_msg(self._default_room, f"{ERROR} Shutting down")
+        await self._dispatcher.close()
         await self.nio.close()
+        await self.notflix.close()
+        await self.upstream.close()
         logger.info("Closed nio client")
 
     async def restore_login(self):
@@ -113,8 +406,11 @@ class MatrixClient:
         """
         while True:
             try:
+                await self._upload_sync_filter()
+                while not await self._first_sync():
+                    await asyncio.sleep(5.0)
                 logger.info("Matrix client syncing forever")
-                return await self.nio.sync_forever(timeout=3000, full_state=True)
+                return await self._sync_loop()
             except (asyncio.exceptions.TimeoutError, aiohttp.client_exceptions.ClientOSError) as e:
                 logger.error(e)
                 logger.error("Timed out, reconnecting after 10s..")
@@ -128,59 +424,246 @@ class MatrixClient:
             # order is important here, _after_first_sync awaits for first sync
             # then the rest is executed
             self._after_first_sync(),
+            self.sync_forever()
+        )
 
-            asyncio.get_event_loop().create_task(
-                self.nio.sync_forever(timeout=3000, full_state=True)
-            ))
+    async def _upload_sync_filter(self):
+        """Registers the sync filter with the homeserver so sync requests
+        only need to send its id, falls back to sending all of it"""
+        if self._sync_filter is not None:
+            return
 
-    async def webhook_poller(self):
-        logger.info("Polling ZMQ socket for webhook messages")
+        f = sync_filter(self.nio.event_callbacks)
+        resp = await self.nio.upload_filter(
+            presence=f['presence'], account_data=f['account_data'], room=f['room'])
+        if isinstance(resp, UploadFilterError):
+            logger.warning(f"Could not upload sync filter, sending it with every sync: {resp}")
+            self._sync_filter = f
+        else:
+            logger.debug(f"Uploaded sync filter '{resp.filter_id}'")
+            self._sync_filter = resp.filter_id
+
+    async def _sync_keys(self, tasks):
+        """Like in nio's sync_forever, keys are uploaded, queried and
+        claimed alongside syncing"""
+        if self.nio.should_upload_keys:
+            tasks.append(asyncio.ensure_future(self.nio.keys_upload()))
+        if self.nio.should_query_keys:
+            tasks.append(asyncio.ensure_future(self.nio.keys_query()))
+        if self.nio.should_claim_keys:
+            tasks.append(asyncio.ensure_future(
+                self.nio.keys_claim(self.nio.get_users_for_key_claiming())))
+
+        for response in asyncio.as_completed(tasks):
+            await self.nio.run_response_callbacks([await response])
+
+    async def _sync_loop(self):
+        """nio's sync_forever, with a long-poll timeout that can change
+        between requests"""
         while True:
-            # keyboard interrupt?
-            events = await self._poller.poll(3000)
-            if self._socket in dict(events):
-                z_data = await self._socket.recv_string()
-                m_data = json.loads(z_data)
+            tasks = [
+                asyncio.ensure_future(self.nio.sync(
+                    timeout=self._poll.timeout, sync_filter=self._sync_filter)),
+                asyncio.ensure_future(self.nio.send_to_device_messages()),
+            ]
+            try:
+                await self._sync_keys(tasks)
+            except (asyncio.exceptions.TimeoutError, aiohttp.client_exceptions.ClientError):
+                self._poll.failed()
+                raise
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+            if isinstance(tasks[0].result(), SyncError):
+                self._poll.failed()
+            else:
+                self._poll.succeeded()
 
-                room = m_data['room']
-                msg = m_data['msg']
-                plain = m_data.get('plain')
-                logger.debug(f"{room}: '{msg}'")
+            self.nio.synced.set()
+            self.nio.synced.clear()
 
-                await self.send_msg(room, msg, plain)
+    async def _first_sync(self):
+        """Resumes from the sync token in the store, and only asks for the
+        full state of every room if there is no token (a new store) or the
+        homeserver doesnt accept it. Returns False if it failed.
+        """
+        started = time.monotonic()
+        since = self.nio.next_batch or self.nio.loaded_sync_token
+        full_state = since is None
+        if full_state:
+            logger.info("No stored sync token, doing a full state sync")
+
+        resp = await self.nio.sync(timeout=0, sync_filter=self._sync_filter, full_state=full_state)
+        if isinstance(resp, SyncError) and not full_state:
+            status = getattr(resp.transport_response, 'status', None)
+            if status is not None and status < 500:
+                logger.warning(f"Stored sync token was not accepted, doing a full state sync: {resp}")
+                self.nio.next_batch = None
+                self.nio.loaded_sync_token = None
+                full_state = True
+                resp = await self.nio.sync(timeout=0, sync_filter=self._sync_filter, full_state=True)
+
+        if isinstance(resp, SyncError):
+            logger.error(f"First sync failed: {resp}")
+            return False
+        await self.nio.run_response_callbacks([resp])
+
+        if not full_state:
+            await self._add_missing_rooms()
+        await self._sync_keys([])
+
+        elapsed = time.monotonic() - started
+        FIRST_SYNC_SECONDS.set(elapsed)
+        self._first_sync_stats = {
+            'ms': round(elapsed * 1000),
+            'full_state': full_state,
+            'rooms': len(self.nio.rooms),
+        }
+        kind = "full state" if full_state else "incremental"
+        logger.info(f"First sync took {elapsed * 1000:.0f}ms ({kind}, {len(self.nio.rooms)} rooms)")
+
+        self.nio.synced.set()
+        self.nio.synced.clear()
+        return True
+
+    async def _add_missing_rooms(self):
+        """An incremental sync only has the rooms that something happened in,
+        but nio needs to know about a room to send to it. Which rooms are
+        encrypted is kept in the store.
+        """
+        joined = await self.nio.joined_rooms()
+        if isinstance(joined, JoinedRoomsError):
+            logger.warning(f"Could not get joined rooms: {joined}")
+            return
+
+        for room_id in joined.rooms:
+            if room_id not in self.nio.rooms:
+                encrypted = room_id in self.nio.encrypted_rooms
+                self.nio.rooms[room_id] = MatrixRoom(room_id, self.nio.user_id, encrypted)
+
+    async def webhook_poller(self):
+        logger.info(f"Sending webhook messages from outbox ({len(self.outbox)} queued)")
+        while True:
+            item = await self.outbox.get()
+            # messages to the same room are sent in order, different
+            # rooms are sent in parallel
+            await self._dispatcher.submit(item.room, item)
+
+    async def _deliver(self, items):
+        room = items[0].room
+        if len(items) == 1:
+            msg = items[0].msg
+            plain = items[0].plain
+        else:
+            # a burst of messages to the same room, sent as one message
+            # with one line (or paragraph) per message
+            msg = "\n\n".join([i.msg for i in items])
+            plain = "\n".join([i.msg if i.plain is None else i.plain for i in items])
+            logger.debug(f"Coalesced {len(items)} messages to {room}")
+        logger.debug(f"{room}: '{msg}'")
+
+        # if this raises (f.ex. the homeserver is down) the messages
+        # are not acked, and the dispatcher tries again
+        resp = await self.send_msg(room, msg, plain)
+        if isinstance(resp, RoomSendError):
+            if SendScheduler.is_transient(resp):
+                # SendScheduler has already retried, the dispatcher tries
+                # again later
+                raise MatrixError(f"Sending to {room} failed: {resp}")
+            logger.error(f"Dropping {len(items)} message(s) to {room}: {resp}")
+        elif resp is None:
+            # the room couldnt be resolved, and it has been logged
+            logger.error(f"Dropping {len(items)} message(s) to {room}")
+        for item in items:
+            self.outbox.ack(item.id)
 
     async def _room_id(self, room_addr):
         if room_addr.startswith('!'):
             # this is a room_id
             return room_addr
 
+        cached = self._alias_cache.get(room_addr, _MISSING)
+        if cached is None:
+            raise MatrixError(f"Cannot resolve room: '{room_addr}' (cached)")
+        elif cached is not _MISSING:
+            return cached
+
         room = await self.nio.room_resolve_alias(room_addr)
         if isinstance(room, RoomResolveAliasError):
+            if room.status_code == "M_NOT_FOUND":
+                # negative cache, so a misconfigured webhook token doesnt
+                # ask the homeserver for the same alias on every request
+                self._alias_cache.set(
+                    room_addr, None, ttl=self.config.alias_cache_negative_ttl)
+            elif SendScheduler.is_transient(room):
+                # not cached, so the messages for it are sent later
+                raise MatrixUnavailableError(f"Cannot resolve room: '{room_addr}': {room}")
             raise MatrixError(f"Cannot resolve room: '{room_addr}'")
 
+        self._alias_cache.set(room_addr, room.room_id)
         return room.room_id
 
     async def _after_first_sync(self):
         # wait for sync
         await self.nio.synced.wait()
+        started = time.monotonic()
+
+        # in the background, so a slow radarr doesnt hold up the rest. !add
+        # waits for it if it isnt done yet
+        self.notflix.start_loading_library()
+
+        # rooms are warmed up concurrently, but not all at once
+        sem = asyncio.Semaphore(self.config.startup_concurrency)
+
+        async def bounded(coro):
+            async with sem:
+                return await coro
+
+        async def trust_rooms():
+            joined = await self.nio.joined_rooms()
+            if isinstance(joined, JoinedRoomsError):
+                logger.warning(f"Could not get joined rooms: {joined}")
+                return
+            await asyncio.gather(*[
+                bounded(self._trust_all_users_in_room(room_id)) for room_id in joined.rooms
+            ])
+
+        async def resolve_admin_rooms():
+            self.admin_room_ids = list(await asyncio.gather(*[
+                bounded(self._room_id(room_alias)) for room_alias in self.config.admin_rooms
+            ]))
+
+        async def resolve_phrase_room(room_alias):
+            try:
+                return (room_alias, await self._room_id(room_alias))
+            except (MatrixError, MatrixUnavailableError) as e:
+                logger.warning(f"Phrases for {room_alias} only work where it is the canonical alias: {e}")
+                return (room_alias, None)
 
-        joined = await self.nio.joined_rooms()
-        for room_id in joined.rooms:
-            await self._trust_all_users_in_room(room_id)
+        async def resolve_phrase_rooms():
+            resolved = await asyncio.gather(*[
+                bounded(resolve_phrase_room(room_alias)) for room_alias in self._phrases.aliases()
+            ])
+            self._phrases.resolve({a: room_id for a, room_id in resolved if room_id is not None})
 
-        for room_alias in self.config.admin_rooms:
-            admin_room_id = await self._room_id(room_alias)
-            self.admin_room_ids.append(admin_room_id)
+        async def avatar():
+            if self.config.avatar:
+                await self._avatar()
 
-        if self.config.avatar:
-            await self._avatar()
+        await asyncio.gather(
+            _timed_phase("trust room members", trust_rooms()),
+            _timed_phase("resolve admin rooms", resolve_admin_rooms()),
+            _timed_phase("resolve phrase rooms", resolve_phrase_rooms()),
+            _timed_phase("set avatar", avatar()),
+        )
 
         if self._default_room is not None:
             msg = f"{ROBOT} `{version_dict['name']} {version_dict['version']}`"
-            await self.send_msg(self._default_room, msg)
+            await _timed_phase("startup message", self.send_msg(self._default_room, msg))
 
-        await self._key_sync()
-        logger.debug("First sync is done.")
+        await _timed_phase("key sync", self._key_sync())
+        logger.info(f"Startup done {(time.monotonic() - started) * 1000:.0f}ms after the first sync")
 
     async def _set_creds(self):
         self.nio.user_id = self.config.creds.user_id
@@ -205,18 +688,23 @@ class MatrixClient:
 
     def _cmd_handlers(self):
         self.cmd_handlers['!add'] = self._handle_add
-        self.help_text["!add"] = "usage: `!add $IMDB_URL`"
+        self.help_text["!add"] = "usage: `!add $IMDB_URL [$IMDB_URL ...]`"
+        self.cmd_handlers['!have'] = self._handle_have
+        self.help_text["!have"] = "usage: `!have $TITLE`, search for a movie we have"
         self.cmd_handlers['!ruok'] = self._handle_ruok
         self.help_text['!ruok'] = "check if the bot is ok"
         self.cmd_handlers['!whoami'] = self._handle_whoami
         self.help_text['!whoami'] = "show your user id"
         self.cmd_handlers['!key_sync'] = self._key_sync
         self.help_text["!key_sync"] = "force a key sync"
+        self.cmd_handlers['!stats'] = self._handle_stats
+        self.help_text["!stats"] = "show internal counters"
         self.cmd_handlers['!help'] = self._handle_help
         self.help_text["!help"] = "this message"
         self.cmd_handlers['!crash'] = self._handle_crash
 
     def _callbacks(self):
+        self._trust.register()
         self.nio.add_event_callback(self._cb_invite_filtered, (InviteMemberEvent,))
         self.nio.add_event_callback(self._cb_message, (RoomMessageText,))
         self.nio.add_event_callback(self._cb_room_member, (RoomMemberEvent,))
@@ -268,17 +756,10 @@ class MatrixClient:
     async def _trust_all_users_in_room(self, room):
         room_id = await self._room_id(room)
         members = await self.nio.joined_members(room_id)
-        for u in members.members:
-            await self._trust_user_devices(u.user_id)
-
-    async def _trust_user_devices(self, user_id):
-        if user_id != self.config.user_id and self.config.autotrust:
-            for dev_id, olm_device in self.nio.device_store[user_id].items():
-                if olm_device.trust_state != TrustState.verified:
-                    self.nio.verify_device(olm_device)
-                    logger.info(f"Trusting {dev_id} from user {user_id}")
-                else:
-                    logger.debug(f"Already trust {dev_id} from user {user_id}")
+        if isinstance(members, JoinedMembersError):
+            logger.warning(f"Could not get members of {room_id}: {members}")
+            return
+        self._trust.add_users([u.user_id for u in members.members])
 
     async def _cb_decryption_fail(self, room: MatrixRoom, event: MegolmEvent) -> None:
         red_x_and_lock_emoji = "❌ 🔐"
@@ -292,6 +773,12 @@ class MatrixClient:
                 logger.debug("Room member event")
                 await self._trust_all_users_in_room(room.room_id)
 
+        elif event.content['membership'] in ["leave", "ban"]:
+            if event.state_key == self.nio.user_id:
+                # aliases pointing to a room we left are stale
+                n = self._alias_cache.invalidate_value(room.room_id)
+                logger.debug(f"Left {room.room_id}, dropped {n} cached aliases")
+
     async def _cb_invite(self, room: MatrixRoom, event: InviteMemberEvent) -> None:
         """When an invite is received, join the room specified in the invite
         """
@@ -343,9 +830,14 @@ class MatrixClient:
         if prefix in self.cmd_handlers:
             if room_id not in self.admin_room_ids:
                 logger.warning(f"Ignored cmd '{msg}' from '{user_id}' in '{room_alias}'")
+            elif prefix == "!crash":
+                # not caught by the CommandRunner, it is for testing how
+                # the bot handles crashing
+                await self.cmd_handlers[prefix](room, event)
             else:
                 handler_func = self.cmd_handlers[prefix]
-                await handler_func(room, event)
+                # in the background, so a slow command doesnt hold up the sync loop
+                self._commands.submit(room_id, user_id, prefix, partial(handler_func, room, event))
 
         elif "youtube.com" in msg or "youtu.be" in msg:
             yt_unfurl = await self.youtube.unfurl(msg)
@@ -357,20 +849,7 @@ class MatrixClient:
             await self._phrase_respond(room, event)
 
     async def _phrase_respond(self, room, event):
-        phrases = {
-            'are you alive?': 'no im a `robot`',
-            'are you alive': 'no im a `robot`',
-            'i am a robot': 'FILTHY LIES',
-            "i'm a robot": 'FILTHY LIES',
-            'im a robot': 'FILTHY LIES',
-            'fuck you': '🖕',
-            'duck you': '🦆',
-        }
-        # keywords = {
-        #     'cheese': 'did someone say 🧀?'
-        # }
-        msg = event.body.strip().lower()
-        response = phrases.get(msg, None)
+        response = self._phrases.match(event.body, room.room_id, room.canonical_alias)
         if response is not None:
             await self.send_msg(room.room_id, response)
 
@@ -380,6 +859,30 @@ class MatrixClient:
         v = version_dict['version']
         await self.send_msg(room.room_id, f"`{n} v{v}` help: \n\n{cmds}")
 
+    def stats(self):
+        return {
+            'alias_cache': self._alias_cache.stats(),
+            'youtube_cache': self.youtube.stats(),
+            'tmdb_cache': self.notflix.tvdb.stats(),
+            'radarr_library': self.notflix.library.stats(),
+            'titles': self.notflix.titles.stats(),
+            'markdown_cache': self._markdown.stats(),
+            'outbox': self.outbox.stats(),
+            'room_queues': self._dispatcher.depths(),
+            'sender': self._scheduler.stats(),
+            'first_sync': self._first_sync_stats,
+            'trust': self._trust.stats(),
+            'commands': self._commands.stats(),
+            'phrases': self._phrases.stats(),
+        }
+
+    async def _handle_stats(self, room, event):
+        lines = []
+        for name, counters in self.stats().items():
+            c = ", ".join([f"{k}: `{v}`" for k, v in counters.items()])
+            lines.append(f"- {name}: {c}")
+        await self.send_msg(room.room_id, "\n".join(lines))
+
     async def _handle_whoami(self, room, event):
         your_id = event.sender
         my_id = self.config.creds.user_id
@@ -393,33 +896,38 @@ class MatrixClient:
         return 1 / 0
 
     async def _handle_add(self, room, event):
-        try:
-            msg = event.body.strip().split(' ')
-            url = msg[1].strip()
-            try:
-                user = event.sender.split(":")[0][1:]
-            except IndexError as e:
-                logger.error(f"Error parsing user_id '{event.sender}': {e}")
-                user = "unknown"
-            added_status, item = self.notflix.add_from_imdb_url(url, user)
-            if added_status == "added":
-                await self.send_msg(room.room_id, f"Added: {item['title']} ({item['release_year']})")
-            elif added_status == "exists":
-                await self.send_msg(room.room_id, f"Already exists: {item['title']} ({item['release_year']})")
-            else:
-                try:
-                    errmsg = item[0]['errorMessage']
-                    await self.send_msg(room.room_id, errmsg)
-                except (IndexError, KeyError):
-                    pass
-
-            return item
-        except IndexError:
+        urls = event.body.strip().split()[1:]
+        if not urls:
             logger.error(f"Invalid msg from {event.sender}: '{event.body}'")
-            self.send_msg(room.room_id, "Url is missing")
+            await self.send_msg(room.room_id, "Url is missing")
+            return
+
+        try:
+            user = event.sender.split(":")[0][1:]
+        except IndexError as e:
+            logger.error(f"Error parsing user_id '{event.sender}': {e}")
+            user = "unknown"
+
+        try:
+            results = await self.notflix.add_many(urls, user)
         except (NotflixbotError, ImdbError) as e:
             logger.warning(e)
             await self.send_msg(room.room_id, str(e))
+            return
+
+        # one message, however many were added
+        await self.send_msg(room.room_id, format_add_results(results))
+        return results
+
+    async def _handle_have(self, room, event):
+        query = event.body.strip()[len("!have"):].strip()
+        if not query:
+            await self.send_msg(room.room_id, "usage: `!have $TITLE`")
+            return
+
+        matches = await self.notflix.have(query)
+        await self.send_msg(room.room_id, format_have_results(query, matches))
+        return matches
 
     async def send_msg(self, room, msg, plain=None):
         """Wrapper function to handle exceptions cleanly
@@ -428,9 +936,10 @@ class MatrixClient:
         try:
             return await self._send_msg(room, msg, plain)
         except OlmUnverifiedDeviceError as e:
+            # shouldnt happen since TrustManager trusts new devices before
+            # sending, unless autotrust is off
             logger.warning(e)
-            # self.nio.verify_device(e.devide)
-            await self._trust_user_devices(e.device.user_id)
+            self._trust.trust_user(e.device.user_id)
             return await self._send_msg(room, msg, plain)
 
     async def _send_msg(self, room, msg, plain=None):
@@ -449,28 +958,33 @@ class MatrixClient:
         plain = plain.replace('`', '')
 
         try:
-            room_id = await self._room_id(room)
+            with SEND_LATENCY.time(phase="resolve_alias"):
+                room_id = await self._room_id(room)
         except MatrixError as e:
             # webhook isnt aware of this
             logger.error(e)
             return
 
-        await self.nio.room_send(
+        with SEND_LATENCY.time(phase="trust"):
+            await self._trust.before_send(room_id)
+
+        resp = await self._scheduler.send(
             room_id,
             message_type="m.room.message",
             content={
                 'msgtype': 'm.text',
                 'format': 'org.matrix.custom.html',
-                'formatted_body': markdown(msg),
+                'formatted_body': self._markdown.render(msg),
                 'body': plain
             },
             ignore_unverified_devices=False
         )
 
         logger.debug(f"sent '{msg}' to '{room_id}'")
+        return resp
 
     async def react_to_event(self, room, event, reaction_text):
-        await self.nio.room_send(
+        await self._scheduler.send(
             room.room_id,
             message_type="m.reaction",
             content={
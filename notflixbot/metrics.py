@@ -0,0 +1,246 @@
+"""In-process metrics, rendered in the Prometheus text format on the
+`/metrics` route of the webhook server.
+
+These are plain counters in dicts, so they are cheap to update from hot
+paths. Each process has its own registry. Separate webhook processes
+send a `snapshot()` of theirs to the bot every few seconds, and the bot
+renders them together with its own, with a `worker` label.
+"""
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = [f'{k}="{_escape(v)}"' for k, v in zip(labelnames, labelvalues)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # tuple of label values -> value
+        self._values = dict()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} has labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[k] for k in self.labelnames)
+
+    def items(self):
+        return self._values.items()
+
+    def samples(self, items):
+        for key, value in items:
+            yield ("", key, None, value)
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.items()]
+
+    def render(self, workers=()):
+        """`workers` is a list of (worker, snapshot) from other processes"""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, key, extra, value in self.samples(self.items()):
+            labels = _format_labels(self.labelnames, key, extra)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        labelnames = self.labelnames + ("worker",)
+        for worker, snapshot in workers:
+            items = ((tuple(key) + (worker,), value) for key, value in snapshot)
+            for suffix, key, extra, value in self.samples(items):
+                labels = _format_labels(labelnames, key, extra)
+                lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = dict()
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, f, **labels):
+        """The value is read from `f()` when metrics are rendered"""
+        self._functions[self._key(labels)] = f
+
+    def get(self, **labels):
+        key = self._key(labels)
+        if key in self._functions:
+            return self._functions[key]()
+        return self._values.get(key, 0)
+
+    def items(self):
+        yield from self._values.items()
+        for key, f in self._functions.items():
+            yield (key, f())
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        try:
+            counts = self._values[key]
+        except KeyError:
+            # one count per bucket, then +Inf, sum
+            counts = [0] * (len(self.buckets) + 1) + [0.0]
+            self._values[key] = counts
+
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        if counts is None:
+            return 0
+        return sum(counts[:-1])
+
+    def samples(self, items):
+        for key, counts in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                yield ("_bucket", key, ("le", _format_value(float(bound))), cumulative)
+            yield ("_sum", key, None, counts[-1])
+            yield ("_count", key, None, cumulative)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = dict()
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        """The values of every metric, as json"""
+        return {name: m.snapshot() for name, m in self._metrics.items()}
+
+    def render(self, workers=None):
+        """`workers` maps the names of other processes to their
+        `snapshot()`"""
+        workers = sorted((workers or {}).items())
+        return "\n".join(
+            m.render([(w, snapshot.get(name, [])) for w, snapshot in workers])
+            for name, m in self._metrics.items()
+        ) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+WEBHOOK_REQUESTS = counter(
+    "notflixbot_webhook_requests_total",
+    "Webhook HTTP requests", ["route", "method", "status"])
+WEBHOOK_LATENCY = histogram(
+    "notflixbot_webhook_request_seconds",
+    "Webhook HTTP request latency", ["route", "status"])
+WEBHOOK_DEDUPED = counter(
+    "notflixbot_webhook_deduplicated_total",
+    "Webhook notifications that were suppressed as duplicates", ["source"])
+OUTBOX_DEPTH = gauge(
+    "notflixbot_outbox_depth",
+    "Messages in the outbox that haven't been sent to Matrix yet")
+ZMQ_SENT = counter(
+    "notflixbot_zmq_sent_total",
+    "Messages sent from a webhook process to the bot")
+ZMQ_RECEIVED = counter(
+    "notflixbot_zmq_received_total",
+    "Messages received by the bot from webhook processes")
+SEND_LATENCY = histogram(
+    "notflixbot_send_seconds",
+    "Time spent sending messages to Matrix, by phase", ["phase"])
+SYNC_LATENCY = histogram(
+    "notflixbot_sync_seconds",
+    "Duration of sync requests (including the long-poll)",
+    buckets=DEFAULT_BUCKETS + (30.0, 60.0))
+FIRST_SYNC_SECONDS = gauge(
+    "notflixbot_first_sync_seconds",
+    "How long the first sync took after the bot (re)connected")
+UPSTREAM_LATENCY = histogram(
+    "notflixbot_upstream_request_seconds",
+    "Latency of requests to Radarr, TheMovieDB and Invidious",
+    ["service", "status"])
+ACCESS_LOG_SECONDS = histogram(
+    "notflixbot_access_log_seconds",
+    "Time spent logging a webhook request in the access log",
+    buckets=(0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.001))
+LOG_QUEUE = gauge(
+    "notflixbot_log_queue",
+    "Log records waiting for the batch writer")
+LOG_DROPPED = counter(
+    "notflixbot_log_dropped_total",
+    "Log records dropped because the batch writer queue was full")
+LOG_BATCH_SECONDS = histogram(
+    "notflixbot_log_batch_seconds",
+    "Time spent by the batch writer formatting and writing a batch")
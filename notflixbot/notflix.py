@@ -1,68 +1,164 @@
-import json
+import asyncio
+import re
+import time
+from collections import namedtuple
 from urllib.parse import urljoin, urlparse
 
-import requests
+from aiohttp import ClientTimeout
 from loguru import logger
 
+from notflixbot.cache import SqliteCache
 from notflixbot.errors import ImdbError, NotflixbotError, TvdbError
+from notflixbot.library import Library, from_radarr
+from notflixbot.search import TitleIndex
+from notflixbot.upstream import Upstream, UpstreamError
+
+AddResult = namedtuple("AddResult", ["imdb_id", "status", "item", "error"])
+
+IMDB_ID = re.compile(r"^tt\d+$")
+
+# seconds to wait before trying to load the radarr library again
+LIBRARY_RETRY = 60.0
 
 
 class Radarr:
-    def __init__(self, base_url, api_key):
+    def __init__(self, base_url, api_key, upstream, quality_profile_id=4,
+                 root_folder="/deadspace/video/movies", library_timeout=60.0):
         self._api_key = api_key
         self._base_url = base_url
+        self._upstream = upstream
+        self.quality_profile_id = quality_profile_id
+        self.root_folder = root_folder
+        # the whole library is a lot bigger than other responses
+        self.library_timeout = library_timeout
 
-    def add(self, item, user="unknown"):
-        data = json.dumps({
+    def _movie(self, item, user):
+        return {
             'imdbId': item['imdb_id'],
             'TmdbId': item['tmdb_id'],
             'Title': item['title'],
-            'QualityProfileId': 4,   # HD 1080
+            'QualityProfileId': self.quality_profile_id,
             # 'Path': self.path,
-            'RootFolderPath': "/deadspace/video/movies",
+            'RootFolderPath': self.root_folder,
             'monitored': True,
             'addOptions': {'searchForMovie': True, 'tags': ['notflixbot', user]}
 
-        }, indent=2)
-        r = requests.post(
+        }
+
+    async def add(self, item, user="unknown"):
+        status, j = await self._upstream.post(
+            f"{self._base_url}/movie",
+            service="radarr",
+            json=self._movie(item, user),
+            params={'apikey': self._api_key},
+        )
+        logger.info(f"radarr responded: {status}")
+        return (status, j)
+
+    async def movies(self):
+        """Returns every movie in Radarr"""
+        status, j = await self._upstream.get(
             f"{self._base_url}/movie",
-            data=data,
+            service="radarr",
             params={'apikey': self._api_key},
-            headers={'Content-Type': 'application/json'}
+            timeout=ClientTimeout(total=self.library_timeout),
         )
-        j = r.json()
-        logger.info(f"radarr responded: {r.status_code}")
-        return (r.status_code, j)
+        if status != 200 or not isinstance(j, list):
+            raise UpstreamError(f"radarr responded {status} for the movie list")
+        return j
+
+    async def import_movies(self, items, user="unknown"):
+        """Adds several movies in one request. Radarr skips the ones it
+        can't add (f.ex. because it has them already) and responds with
+        the ones that were added."""
+        status, j = await self._upstream.post(
+            f"{self._base_url}/movie/import",
+            service="radarr",
+            json=[self._movie(item, user) for item in items],
+            params={'apikey': self._api_key},
+        )
+        logger.info(f"radarr responded: {status} for import of {len(items)} movies")
+        return (status, j)
 
 
 class TheMovieDB:
-    def __init__(self, api_key):
+    def __init__(self, api_key, upstream, cache=None, negative_ttl=86400):
         self._api_key = api_key
+        self._upstream = upstream
+        # imdb_id -> parsed result, or None if there were no results
+        self._cache = cache
+        self.negative_ttl = negative_ttl
+        # imdb_id -> task refreshing a stale cache entry
+        self._revalidating = dict()
 
         self.poster_base_url = "https://www.themoviedb.org/t/p/w1280"
         self.api_base_url = "https://api.themoviedb.org/3/"
 
     # https://developers.themoviedb.org/3/find/find-by-id
-    def search_imdb_id(self, imdb_id):
+    async def search_imdb_id(self, imdb_id):
+        if self._cache is not None:
+            cached = self._cache.get(imdb_id)
+            if cached is not None:
+                info, fresh = cached
+                if not fresh:
+                    self._revalidate(imdb_id)
+                return self._found(info, imdb_id)
+
+        return self._found(await self._fetch(imdb_id), imdb_id)
+
+    def _found(self, info, imdb_id):
+        if info is None:
+            err = f"no results in tv or movies for '{imdb_id}'"
+            logger.error(err)
+            raise TvdbError(err)
+        return info
+
+    async def _fetch(self, imdb_id):
         url = urljoin(self.api_base_url, f"find/{imdb_id}")
         params = {
             'api_key': self._api_key,
             # 'language': 'en-US',
             'external_source': 'imdb_id'
         }
-        r = requests.get(url, params=params)
-        r.raise_for_status()
-        j = r.json()
-
-        logger.debug(json.dumps(j, indent=2))
+        status, j = await self._upstream.get(url, service="tmdb", params=params)
+        if status != 200:
+            raise TvdbError(f"themoviedb responded {status} for '{imdb_id}'")
 
         info = self.parse_tvdb(j, imdb_id)
-        if info is None:
-            err = f"no results in tv or movies for '{imdb_id}'"
-            logger.error(err)
-            raise TvdbError(err)
+        if self._cache is not None:
+            if info is None:
+                self._cache.set(imdb_id, None, ttl=self.negative_ttl)
+            else:
+                self._cache.set(imdb_id, info)
         return info
 
+    def _revalidate(self, imdb_id):
+        """Refreshes a stale entry in the background, the stale one is
+        used in the meantime"""
+        if imdb_id in self._revalidating:
+            return
+        task = asyncio.ensure_future(self._fetch(imdb_id))
+        self._revalidating[imdb_id] = task
+        task.add_done_callback(lambda t: self._revalidated(imdb_id, t))
+
+    def _revalidated(self, imdb_id, task):
+        del self._revalidating[imdb_id]
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Could not refresh '{imdb_id}': {task.exception()!r}")
+
+    def stats(self):
+        if self._cache is None:
+            return {}
+        return self._cache.stats()
+
+    async def close(self):
+        tasks = list(self._revalidating.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._cache is not None:
+            self._cache.close()
+
     def parse_tvdb(self, j, imdb_id):
         if j['movie_results']:
             if len(j['movie_results']) > 1:
@@ -91,11 +187,43 @@ class TheMovieDB:
 
 class Notflix:
 
-    def __init__(self, config_dict):
+    def __init__(self, config_dict, upstream=None, cache=None, negative_ttl=86400):
+        """`cache` is an optional SqliteCache for TheMovieDB lookups"""
         self.config_dict = config_dict
-        self.tvdb = TheMovieDB(config_dict['themoviedb_api_key'])
-        self.radarr = Radarr(config_dict['radarr_url'],
-                             config_dict['radarr_api_key'])
+        # a shared upstream is closed by whoever created it
+        self._owns_upstream = upstream is None
+        if upstream is None:
+            upstream = Upstream.from_config(config_dict)
+        self.upstream = upstream
+        self.tvdb = TheMovieDB(config_dict['themoviedb_api_key'], upstream, cache, negative_ttl)
+        self.radarr = Radarr(
+            config_dict['radarr_url'],
+            config_dict['radarr_api_key'],
+            upstream,
+            quality_profile_id=int(config_dict.get('radarr_quality_profile_id', 4)),
+            root_folder=config_dict.get('radarr_root_folder', "/deadspace/video/movies"),
+            library_timeout=float(config_dict.get('radarr_library_timeout', 60.0)),
+        )
+        # the titles of the movies in radarr and jellyfin, for !have
+        self.titles = TitleIndex()
+        # the movies in radarr, so !add doesnt have to ask
+        self.library = Library(
+            ttl=float(config_dict.get('radarr_library_ttl', 3600.0)), titles=self.titles)
+        self._library_task = None
+        self._library_failed_at = None
+        # concurrent TheMovieDB lookups for a bulk add
+        self.lookup_concurrency = int(config_dict.get('tmdb_concurrency', 4))
+        self.add_max_items = int(config_dict.get('add_max_items', 50))
+
+    @classmethod
+    def from_config(cls, config, upstream=None):
+        cache = SqliteCache(
+            config.tmdb_cache_path,
+            maxsize=config.tmdb_cache_maxsize,
+            ttl=config.tmdb_cache_ttl,
+            stale_ttl=config.tmdb_cache_stale_ttl
+        )
+        return cls(config.notflixbot, upstream, cache, config.tmdb_cache_negative_ttl)
 
     def get_imdb_id_from_url(self, url):
         parsed_url = urlparse(url)
@@ -108,24 +236,207 @@ class Notflix:
         else:
             raise ImdbError("not an imdb url")
 
-    def add_from_imdb_url(self, imdb_url, user="unknown"):
+    def get_imdb_id(self, url_or_id):
+        if IMDB_ID.match(url_or_id):
+            return url_or_id
+        return self.get_imdb_id_from_url(url_or_id)
+
+    async def load_library(self):
+        """Loads the library from Radarr, concurrent calls share the same
+        request. Returns False if it failed, then the old one is kept."""
+        return await asyncio.shield(self.start_loading_library())
+
+    def start_loading_library(self):
+        """Starts loading the library in the background, returns the task"""
+        if self._library_task is None:
+            self._library_task = asyncio.ensure_future(self._load_library())
+            self._library_task.add_done_callback(self._library_loaded)
+        return self._library_task
+
+    def _library_loaded(self, task):
+        self._library_task = None
+
+    async def _load_library(self):
+        try:
+            movies = await self.radarr.movies()
+        except UpstreamError as e:
+            logger.warning(f"Could not load the radarr library: {e}")
+            self._library_failed_at = time.monotonic()
+            return False
+        self.library.replace(movies)
+        self._library_failed_at = None
+        return True
+
+    async def _refresh_library(self):
+        """Loads the library if it never has been, and reloads it in the
+        background when it is stale (the stale one is used meanwhile)"""
+        failed = self._library_failed_at
+        if failed is not None and time.monotonic() - failed < LIBRARY_RETRY:
+            return
+        if not self.library.loaded:
+            await self.load_library()
+        elif self.library.is_stale():
+            self.start_loading_library()
+
+    def radarr_event(self, event_type, movie):
+        """Keeps the library up to date from a Radarr webhook"""
+        if event_type in ("grab", "download", "movieadded"):
+            self.library.add(movie)
+        elif event_type == "moviedelete":
+            item = from_radarr(movie)
+            if item is not None:
+                self.library.remove(item['tmdb_id'])
+
+    def jellyfin_item_added(self, title, year):
+        """A movie was added to Jellyfin"""
+        self.titles.add(title, year, "jellyfin")
+
+    async def have(self, query, limit=5):
+        """Searches for movies in Radarr or Jellyfin by title, returns a
+        list of `search.Match`"""
+        await self._refresh_library()
+        return self.titles.search(query, limit)
+
+    async def add_many(self, urls, user="unknown"):
+        """Adds all of `urls` (imdb urls or ids), returns an `AddResult`
+        for each of them in the same order. The lookups on TheMovieDB run
+        concurrently, and the movies are added to Radarr in one request.
+        """
+        if len(urls) > self.add_max_items:
+            raise NotflixbotError(f"can only add {self.add_max_items} at a time")
+
+        # imdb_id -> AddResult, for the ones that are done
+        results = dict()
+        # imdb_id (or the url, if it isnt one), in the order they were given
+        keys = list()
+        for url in urls:
+            try:
+                imdb_id = self.get_imdb_id(url.strip())
+            except (ImdbError, IndexError):
+                results[url] = AddResult(url, "error", None, "not an imdb url")
+                keys.append(url)
+                continue
+            keys.append(imdb_id)
+        keys = list(dict.fromkeys(keys))
+
+        # the ones that are in radarr already dont need to be looked up
+        await self._refresh_library()
+        for k in keys:
+            if k not in results:
+                item = self.library.get(imdb_id=k)
+                if item is not None:
+                    results[k] = AddResult(k, "exists", item, None)
+        imdb_ids = [k for k in keys if k not in results]
+
+        sem = asyncio.Semaphore(self.lookup_concurrency)
+
+        async def lookup(imdb_id):
+            async with sem:
+                try:
+                    item = await self.tvdb.search_imdb_id(imdb_id)
+                except (TvdbError, UpstreamError, NotImplementedError) as e:
+                    results[imdb_id] = AddResult(imdb_id, "error", None, str(e))
+                    return None
+            # radarr didnt have an imdb id for it
+            if self.library.get(tmdb_id=item['tmdb_id']) is not None:
+                results[imdb_id] = AddResult(imdb_id, "exists", item, None)
+                return None
+            return item
+
+        items = [i for i in await asyncio.gather(*[lookup(i) for i in imdb_ids]) if i is not None]
+        if len(items) == 1:
+            added = await self._add_one_by_one(items, user)
+        elif len(items) > 1:
+            added = await self._import(items, user)
+        else:
+            added = dict()
+
+        for r in added.values():
+            if r.status in ("added", "exists"):
+                self.library.add_item(r.item)
+        results.update(added)
+
+        return [results[k] for k in keys]
+
+    async def _import(self, items, user):
         try:
-            imdb_id = self.get_imdb_id_from_url(imdb_url)
-            item = self.tvdb.search_imdb_id(imdb_id)
-            status, response = self.radarr.add(item, user)
+            status, j = await self.radarr.import_movies(items, user)
+        except UpstreamError as e:
+            logger.warning(f"radarr import failed: {e}")
+            status, j = None, None
+
+        if status in (200, 201, 202) and isinstance(j, list):
+            added = {m.get('tmdbId') for m in j if isinstance(m, dict)}
+            # radarr doesnt say why it left a movie out, so it cant be
+            # told apart from one that failed
+            return {
+                i['imdb_id']: AddResult(i['imdb_id'], "added", i, None)
+                if i['tmdb_id'] in added else
+                AddResult(i['imdb_id'], "error", i, "not added by radarr, it might exist already")
+                for i in items
+            }
+
+        logger.warning(f"radarr import responded {status}, adding one at a time")
+        return await self._add_one_by_one(items, user)
+
+    async def _add_one_by_one(self, items, user):
+        sem = asyncio.Semaphore(self.lookup_concurrency)
+
+        async def add(item):
+            async with sem:
+                try:
+                    status, j = await self.radarr.add(item, user)
+                except UpstreamError as e:
+                    return AddResult(item['imdb_id'], "error", item, str(e))
             if status == 201:
-                status = "added"
+                return AddResult(item['imdb_id'], "added", item, None)
             elif status == 400:
-                status = "exists"
-            else:
-                status = "error"
-            return (status, item)
-
-            # msg = f"{item['title']} ({item['release_year']})"
-            # msg += " | [poster]({item['poster']})"
-            # return {
-            #     'msg': msg,
-            #     'item': item
-            # }
-        except (ImdbError, TvdbError, NotImplementedError) as e:
-            raise NotflixbotError(e) from e
+                return AddResult(item['imdb_id'], "exists", item, None)
+            try:
+                error = j[0]['errorMessage']
+            except (IndexError, KeyError, TypeError):
+                error = f"radarr responded {status}"
+            return AddResult(item['imdb_id'], "error", item, error)
+
+        return {r.imdb_id: r for r in await asyncio.gather(*[add(i) for i in items])}
+
+    async def close(self):
+        if self._library_task is not None:
+            self._library_task.cancel()
+            await asyncio.gather(self._library_task, return_exceptions=True)
+        await self.tvdb.close()
+        if self._owns_upstream:
+            await self.upstream.close()
+
+
+def format_add_results(results):
+    """One message for the results of `Notflix.add_many`"""
+    lines = list()
+    for r in results:
+        if r.item is not None:
+            name = f"{r.item['title']} ({r.item['release_year']})"
+        else:
+            name = f"`{r.imdb_id}`"
+        if r.status == "added":
+            lines.append(f"Added: {name}")
+        elif r.status == "exists":
+            lines.append(f"Already exists: {name}")
+        else:
+            lines.append(f"Failed: {name}: {r.error}")
+
+    if len(lines) == 1:
+        return lines[0]
+
+    counts = [
+        f"{sum(r.status == status for r in results)} {text}"
+        for status, text in [("added", "added"), ("exists", "already existed"), ("error", "failed")]
+    ]
+    return ", ".join(counts) + "\n\n" + "\n".join([f"- {line}" for line in lines])
+
+
+def format_have_results(query, matches):
+    """One message for the results of `Notflix.have`"""
+    if not matches:
+        return f"Nothing like '{query}'"
+    lines = [f"- {m.title} ({m.year})" if m.year else f"- {m.title}" for m in matches]
+    return "\n".join(lines)
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import sqlite3
+from collections import namedtuple
+
+from loguru import logger
+
+from notflixbot.metrics import OUTBOX_DEPTH
+
+OutboxItem = namedtuple("OutboxItem", ["id", "room", "msg", "plain"])
+
+
+class Outbox:
+    """Persistent queue of outgoing messages between Webhook and
+    MatrixClient, stored in SQLite under `storage_path`.
+
+    Messages are removed with `ack()` once they have been sent to Matrix,
+    anything that is still in the outbox when the bot starts is sent
+    again. Commits are batched: `put()` returns once the commit that
+    includes the message has been written to disk, which happens after
+    `flush_interval` seconds or `flush_batch` messages, whichever is
+    first.
+    """
+
+    def __init__(self, path, maxsize=10000, flush_interval=0.05,
+                 flush_batch=64):
+        self.path = path
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "  room TEXT NOT NULL,"
+            "  msg TEXT NOT NULL,"
+            "  plain TEXT"
+            ")"
+        )
+        self._db.commit()
+
+        self._size = self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        # highest id handed out by get(), starts from 0 so that
+        # messages that weren't acked before a restart are replayed
+        self._cursor = 0
+        self._wakeup = asyncio.Event()
+
+        self._unflushed = 0
+        self._flushed = None
+        self._flush_handle = None
+
+        self.dropped = 0
+        OUTBOX_DEPTH.set_function(self.__len__)
+        if self._size > 0:
+            logger.info(f"Outbox has {self._size} unsent messages from before")
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.outbox_path,
+            maxsize=config.outbox_maxsize,
+            flush_interval=config.outbox_flush_interval
+        )
+
+    def __len__(self):
+        return self._size
+
+    def _schedule_flush(self):
+        if self._flushed is None:
+            loop = asyncio.get_running_loop()
+            self._flushed = loop.create_future()
+            self._flush_handle = loop.call_later(
+                self.flush_interval, self._flush)
+
+        if self._unflushed >= self.flush_batch:
+            self._flush()
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        flushed = self._flushed
+        self._flushed = None
+        self._flush_handle = None
+        self._unflushed = 0
+
+        try:
+            self._db.commit()
+        except sqlite3.Error as e:
+            if flushed is not None and not flushed.done():
+                flushed.set_exception(e)
+            raise
+        if flushed is not None and not flushed.done():
+            flushed.set_result(True)
+
+    def _drop_oldest(self):
+        row = self._db.execute("SELECT MIN(id) FROM outbox").fetchone()
+        if row[0] is not None:
+            self._db.execute("DELETE FROM outbox WHERE id = ?", (row[0],))
+            self._size -= 1
+            self.dropped += 1
+            logger.warning(f"Outbox is full ({self.maxsize}), dropped oldest message")
+
+    def _insert(self, room, msg, plain):
+        if self._size >= self.maxsize:
+            self._drop_oldest()
+
+        cur = self._db.execute(
+            "INSERT INTO outbox (room, msg, plain) VALUES (?, ?, ?)",
+            (room, msg, plain)
+        )
+        self._size += 1
+        self._unflushed += 1
+        return cur.lastrowid
+
+    async def put(self, room, msg, plain=None):
+        rowid = self._insert(room, msg, plain)
+        self._wakeup.set()
+
+        self._schedule_flush()
+        if self._flushed is not None:
+            await asyncio.shield(self._flushed)
+        return rowid
+
+    async def put_many(self, messages):
+        """Writes a list of (room, msg, plain) in one commit, right away
+        rather than waiting for `flush_interval`, since the whole batch is
+        already here. Returns their ids."""
+        rowids = [self._insert(room, msg, plain) for room, msg, plain in messages]
+        if rowids:
+            self._wakeup.set()
+            self._flush()
+        return rowids
+
+    async def get(self):
+        """Waits for and returns the next message that hasn't been handed
+        out yet. It stays in the outbox until it is acked.
+        """
+        while True:
+            row = self._db.execute(
+                "SELECT id, room, msg, plain FROM outbox"
+                " WHERE id > ? ORDER BY id LIMIT 1",
+                (self._cursor,)
+            ).fetchone()
+            if row is not None:
+                self._cursor = row[0]
+                return OutboxItem(*row)
+
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def ack(self, item_id):
+        cur = self._db.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+        self._size -= cur.rowcount
+        self._unflushed += 1
+        # an ack that gets lost in a crash only means a duplicate message
+        # later, so this doesn't wait for the commit
+        self._schedule_flush()
+
+    def close(self):
+        if self._flushed is not None or self._unflushed > 0:
+            self._flush()
+        self._db.close()
+        logger.debug(f"Closed outbox '{self.path}'")
+
+    def stats(self):
+        return {
+            'depth': self._size,
+            'maxsize': self.maxsize,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,153 @@
+import re
+import time
+from collections import namedtuple
+
+from loguru import logger
+
+from notflixbot.errors import ConfigError
+
+Phrase = namedtuple("Phrase", ["trigger", "response", "match", "rooms", "cooldown"])
+
+MATCH_KINDS = ("exact", "prefix", "substring")
+
+DEFAULT_PHRASES = [
+    {'trigger': "are you alive?", 'response': "no im a `robot`"},
+    {'trigger': "are you alive", 'response': "no im a `robot`"},
+    {'trigger': "i am a robot", 'response': "FILTHY LIES"},
+    {'trigger': "i'm a robot", 'response': "FILTHY LIES"},
+    {'trigger': "im a robot", 'response': "FILTHY LIES"},
+    {'trigger': "fuck you", 'response': "🖕"},
+    {'trigger': "duck you", 'response': "🦆"},
+]
+
+
+def _parse(p):
+    try:
+        match = p.get('match', "exact")
+        if match not in MATCH_KINDS:
+            raise ConfigError(f"phrase '{p['trigger']}': match must be one of {MATCH_KINDS}, not '{match}'")
+        rooms = p.get('rooms')
+        return Phrase(
+            trigger=p['trigger'].strip().lower(),
+            response=p['response'],
+            match=match,
+            rooms=None if rooms is None else frozenset(rooms),
+            cooldown=float(p.get('cooldown', 0.0)),
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise ConfigError(f"invalid phrase {p}: {e!r}") from e
+
+
+def _alternation(triggers):
+    # longest first, so that the longest trigger wins where several match
+    return "|".join(re.escape(t) for t in sorted(triggers, key=len, reverse=True))
+
+
+class PhraseMatcher:
+    """Responds to phrases and keywords in messages.
+
+    Triggers match the whole message (`exact`), the start of it (`prefix`)
+    or anywhere in it (`substring`), ignoring case. All triggers that are
+    enabled in a room are compiled into one regex, so a message is
+    matched in one pass however many triggers there are. A trigger with
+    `rooms` is only enabled in those rooms (aliases or room ids), and with
+    a `cooldown` it responds at most once per that many seconds per room.
+
+    The aliases in `rooms` are resolved to room ids with `resolve()`,
+    since a room doesn't always know its alias (f.ex. the rooms that nio
+    only knows from `joined_rooms` after an incremental sync).
+    """
+
+    def __init__(self, phrases=None, clock=time.monotonic):
+        if phrases is None:
+            phrases = DEFAULT_PHRASES
+        self.phrases = [_parse(p) for p in phrases]
+        self._clock = clock
+
+        # (match, trigger) -> Phrase, the later one wins for duplicates
+        self._lookup = {(p.match, p.trigger): p for p in self.phrases}
+        # (room_id, room_alias) -> compiled regex, or None if no phrases
+        # are enabled in that room
+        self._compiled = dict()
+        # (trigger, room_id) -> last time it was responded to
+        self._last = dict()
+
+        self.matched = 0
+        self.cooling_down = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('phrases'))
+
+    def aliases(self):
+        """The room aliases in the `rooms` of the phrases"""
+        return {
+            room for p in self.phrases if p.rooms is not None
+            for room in p.rooms if room.startswith("#")
+        }
+
+    def resolve(self, room_ids):
+        """Enables the phrases with aliases in `rooms` in the rooms that
+        the aliases point to, `room_ids` maps aliases to room ids"""
+        def add_ids(p):
+            if p.rooms is None:
+                return p
+            return p._replace(rooms=p.rooms | {room_ids[r] for r in p.rooms if r in room_ids})
+
+        self.phrases = [add_ids(p) for p in self.phrases]
+        self._lookup = {k: add_ids(p) for k, p in self._lookup.items()}
+        self._compiled.clear()
+
+    def _compile(self, rooms):
+        enabled = [p for p in self._lookup.values() if p.rooms is None or p.rooms & rooms]
+        branches = []
+        for kind, fmt in [
+                ("exact", r"\A(?P<exact>{})\Z"),
+                ("prefix", r"\A(?P<prefix>{})"),
+                ("substring", r"(?P<substring>{})")]:
+            triggers = [p.trigger for p in enabled if p.match == kind]
+            if triggers:
+                branches.append(fmt.format(_alternation(triggers)))
+
+        if not branches:
+            return None
+        return re.compile("|".join(branches))
+
+    def _regex(self, room_id, room_alias):
+        key = (room_id, room_alias)
+        try:
+            return self._compiled[key]
+        except KeyError:
+            rooms = frozenset([room_id, room_alias])
+            regex = self._compiled[key] = self._compile(rooms)
+            return regex
+
+    def match(self, msg, room_id, room_alias=None):
+        """Returns the response to `msg`, or None"""
+        regex = self._regex(room_id, room_alias)
+        if regex is None:
+            return None
+
+        m = regex.search(msg.strip().lower())
+        if m is None:
+            return None
+
+        phrase = self._lookup[(m.lastgroup, m.group(m.lastgroup))]
+        if phrase.cooldown > 0:
+            now = self._clock()
+            last = self._last.get((phrase.trigger, room_id))
+            if last is not None and now - last < phrase.cooldown:
+                self.cooling_down += 1
+                logger.debug(f"'{phrase.trigger}' is cooling down in {room_id}")
+                return None
+            self._last[(phrase.trigger, room_id)] = now
+
+        self.matched += 1
+        return phrase.response
+
+    def stats(self):
+        return {
+            'phrases': len(self.phrases),
+            'matched': self.matched,
+            'cooling_down': self.cooling_down,
+        }
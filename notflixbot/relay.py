@@ -0,0 +1,138 @@
+import asyncio
+import time
+
+import zmq
+import zmq.asyncio
+from loguru import logger
+
+from notflixbot import codec
+from notflixbot.errors import RelayError
+from notflixbot.metrics import REGISTRY, ZMQ_RECEIVED, ZMQ_SENT
+
+
+class ZmqSink:
+    """Used by Webhook in place of the Outbox when the webhook server runs
+    in separate processes (`notflixbot webhook`), pushes messages to the
+    bot process over a ZMQ PUSH socket.
+
+    If the bot is down, ZMQ queues up to `hwm` messages and delivers them
+    when it comes back. When that queue is full, `put()` gives up after
+    `send_timeout` seconds.
+    """
+
+    def __init__(self, ctx, addr, hwm=1000, send_timeout=5.0):
+        self.addr = addr
+        self.send_timeout = send_timeout
+        self._socket = ctx.socket(zmq.PUSH)
+        self._socket.setsockopt(zmq.SNDHWM, hwm)
+        # try to deliver queued messages on shutdown, but not forever
+        self._socket.setsockopt(zmq.LINGER, 5000)
+        self._socket.connect(addr)
+
+        self.sent = 0
+
+    async def put(self, room, msg, plain=None):
+        events = await self._socket.poll(int(self.send_timeout * 1000), zmq.POLLOUT)
+        if not events & zmq.POLLOUT:
+            raise RelayError(f"timed out sending to '{self.addr}', is the bot running?")
+
+        await self._socket.send_multipart(codec.pack(room, msg, plain))
+        self.sent += 1
+        ZMQ_SENT.inc()
+
+    async def push_metrics(self, worker, interval=10.0):
+        """Sends a snapshot of this process' metrics to the bot every
+        `interval` seconds, so that the bot can serve them. A snapshot
+        is skipped rather than queued when the bot isn't there."""
+        while True:
+            try:
+                await self._socket.send_multipart(
+                    codec.pack_metrics(worker, REGISTRY.snapshot()), zmq.NOBLOCK)
+            except zmq.Again:
+                pass
+            await asyncio.sleep(interval)
+
+    def close(self):
+        self._socket.close()
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+        }
+
+
+class ZmqSource:
+    """Receives messages from webhook frontend processes on a ZMQ PULL
+    socket and writes them to the outbox.
+
+    Every message that has arrived (up to `max_batch`) is written to the
+    outbox in one commit, instead of waiting for a commit per message.
+
+    The metrics snapshots from the webhook processes are kept, the latest
+    one from each, until a process hasn't sent one for `metrics_ttl`
+    seconds.
+    """
+
+    def __init__(self, ctx, addr, outbox, max_batch=256, metrics_ttl=60.0):
+        self.addr = addr
+        self.max_batch = max_batch
+        self.metrics_ttl = metrics_ttl
+        # worker -> (received at, snapshot)
+        self._metrics = dict()
+        self._outbox = outbox
+        self._socket = ctx.socket(zmq.PULL)
+        self._socket.bind(addr)
+
+        self.received = 0
+        self.batches = 0
+
+    async def _recv_batch(self):
+        batch = [await self._socket.recv_multipart(copy=False)]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(await self._socket.recv_multipart(zmq.NOBLOCK, copy=False))
+            except zmq.Again:
+                break
+        return batch
+
+    async def run(self):
+        logger.info(f"Receiving webhook messages on: {self.addr}")
+        while True:
+            messages = list()
+            for frames in await self._recv_batch():
+                frames = [f.buffer for f in frames]
+                try:
+                    if codec.is_metrics(frames):
+                        worker, snapshot = codec.unpack_metrics(frames)
+                        self._metrics[worker] = (time.monotonic(), snapshot)
+                    else:
+                        messages.append(codec.unpack(frames))
+                except ValueError as e:
+                    logger.error(f"Invalid message from webhook frontend: {e!r}")
+
+            if not messages:
+                continue
+
+            await self._outbox.put_many(messages)
+            self.received += len(messages)
+            self.batches += 1
+            ZMQ_RECEIVED.inc(len(messages))
+
+    def metrics(self):
+        """The latest metrics snapshot from every webhook process, for
+        `Registry.render`"""
+        now = time.monotonic()
+        return {
+            worker: snapshot
+            for worker, (received_at, snapshot) in self._metrics.items()
+            if now - received_at <= self.metrics_ttl
+        }
+
+    def close(self):
+        self._socket.close()
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'batches': self.batches,
+        }
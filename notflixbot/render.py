@@ -0,0 +1,27 @@
+from markdown import Markdown
+
+from notflixbot.cache import TTLCache
+
+
+class MarkdownRenderer:
+    """Renders markdown to html with one long-lived `Markdown` instance
+    (instead of loading extensions and compiling regexes for every
+    message), and keeps the most recently rendered messages in an LRU
+    cache, since a lot of messages are sent over and over again.
+    """
+
+    def __init__(self, cache_size=512, max_cached_len=4096):
+        self._md = Markdown()
+        self._cache = TTLCache(maxsize=cache_size)
+        self.max_cached_len = max_cached_len
+
+    def render(self, msg):
+        html = self._cache.get(msg)
+        if html is None:
+            html = self._md.reset().convert(msg)
+            if len(msg) <= self.max_cached_len:
+                self._cache.set(msg, html)
+        return html
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,169 @@
+import math
+import re
+import unicodedata
+from collections import Counter, namedtuple
+from itertools import chain, islice
+
+Match = namedtuple("Match", ["title", "year", "score", "sources"])
+
+_NOT_ALNUM = re.compile(r"[^a-z0-9]+")
+
+
+def normalize(title):
+    """Lowercase, without accents and punctuation"""
+    decomposed = unicodedata.normalize("NFKD", title)
+    ascii_title = decomposed.encode("ascii", "ignore").decode()
+    return _NOT_ALNUM.sub(" ", ascii_title.lower()).strip()
+
+
+def trigrams(normalized):
+    """The trigrams of each word, padded so that short words and the
+    start of words count for something"""
+    grams = set()
+    for word in normalized.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class _Title:
+    __slots__ = ("title", "year", "normalized", "grams", "sources")
+
+    def __init__(self, title, year, normalized, grams):
+        self.title = title
+        self.year = year
+        self.normalized = normalized
+        self.grams = grams
+        self.sources = set()
+
+
+class TitleIndex:
+    """Fuzzy search over movie titles with a trigram index.
+
+    Every title is split into trigrams, and each trigram maps to the
+    titles that have it. A query is scored against the titles that share
+    its rarest trigrams (so that "the" doesn't make every title a
+    candidate), and only the ones with the most trigrams in common are
+    scored, by the share of trigrams they have in common. Titles are
+    added and removed one at a time, by `source` ("radarr", "jellyfin"),
+    and a title is kept until every source that added it removed it.
+    """
+
+    def __init__(self, min_score=0.3, max_candidates_share=0.05, max_candidates=100):
+        self.min_score = min_score
+        # trigrams in more than this share of all titles are only used for
+        # finding candidates if the query has nothing rarer
+        self.max_candidates_share = max_candidates_share
+        # only the titles with the most trigrams in common are scored
+        self.max_candidates = max_candidates
+
+        # (normalized, year) -> id
+        self._ids = dict()
+        # id -> _Title
+        self._titles = dict()
+        # trigram -> set of ids
+        self._postings = dict()
+        self._next_id = 0
+
+        self.searches = 0
+
+    def __len__(self):
+        return len(self._titles)
+
+    def add(self, title, year, source):
+        normalized = normalize(title)
+        if not normalized:
+            return
+        year = str(year or "")
+        key = (normalized, year)
+        title_id = self._ids.get(key)
+        if title_id is None:
+            title_id = self._next_id
+            self._next_id += 1
+            self._ids[key] = title_id
+            t = self._titles[title_id] = _Title(title, year, normalized, trigrams(normalized))
+            for gram in t.grams:
+                self._postings.setdefault(gram, set()).add(title_id)
+        self._titles[title_id].sources.add(source)
+
+    def remove(self, title, year, source):
+        title_id = self._ids.get((normalize(title), str(year or "")))
+        if title_id is None:
+            return
+        t = self._titles[title_id]
+        t.sources.discard(source)
+        if t.sources:
+            return
+
+        del self._ids[(t.normalized, t.year)]
+        del self._titles[title_id]
+        for gram in t.grams:
+            ids = self._postings[gram]
+            ids.discard(title_id)
+            if not ids:
+                del self._postings[gram]
+
+    def _candidates(self, grams):
+        """Returns (id, trigrams in common) for the titles that can score at
+        least `min_score`"""
+        postings = sorted(
+            [self._postings[g] for g in grams if g in self._postings], key=len)
+        if not postings:
+            return []
+
+        max_len = max(1, int(len(self._titles) * self.max_candidates_share))
+        n_rare = sum(1 for p in postings if len(p) <= max_len) or 1
+        rare, common = postings[:n_rare], postings[n_rare:]
+
+        # a title needs this many trigrams in common with the query to
+        # score `min_score`, and the common ones that were skipped can
+        # only account for some of them
+        s = self.min_score
+        needed = math.ceil(s * len(grams) / (2 - s)) - len(common)
+        if len(rare[0]) > max_len:
+            # only common trigrams, like a query for "the". the titles that
+            # have all of them are good enough
+            both = set.intersection(*postings)
+            return [(title_id, len(postings)) for title_id in islice(both, self.max_candidates)]
+
+        counts = Counter(chain.from_iterable(rare))
+        if len(counts) > self.max_candidates:
+            top = counts.most_common(self.max_candidates)
+        else:
+            top = counts.items()
+        return [
+            (title_id, n + sum(1 for p in common if title_id in p))
+            for title_id, n in top if n >= needed
+        ]
+
+    def search(self, query, limit=5):
+        """Returns up to `limit` `Match`es for `query`, best first"""
+        self.searches += 1
+        normalized = normalize(query)
+        grams = trigrams(normalized)
+        if not grams:
+            return []
+
+        matches = list()
+        for title_id, n in self._candidates(grams):
+            t = self._titles[title_id]
+            score = 2 * n / (len(grams) + len(t.grams))
+            if normalized in t.normalized:
+                # all of the query is in the title, "matrix" should find
+                # "The Matrix" before "Metrix"
+                score = (1 + score) / 2
+            if score >= self.min_score:
+                matches.append((score, t))
+
+        matches.sort(key=lambda m: (-m[0], m[1].title))
+        return [
+            Match(t.title, t.year, round(score, 3), sorted(t.sources))
+            for score, t in matches[:limit]
+        ]
+
+    def stats(self):
+        return {
+            'titles': len(self._titles),
+            'trigrams': len(self._postings),
+            'searches': self.searches,
+        }
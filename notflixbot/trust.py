@@ -0,0 +1,111 @@
+from loguru import logger
+from nio import JoinedMembersError, KeysQueryResponse, SyncResponse
+from nio.crypto import TrustState
+
+
+class TrustManager:
+    """Trusts (verifies) the devices of everyone the bot shares a room
+    with, when `autotrust` is set.
+
+    Devices that have been looked at are remembered, so each one is only
+    checked once. Users are checked again when sync says that their device
+    list changed, and their new devices are trusted as soon as nio has
+    queried for their keys, so that sending to a room doesn't fail with
+    `OlmUnverifiedDeviceError` first.
+    """
+
+    def __init__(self, nio, enabled=True):
+        self.nio = nio
+        self.enabled = enabled
+        # (user_id, device_id) that have already been looked at
+        self._seen = set()
+        # users that may have devices we haven't looked at yet
+        self._pending = set()
+
+        self.trusted = 0
+
+    def register(self):
+        """Adds the response callbacks to the nio client"""
+        self.nio.add_response_callback(self._cb_sync, SyncResponse)
+        self.nio.add_response_callback(self._cb_keys_query, KeysQueryResponse)
+
+    async def _cb_sync(self, response):
+        self.device_lists_changed(response.device_list.changed, response.device_list.left)
+
+    async def _cb_keys_query(self, response):
+        self.keys_queried(response)
+
+    def device_lists_changed(self, changed, left=()):
+        for user_id in left:
+            self.forget(user_id)
+        # their keys are queried by the sync loop, and the new devices
+        # are trusted then
+        self._pending.update(changed)
+
+    def keys_queried(self, response):
+        if isinstance(response, KeysQueryResponse):
+            for user_id in response.changed:
+                self.trust_user(user_id)
+
+    def forget(self, user_id):
+        self._seen = {(u, d) for u, d in self._seen if u != user_id}
+        self._pending.discard(user_id)
+
+    def add_users(self, user_ids):
+        self._pending.update(user_ids)
+        self.trust_pending()
+
+    def trust_user(self, user_id):
+        """Trusts the devices of `user_id` that haven't been looked at
+        before, returns how many were trusted"""
+        self._pending.discard(user_id)
+        if not self.enabled or user_id == self.nio.user_id:
+            return 0
+
+        n = 0
+        for dev_id, olm_device in self.nio.device_store[user_id].items():
+            if (user_id, dev_id) in self._seen:
+                continue
+            self._seen.add((user_id, dev_id))
+
+            if olm_device.trust_state != TrustState.verified:
+                self.nio.verify_device(olm_device)
+                logger.info(f"Trusting {dev_id} from user {user_id}")
+                n += 1
+            else:
+                logger.debug(f"Already trust {dev_id} from user {user_id}")
+
+        self.trusted += n
+        return n
+
+    def trust_pending(self):
+        for user_id in list(self._pending):
+            self.trust_user(user_id)
+
+    async def before_send(self, room_id):
+        """Makes sure the devices in an encrypted room are known and
+        trusted before nio shares a group session with them"""
+        if not self.enabled:
+            return
+        room = self.nio.rooms.get(room_id)
+        if room is None or not room.encrypted:
+            return
+
+        if not room.members_synced:
+            members = await self.nio.joined_members(room_id)
+            if isinstance(members, JoinedMembersError):
+                logger.warning(f"Could not get members of {room_id}: {members}")
+            else:
+                self._pending.update([m.user_id for m in members.members])
+
+        if self.nio.should_query_keys:
+            self.keys_queried(await self.nio.keys_query())
+
+        self.trust_pending()
+
+    def stats(self):
+        return {
+            'devices': len(self._seen),
+            'trusted': self.trusted,
+            'pending_users': len(self._pending),
+        }
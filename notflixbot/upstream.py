@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import aiohttp
+from loguru import logger
+
+from notflixbot.errors import UpstreamError
+from notflixbot.metrics import UPSTREAM_LATENCY
+
+
+class Upstream:
+    """One shared, keep-alive HTTP connection pool for the services we
+    call (Radarr, TheMovieDB, Invidious).
+
+    The aiohttp session is created lazily, since it has to be created
+    inside of a running event loop and `main()` starts a new loop every
+    time it reconnects.
+    """
+
+    def __init__(self, timeout=10.0, connect_timeout=4.0, max_connections=16,
+                 max_per_host=4):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self._session = None
+
+    @classmethod
+    def from_config(cls, config_dict):
+        return cls(
+            timeout=float(config_dict.get('http_timeout', 10.0)),
+            connect_timeout=float(config_dict.get('http_connect_timeout', 4.0)),
+            max_connections=int(config_dict.get('http_max_connections', 16)),
+            max_per_host=int(config_dict.get('http_max_per_host', 4)),
+        )
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_per_host,
+                keepalive_timeout=60.0,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=self.timeout,
+                sock_connect=self.connect_timeout
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout
+            )
+            logger.debug(f"Created upstream connection pool ({self.max_connections} connections)")
+        return self._session
+
+    async def request(self, method, url, service="other", **kwargs):
+        """Returns a tuple of (status_code, json)
+
+        Raises UpstreamError if the request fails or times out. An HTTP
+        error status is not an exception, callers decide what it means.
+        `service` is only used to label metrics.
+        """
+        session = self._get_session()
+        start = time.perf_counter()
+        status = "error"
+        try:
+            async with session.request(method, url, **kwargs) as r:
+                status = r.status
+                j = await r.json(content_type=None)
+                return (r.status, j)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            # params are not part of url, so api keys stay out of the logs
+            raise UpstreamError(f"{method} {url}: {e!r}") from e
+        finally:
+            UPSTREAM_LATENCY.observe(
+                time.perf_counter() - start, service=service, status=status)
+
+    async def get(self, url, service="other", **kwargs):
+        return await self.request("GET", url, service, **kwargs)
+
+    async def post(self, url, service="other", **kwargs):
+        return await self.request("POST", url, service, **kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.debug("Closed upstream connection pool")
+        self._session = None
@@ -1,35 +1,59 @@
 import json
-from collections import defaultdict
+import time
 from urllib.parse import urljoin
 
-import zmq.asyncio
 from aiohttp import BasicAuth
 from aiohttp.web import Application, AppRunner, HTTPBadRequest, HTTPException
-from aiohttp.web import HTTPForbidden, TCPSite, get, json_response, middleware
-from aiohttp.web import post
+from aiohttp.web import HTTPForbidden, HTTPServiceUnavailable, Response
+from aiohttp.web import TCPSite, get, json_response, middleware, post
 from loguru import logger
 
+from notflixbot import codec
+from notflixbot.dedup import Dedup
 from notflixbot.emojis import FOLDER, MOVIE, OK, PERSON, TV_EPISODE, TV_SEASON
 from notflixbot.emojis import VIDEO, WARNING
+from notflixbot.errors import NotflixbotError, RelayError
+from notflixbot.logsink import AccessLogSampler
 from notflixbot.matrix import markdown_json
+from notflixbot.metrics import ACCESS_LOG_SECONDS, REGISTRY, WEBHOOK_LATENCY
+from notflixbot.metrics import WEBHOOK_REQUESTS
+from notflixbot.notflix import Notflix, format_add_results
 
 
 class Webhook:
-    def __init__(self, config, ctx):
+    """HTTP server for incoming webhooks. Messages are passed to `sink`,
+    which is either the Outbox (when running in the same process as the
+    Matrix client) or a ZmqSink (when running as a separate process).
+
+    `notflix` is the Matrix client's `Notflix` when running in the same
+    process, so that the Radarr webhooks keep its library up to date.
+
+    The webhook processes (`notflixbot webhook`) are started with
+    `metrics=False` and don't serve `/metrics`, they send their metrics
+    to the bot, which serves them with `serve_metrics()`.
+    """
+
+    def __init__(self, config, sink, notflix=None, metrics=True):
         self.host = config.webhook_host
         self.port = config.webhook_port
         self.tokens = config.webhook_tokens
         self.base_url = config.webhook_base_url
 
-        self._last_msg = defaultdict(str)
+        self._dedup = Dedup.from_config(config)
+        self._sampler = AccessLogSampler(config.log.get('access_log_sample'))
         if len(config.admin_rooms) > 1 and config._debug_arg:
             self._debug_room = config.admin_rooms[1]
         else:
             self._debug_room = None
 
-        self._context = ctx
-        self._socket = self._context.socket(zmq.PAIR)
-        self._socket.connect("inproc://webhook")
+        self._sink = sink
+        # created when it is first used, if it isnt shared
+        self._config = config
+        self._notflix = notflix
+        self._shared_notflix = notflix is not None
+        # returns the metrics snapshots from the webhook processes, set by
+        # the bot when it receives them
+        self.worker_metrics = None
 
         self._app = Application(
             middlewares=[
@@ -41,13 +65,14 @@ class Webhook:
             ]
         )
         self._app.on_shutdown.append(self._on_shutdown)
-        self._setup_routes()
+        self._setup_routes(metrics)
 
-    def _setup_routes(self):
-        def url(url):
-            # adds base url
-            return urljoin(self.base_url, url)
+    def _url(self, url):
+        # adds base url
+        return urljoin(self.base_url, url)
 
+    def _setup_routes(self, metrics):
+        url = self._url
         self._app.add_routes([
             # not an f-string, parameterized input in aiohttp
             post(url("incoming/{token}"), self._handle_incoming),
@@ -57,14 +82,25 @@ class Webhook:
             post(url("jellyfin/{token}"), self._handle_jellyfin),
             post(url("grafana"), self._handle_grafana),
             post(url("authentik/{token}"), self._handle_authentik),
+            post(url("add"), self._handle_add),
+            post(url("add/{token}"), self._handle_add),
             get(url("ruok"), self._handle_ruok),
         ])
+        if metrics:
+            self._app.add_routes([get(url("metrics"), self._handle_metrics)])
 
     async def _on_shutdown(self, app):
         # doesnt work
         # gets triggered by
         #   await runner.cleanup()
         logger.info("http server shutdown")
+        if not self._shared_notflix and self._notflix is not None:
+            await self._notflix.close()
+
+    def _get_notflix(self):
+        if self._notflix is None:
+            self._notflix = Notflix.from_config(self._config)
+        return self._notflix
 
     @middleware
     async def _middleware_access_log(self, request, handler):
@@ -75,26 +111,30 @@ class Webhook:
         # request.method
         # response_status
 
+        start = time.perf_counter()
         response = await handler(request)
         if response is None:
             response = json_response("ok")
 
+        # the route and not the path, so tokens dont end up in metrics
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        WEBHOOK_LATENCY.observe(time.perf_counter() - start, route=route, status=response.status)
+        WEBHOOK_REQUESTS.inc(route=route, method=request.method, status=response.status)
+
         status = response.status
-        remote = request.remote
-        method = request.method
-        path_qs = request.path_qs
-
-        if path_qs == "/ruok":
-            level = "DEBUG"
-        elif status in range(500, 600):
-            level = "ERROR"
-        elif status in range(400, 500):
-            level = "WARNING"
-        else:
-            level = "SUCCESS"
+        log_start = time.perf_counter()
+        if self._sampler.keep(route, status, request.path):
+            if status in range(500, 600):
+                level = "ERROR"
+            elif status in range(400, 500):
+                level = "WARNING"
+            else:
+                level = "SUCCESS"
 
-        logger.bind(access_log=True).log(
-            level, f"{remote} - {method} - {path_qs} - {status}")
+            logger.bind(access_log=True).log(
+                level, f"{request.remote} - {request.method} - {request.path_qs} - {status}")
+        ACCESS_LOG_SECONDS.observe(time.perf_counter() - log_start)
 
         return response
 
@@ -121,21 +161,20 @@ class Webhook:
 
     @middleware
     async def _middleware_json(self, request, handler):
+        # the body is only read once, as bytes
+        body = await request.read()
         try:
-
-            text = await request.text()
-            if text == "":
+            if body == b"":
                 request['json'] = dict()
             else:
-                request['json'] = json.loads(text)
-
-            response = await handler(request)
-            return response
-        except json.decoder.JSONDecodeError as e:
-            body = await request.read()
-            logger.error(f"json: {e}: \n{body.decode()}")
+                request['json'] = codec.loads(body)
+        except codec.DecodeError as e:
+            logger.error(f"json: {e}: \n{body.decode(errors='replace')}")
             raise HTTPBadRequest(reason="json decoding error")
 
+        response = await handler(request)
+        return response
+
     @middleware
     async def _middleware_auth(self, request, handler):
         """Ways of authenticating:
@@ -200,6 +239,10 @@ class Webhook:
     async def _handle_ruok(self, request):
         return json_response({'ruok': 'iamok'})
 
+    async def _handle_metrics(self, request):
+        workers = self.worker_metrics() if self.worker_metrics is not None else None
+        return Response(text=REGISTRY.render(workers), content_type="text/plain")
+
     async def _handle_authentik(self, request):
         user = request['json']['user_username']
         j_body = request['json']['body']
@@ -212,9 +255,37 @@ class Webhook:
             msg = f"[**{user}**] {j_body}"
             plain = f"[{user} {j_body}"
 
-        await self._send(request['room'], msg, plain)
+        await self._send(request['room'], msg, plain, source="authentik")
         return json_response("ok")
 
+    async def _handle_add(self, request):
+        """Adds movies to Radarr, like `!add`:
+
+            {"urls": ["https://www.imdb.com/title/tt0133093/", "tt0234215"], "user": "neo"}
+
+        The summary is sent to the room and the results are returned.
+        """
+        j = request['json']
+        urls = j.get('urls')
+        if not isinstance(urls, list) or not urls or not all(isinstance(u, str) for u in urls):
+            raise HTTPBadRequest
+        user = str(j.get('user', "webhook"))
+
+        try:
+            results = await self._get_notflix().add_many(urls, user)
+        except NotflixbotError as e:
+            return json_response({'error': str(e)}, status=400)
+
+        await self._send(request['room'], format_add_results(results))
+        return json_response({'results': [
+            {
+                'imdb_id': r.imdb_id,
+                'status': r.status,
+                'title': None if r.item is None else r.item['title'],
+                'error': r.error,
+            } for r in results
+        ]})
+
     async def _handle_incoming(self, request):
         """Following the slack webhook request format
         """
@@ -225,11 +296,9 @@ class Webhook:
             else:
                 text = j['text']
 
-            # send the http response to the client before sending
-            # it with zmq. if the consumer part is dead, the http
-            # request will hang, but the message is on the socket and
-            # is read when we recover from it.
-            await self._send(request['room'], text)
+            # the message is on disk in the outbox when this returns,
+            # if the matrix client is down it is sent when it recovers
+            await self._send(request['room'], text, source="incoming", payload=j)
             return json_response("ok")
 
         except KeyError:
@@ -241,23 +310,33 @@ class Webhook:
          - test
          - grab
          - download
+         - movieadded
+         - moviedelete
+
+        The movie is also added to (or removed from) the library of
+        movies in Radarr, if the Matrix client's `Notflix` was passed in.
+        A webhook process doesn't have one, and a library of its own would
+        never be seen by `!add`.
         """
 
         event_type = request['json']['eventType'].lower()
+        if self._shared_notflix and 'movie' in request['json']:
+            self._notflix.radarr_event(event_type, request['json']['movie'])
+
         if event_type == "test":
             msg = f"{OK} Radarr webhook test"
             logger.success(f"{msg} for {request['room']}")
-            await self._send(request['room'], msg)
+            await self._send(request['room'], msg, source="radarr")
 
         if event_type == "download":
             movie = request['json']['movie']
             msg = f"{MOVIE} {movie['title']} ({movie['year']})"
-            await self._send(request['room'], msg)
+            await self._send(request['room'], msg, source="radarr", payload=request['json'])
 
         elif event_type == "grab":
             movie = request['json']['movie']
             msg = f"{FOLDER} downloading '{movie['title']} ({movie['year']})'"
-            await self._send(request['room'], msg)
+            await self._send(request['room'], msg, source="radarr", payload=request['json'])
 
         return json_response("ok")
 
@@ -339,7 +418,7 @@ class Webhook:
             msg = f"{VIDEO} `{user}` is playing [_{prefix}{name}_]({url}) from {device} ({client})"  # noqa
             plain = msg.replace(
                 "playing _", "playing ").replace("_ from", " from")
-            await self._send(request['room'], msg, plain, not_again=True)
+            await self._send(request['room'], msg, plain, source="jellyfin_playback", payload=j)
 
         elif notification_type == "SessionStart":
             user = j['NotificationUsername']
@@ -347,13 +426,13 @@ class Webhook:
             client = j['Client']
 
             msg = f"{PERSON} `{user}` is online from {device} ({client})"
-            await self._send(request['room'], msg, not_again=True)
+            await self._send(request['room'], msg, source="jellyfin_session", payload=j)
 
         elif notification_type == "UserCreated":
             user = j['NotificationUsername']
 
             msg = f"{PERSON} user creted: `{user}`"
-            await self._send(request['room'], msg)
+            await self._send(request['room'], msg, source="jellyfin", payload=j)
 
         elif notification_type == "ItemAdded" and j['ItemType'] == "Movie":
             host = j['ServerUrl']
@@ -367,10 +446,13 @@ class Webhook:
             else:
                 title = name.strip()
 
+            if self._shared_notflix:
+                self._notflix.jellyfin_item_added(title, j['Year'])
+
             url = urljoin(host, urlpath) + itemid
             msg = f"{MOVIE} [{title}]({url}) ({j['Year']})"
             plain = f"{MOVIE} {title} ({j['Year']})"
-            await self._send(request['room'], msg, plain)
+            await self._send(request['room'], msg, plain, source="jellyfin_item_added", payload=j)
 
         elif notification_type == "ItemAdded" and j['ItemType'] == "Episode":
             host = j['ServerUrl']
@@ -381,7 +463,7 @@ class Webhook:
             url = urljoin(host, urlpath) + itemid
             msg = f"{TV_EPISODE} {series}: [{SE}]({url})"
             plain = f"{TV_EPISODE} {series} {SE}"
-            await self._send(request['room'], msg, plain)
+            await self._send(request['room'], msg, plain, source="jellyfin_item_added", payload=j)
 
         elif notification_type == "ItemAdded" and j['ItemType'] == "Season":
             host = j['ServerUrl']
@@ -393,31 +475,53 @@ class Webhook:
             url = urljoin(host, urlpath) + itemid
             msg = f"{TV_SEASON} {series}: [{name}]({url})"
             plain = f"{TV_EPISODE} {series}: {name}"
-            await self._send(request['room'], msg, plain)
+            await self._send(request['room'], msg, plain, source="jellyfin_item_added", payload=j)
 
         return json_response("ok")
 
-    async def _send(self, room, msg, plain=None, not_again=False):
+    async def _send(self, room, msg, plain=None, source=None, payload=None):
+        """`source` and `payload` are used to suppress duplicates, see
+        `Dedup`"""
         if msg is None:
             msg = ""
-        if msg == self._last_msg[room] and not_again:
-            logger.warning(
-                f"ignoring, '{msg[:15]}..' is same as last in {room}")
+        if source is not None and self._dedup.is_duplicate(source, room, msg, payload):
+            logger.warning(f"ignoring, '{msg[:15]}..' was already sent to {room}")
             return False
-        else:
-            z_data = json.dumps({
-                'room': room,
-                'msg': msg,
-                'plain': plain,
-                'message_type': 'm.room.message'
-            })
-            await self._socket.send_string(z_data)
-            self._last_msg[room] = msg
-            return True
-
-    async def serve(self):
+
+        try:
+            await self._sink.put(room, msg, plain)
+        except RelayError as e:
+            logger.error(e)
+            if source is not None:
+                # so that a retry from the sender isnt suppressed
+                self._dedup.forget(source, room, msg, payload)
+            raise HTTPServiceUnavailable
+        return True
+
+    async def serve(self, reuse_port=None):
         runner = AppRunner(self._app)
         await runner.setup()
-        site = TCPSite(runner, self.host, self.port)
+        site = TCPSite(runner, self.host, self.port, reuse_port=reuse_port)
         await site.start()
         logger.info(f'Webhook server listening on: http://{self.host}:{self.port}')
+
+    async def serve_metrics(self, host, port):
+        """Serves only `/metrics` and `/ruok`, for the bot when the webhook
+        server runs in separate processes"""
+        app = Application(
+            middlewares=[
+                self._middleware_access_log,
+                self._middleware_errors,
+                self._middleware_json,
+                self._middleware_auth,
+            ]
+        )
+        app.add_routes([
+            get(self._url("ruok"), self._handle_ruok),
+            get(self._url("metrics"), self._handle_metrics),
+        ])
+        runner = AppRunner(app)
+        await runner.setup()
+        site = TCPSite(runner, host, port)
+        await site.start()
+        logger.info(f'Metrics server listening on: http://{host}:{port}')
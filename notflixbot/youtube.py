@@ -1,13 +1,32 @@
+import asyncio
 from urllib.parse import parse_qs, urljoin, urlparse
 
-import requests
+from aiohttp import ClientTimeout
 from loguru import logger
-from requests.exceptions import ReadTimeout, RequestException
+
+from notflixbot.cache import TTLCache
+from notflixbot.errors import UpstreamError
+from notflixbot.upstream import Upstream
 
 
 class Youtube:
-    def __init__(self, config):
+    def __init__(self, config, upstream=None):
         self.iv_url = config['invidious_url']
+        if upstream is None:
+            upstream = Upstream.from_config(config)
+        self.upstream = upstream
+        # titles are looked up while handling a message in the sync loop,
+        # so this is shorter than http_timeout
+        self.timeout = float(config.get('youtube_timeout', 4.2))
+
+        # video id -> title
+        self._cache = TTLCache(
+            maxsize=int(config.get('youtube_cache_size', 256)),
+            ttl=float(config.get('youtube_cache_ttl', 3600))
+        )
+        # video id -> task fetching the title, so that the same link
+        # posted in several rooms at once is only looked up once
+        self._inflight = dict()
 
     def get_youtube_video_id(self, youtube_url):
         if "youtube.com" in youtube_url:
@@ -25,24 +44,56 @@ class Youtube:
         else:
             raise ValueError("no youtube id found")
 
+    async def _fetch_title(self, ytid):
+        iv_videos = urljoin(self.iv_url, "/api/v1/videos/")
+        iv_api_url = urljoin(iv_videos, ytid)
+
+        status, j = await self.upstream.get(
+            iv_api_url, service="invidious", timeout=ClientTimeout(total=self.timeout))
+        if status != 200:
+            raise UpstreamError(f"invidious responded {status} for '{ytid}'")
+
+        title = j['title']
+        self._cache.set(ytid, title)
+        return title
+
+    async def video_title(self, ytid):
+        title = self._cache.get(ytid)
+        if title is not None:
+            return title
+
+        task = self._inflight.get(ytid)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_title(ytid))
+            self._inflight[ytid] = task
+            task.add_done_callback(lambda _: self._inflight.pop(ytid, None))
+        else:
+            logger.debug(f"Waiting for in-flight lookup of '{ytid}'")
+
+        # shielded so one cancelled waiter doesnt cancel it for the others
+        return await asyncio.shield(task)
+
     async def unfurl(self, msg_body):
         for w in msg_body.split(' '):
             try:
                 ytid = self.get_youtube_video_id(w.strip())
-                iv_videos = urljoin(self.iv_url, "/api/v1/videos/")
-                iv_api_url = urljoin(iv_videos, ytid)
+            except ValueError:
+                continue
+            if not ytid:
+                continue
 
-                r = requests.get(iv_api_url, timeout=4.20)
-                r.raise_for_status()
-                j = r.json()
+            try:
+                title = await self.video_title(ytid)
+            except (UpstreamError, KeyError) as e:
+                logger.warning(e)
+                return None
 
-                title = j['title']
-                iv_url = urljoin(self.iv_url, "/watch?v=") + ytid
+            iv_url = urljoin(self.iv_url, "/watch?v=") + ytid
+            msg = f"🎥 {title} | [YouBahn]({iv_url})"
+            plain = f"🎥 {title}"
+            return (msg, plain)
 
-                msg = f"🎥 {title} | [YouBahn]({iv_url})"
-                plain = f"🎥 {title}"
-                return (msg, plain)
+        return None
 
-            except (ValueError, ReadTimeout, RequestException) as e:
-                logger.warning(e)
-                return None
+    def stats(self):
+        return self._cache.stats()
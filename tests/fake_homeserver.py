@@ -0,0 +1,288 @@
+"""A local stand-in for a Matrix homeserver, implementing the part of the
+client-server API that notflixbot uses, so MatrixClient can be tested
+end-to-end without a real homeserver.
+
+Latency can be added to every request, /send can be rate limited or
+fail like a reverse proxy in front of a homeserver that is down, and
+rooms are generated with as many members as needed.
+"""
+
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+SERVER_NAME = "fake.example"
+API = "/_matrix/client/v3"
+
+
+def state_event(event_type, sender, content, state_key="", n=0):
+    return {
+        'type': event_type,
+        'sender': sender,
+        'state_key': state_key,
+        'content': content,
+        'event_id': f"$state{n}_{event_type}_{state_key}",
+        'origin_server_ts': int(time.time() * 1000),
+    }
+
+
+class FakeRoom:
+    def __init__(self, room_id, alias, members, encrypted=False):
+        self.room_id = room_id
+        self.alias = alias
+        self.members = members
+        self.encrypted = encrypted
+        self.timeline = []
+
+    def state(self, lazy_load_members=False):
+        creator = self.members[0]
+        events = [
+            state_event("m.room.create", creator, {'creator': creator}),
+            state_event("m.room.canonical_alias", creator, {'alias': self.alias}),
+            state_event("m.room.name", creator, {'name': self.alias[1:].split(':')[0]}),
+        ]
+        if self.encrypted:
+            events.append(state_event(
+                "m.room.encryption", creator, {'algorithm': "m.megolm.v1.aes-sha2"}))
+        senders = {e['sender'] for e in self.timeline}
+        for n, user_id in enumerate(self.members):
+            # with lazy loading, only our own and the timeline senders' membership
+            if lazy_load_members and user_id != creator and user_id not in senders:
+                continue
+            events.append(state_event(
+                "m.room.member", user_id, {'membership': "join"}, state_key=user_id, n=n))
+        return events
+
+
+class FakeHomeserver:
+    """`latency` is added to every request (in seconds), `send_rate` (per
+    second) and `send_burst` rate limit /send with M_LIMIT_EXCEEDED
+    responses. The next `send_errors` requests to /send and the next
+    `directory_errors` requests to /directory/room get a 502.
+    """
+
+    def __init__(self, user_id, rooms=1, members=2, encrypted=False,
+                 latency=0.0, send_rate=None, send_burst=10):
+        self.user_id = user_id
+        self.latency = latency
+        self.send_rate = send_rate
+        self.send_burst = send_burst
+        self._send_tokens = float(send_burst)
+        self._send_updated = time.monotonic()
+
+        self.rooms = dict()
+        for r in range(rooms):
+            room_id = f"!room{r}:{SERVER_NAME}"
+            alias = f"#room{r}:{SERVER_NAME}"
+            users = [user_id] + [f"@user{m}:{SERVER_NAME}" for m in range(members - 1)]
+            self.rooms[room_id] = FakeRoom(room_id, alias, users, encrypted)
+        self.aliases = {room.alias: room.room_id for room in self.rooms.values()}
+
+        # (room_id, event_type, content, time received)
+        self.sent = []
+        self.requests = dict()
+        # most requests to a route at the same time
+        self.max_in_flight = dict()
+        self._in_flight = dict()
+        self.rate_limited = 0
+        self.send_errors = 0
+        self.directory_errors = 0
+        self.full_state_syncs = 0
+        # filter id -> filter
+        self.filters = dict()
+        # the timeout of every sync request, in milliseconds
+        self.sync_timeouts = []
+        self._batch = 0
+        self._new_events = asyncio.Event()
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.router.add_get(f"{API}/account/whoami", self.whoami)
+        self.app.router.add_get(f"{API}/sync", self.sync)
+        self.app.router.add_put(f"{API}/rooms/{{room_id}}/send/{{event_type}}/{{txn_id}}", self.send)
+        self.app.router.add_get(f"{API}/directory/room/{{alias}}", self.directory)
+        self.app.router.add_get(f"{API}/joined_rooms", self.joined_rooms)
+        self.app.router.add_get(f"{API}/rooms/{{room_id}}/joined_members", self.joined_members)
+        self.app.router.add_post(f"{API}/keys/upload", self.keys_upload)
+        self.app.router.add_post(f"{API}/keys/query", self.keys_query)
+        self.app.router.add_post(f"{API}/keys/claim", self.keys_claim)
+        self.app.router.add_put(f"{API}/sendToDevice/{{event_type}}/{{txn_id}}", self.send_to_device)
+        self.app.router.add_post(f"{API}/user/{{user_id}}/filter", self.upload_filter)
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        route = request.match_info.route.resource
+        name = route.canonical if route is not None else request.path
+        self.requests[name] = self.requests.get(name, 0) + 1
+        self._in_flight[name] = self._in_flight.get(name, 0) + 1
+        self.max_in_flight[name] = max(self.max_in_flight.get(name, 0), self._in_flight[name])
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return await handler(request)
+        finally:
+            self._in_flight[name] -= 1
+
+    def sent_to(self, room_id, event_type="m.room.message"):
+        return [s for s in self.sent if s[0] == room_id and s[1] == event_type]
+
+    async def wait_for_sent(self, n, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while len(self.sent) < n:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"only {len(self.sent)} of {n} events were sent")
+            await asyncio.sleep(0.005)
+
+    async def whoami(self, request):
+        return web.json_response({'user_id': self.user_id})
+
+    def _room_sync(self, room, full_state, lazy_load_members):
+        state = room.state(lazy_load_members) if full_state else []
+        timeline = room.timeline
+        room.timeline = []
+        return {
+            'state': {'events': state},
+            'timeline': {'events': timeline, 'limited': False, 'prev_batch': f"p{self._batch}"},
+            'ephemeral': {'events': []},
+            'account_data': {'events': []},
+            'summary': {'m.joined_member_count': len(room.members)},
+            'unread_notifications': {},
+        }
+
+    def _valid_since(self, since):
+        try:
+            return since.startswith("s") and 0 < int(since[1:]) <= self._batch
+        except ValueError:
+            return False
+
+    async def sync(self, request):
+        since = request.query.get('since')
+        if since is not None and not self._valid_since(since):
+            return web.json_response(
+                {'errcode': "M_UNKNOWN", 'error': f"Invalid stream token: {since}"}, status=400)
+
+        full_state = since is None or request.query.get('full_state') == "true"
+        sync_filter = request.query.get('filter', "{}")
+        if sync_filter.startswith("{"):
+            sync_filter = json.loads(sync_filter)
+        else:
+            sync_filter = self.filters[sync_filter]
+        lazy_load_members = sync_filter.get('room', {}).get('state', {}).get('lazy_load_members', False)
+        if full_state:
+            self.full_state_syncs += 1
+        timeout = int(request.query.get('timeout', 0)) / 1000
+        self.sync_timeouts.append(int(timeout * 1000))
+
+        has_events = any(room.timeline for room in self.rooms.values())
+        if not full_state and not has_events and timeout > 0:
+            self._new_events.clear()
+            try:
+                await asyncio.wait_for(self._new_events.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        self._batch += 1
+        return web.json_response({
+            'next_batch': f"s{self._batch}",
+            'rooms': {
+                'join': {
+                    room.room_id: self._room_sync(room, full_state, lazy_load_members)
+                    for room in self.rooms.values()
+                    if full_state or room.timeline
+                },
+                'invite': {},
+                'leave': {},
+            },
+            'to_device': {'events': []},
+            'device_lists': {'changed': [], 'left': []},
+            'device_one_time_keys_count': {'signed_curve25519': 50},
+            'presence': {'events': []},
+            'account_data': {'events': []},
+        })
+
+    def _take_send_token(self):
+        if self.send_rate is None:
+            return True
+        now = time.monotonic()
+        self._send_tokens = min(
+            self.send_burst, self._send_tokens + (now - self._send_updated) * self.send_rate)
+        self._send_updated = now
+        if self._send_tokens >= 1.0:
+            self._send_tokens -= 1.0
+            return True
+        return False
+
+    async def send(self, request):
+        if self.send_errors > 0:
+            self.send_errors -= 1
+            return web.Response(text="<html>502 Bad Gateway</html>", status=502, content_type="text/html")
+
+        if not self._take_send_token():
+            self.rate_limited += 1
+            retry_after_ms = int(1000 / self.send_rate)
+            return web.json_response({
+                'errcode': "M_LIMIT_EXCEEDED",
+                'error': "Too Many Requests",
+                'retry_after_ms': retry_after_ms,
+            }, status=429)
+
+        room_id = request.match_info['room_id']
+        event_type = request.match_info['event_type']
+        content = await request.json()
+        event_id = f"$event{len(self.sent)}"
+        self.sent.append((room_id, event_type, content, time.monotonic()))
+
+        room = self.rooms.get(room_id)
+        if room is not None:
+            room.timeline.append({
+                'type': event_type,
+                'sender': self.user_id,
+                'content': content,
+                'event_id': event_id,
+                'origin_server_ts': int(time.time() * 1000),
+            })
+            self._new_events.set()
+        return web.json_response({'event_id': event_id})
+
+    async def directory(self, request):
+        if self.directory_errors > 0:
+            self.directory_errors -= 1
+            return web.Response(text="<html>502 Bad Gateway</html>", status=502, content_type="text/html")
+
+        alias = request.match_info['alias']
+        try:
+            return web.json_response({'room_id': self.aliases[alias], 'servers': [SERVER_NAME]})
+        except KeyError:
+            return web.json_response(
+                {'errcode': "M_NOT_FOUND", 'error': f"Room alias {alias} not found"}, status=404)
+
+    async def joined_rooms(self, request):
+        return web.json_response({'joined_rooms': list(self.rooms)})
+
+    async def joined_members(self, request):
+        room = self.rooms[request.match_info['room_id']]
+        return web.json_response({
+            'joined': {u: {'display_name': u[1:].split(':')[0], 'avatar_url': None} for u in room.members}
+        })
+
+    async def keys_upload(self, request):
+        return web.json_response({'one_time_key_counts': {'signed_curve25519': 50}})
+
+    async def keys_query(self, request):
+        j = await request.json()
+        return web.json_response({
+            'device_keys': {u: {} for u in j.get('device_keys', {})},
+            'failures': {},
+        })
+
+    async def keys_claim(self, request):
+        return web.json_response({'one_time_keys': {}, 'failures': {}})
+
+    async def send_to_device(self, request):
+        return web.json_response({})
+
+    async def upload_filter(self, request):
+        filter_id = str(len(self.filters) + 1)
+        self.filters[filter_id] = await request.json()
+        return web.json_response({'filter_id': filter_id})
@@ -0,0 +1,21 @@
+"""Shared by the tests"""
+
+import json
+
+from notflixbot import config
+
+
+class FakeClock:
+    """A clock for `clock=` arguments, that only moves when `now` is set"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def read_config():
+    with open('config-sample.json', 'r') as f:
+        j = json.load(f)
+    return config.Config(j, 'config-test.json')
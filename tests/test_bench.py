@@ -0,0 +1,24 @@
+import asyncio
+
+from notflixbot.bench import SCENARIOS, percentile, run_benchmark
+from tests.helpers import read_config
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) == 0.0
+
+def test_webhook_benchmark():
+    for scenario in SCENARIOS:
+        r = asyncio.run(run_benchmark(read_config(), requests=200, concurrency=8, scenario=scenario))
+        print(f"\n{scenario}: {r['throughput']:.0f} req/s, p99 {r['p99'] * 1000:.2f}ms")
+        assert r['errors'] == 0
+        assert r['delivered'] == 200
+        assert r['p50'] <= r['p95'] <= r['p99']
+
+def test_webhook_benchmark_outbox():
+    r = asyncio.run(run_benchmark(read_config(), requests=200, concurrency=8, sink="outbox"))
+    assert r['errors'] == 0
+    assert r['delivered'] == 200
@@ -0,0 +1,95 @@
+import time
+
+from notflixbot.cache import SqliteCache, TTLCache
+from tests.helpers import FakeClock
+
+
+def test_cache_hit_miss():
+    c = TTLCache(maxsize=10, ttl=60)
+    assert c.get("#room:example.com") is None
+    c.set("#room:example.com", "!abc:example.com")
+    assert c.get("#room:example.com") == "!abc:example.com"
+    assert c.hits == 1
+    assert c.misses == 1
+
+def test_cache_ttl_expires():
+    clock = FakeClock()
+    c = TTLCache(maxsize=10, ttl=60, clock=clock)
+    c.set("a", 1)
+    clock.now = 59.0
+    assert c.get("a") == 1
+    clock.now = 60.0
+    assert c.get("a") is None
+    assert len(c) == 0
+
+def test_cache_negative_ttl():
+    clock = FakeClock()
+    c = TTLCache(maxsize=10, ttl=3600, clock=clock)
+    missing = object()
+    c.set("#broken:example.com", None, ttl=5)
+    assert c.get("#broken:example.com", missing) is None
+    clock.now = 6.0
+    assert c.get("#broken:example.com", missing) is missing
+
+def test_cache_lru_eviction():
+    c = TTLCache(maxsize=2)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")
+    c.set("c", 3)
+    assert "a" in c
+    assert "b" not in c
+    assert c.evictions == 1
+
+def test_cache_invalidate_value():
+    c = TTLCache(maxsize=10)
+    c.set("#a:example.com", "!room")
+    c.set("#b:example.com", "!room")
+    c.set("#c:example.com", "!other")
+    assert c.invalidate_value("!room") == 2
+    assert len(c) == 1
+
+
+def test_sqlite_cache_fresh_and_stale(tmp_path):
+    clock = FakeClock()
+    c = SqliteCache(str(tmp_path / "cache.db"), ttl=60, stale_ttl=600, clock=clock)
+    assert c.get("tt0133093") is None
+    c.set("tt0133093", {'title': "The Matrix"})
+    assert c.get("tt0133093") == ({'title': "The Matrix"}, True)
+    clock.now = 61.0
+    assert c.get("tt0133093") == ({'title': "The Matrix"}, False)
+    clock.now = 661.0
+    assert c.get("tt0133093") is None
+    assert c.stats()['stale_hits'] == 1
+
+def test_sqlite_cache_survives_restart(tmp_path):
+    path = str(tmp_path / "cache.db")
+    c = SqliteCache(path)
+    c.set("tt404", None)
+    c.close()
+
+    c = SqliteCache(path)
+    assert len(c) == 1
+    assert c.get("tt404") == (None, True)
+
+def test_sqlite_cache_maxsize(tmp_path):
+    clock = FakeClock()
+    c = SqliteCache(str(tmp_path / "cache.db"), maxsize=10, clock=clock)
+    for i in range(20):
+        clock.now = float(i)
+        c.set(f"tt{i}", i)
+    c.set("tt19", 19)
+    assert len(c) == 10
+    assert c.get("tt9") is None
+    assert c.get("tt10") == (10, True)
+    assert c.stats()['evictions'] == 10
+
+def test_sqlite_cache_benchmark(tmp_path):
+    c = SqliteCache(str(tmp_path / "cache.db"))
+    c.set("tt0133093", {'title': "The Matrix", 'tmdb_id': 603, 'release_year': "1999"})
+    n = 10000
+    start = time.perf_counter()
+    for _ in range(n):
+        c.get("tt0133093")
+    elapsed = time.perf_counter() - start
+    print(f"\nsqlite cache hit: {elapsed / n * 1e6:.1f}us")
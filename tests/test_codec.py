@@ -0,0 +1,89 @@
+import json
+import time
+
+from notflixbot import codec
+
+JELLYFIN_ITEM_ADDED = {
+    "ServerId": "abc123", "ServerName": "jellyfin", "ServerVersion": "10.8.9",
+    "ServerUrl": "https://jellyfin.example.com", "NotificationType": "ItemAdded",
+    "Timestamp": "2023-01-01T00:00:00.0000000+00:00", "UtcTimestamp": "2023-01-01T00:00:00.0000000Z",
+    "Name": "Episode 9", "Overview": "Cooper dreams. " * 20, "Tagline": "", "ItemId": "def456",
+    "ItemType": "Episode", "Year": 1990, "SeriesName": "Twin Peaks", "SeasonNumber": 2,
+    "SeasonNumber00": "02", "SeasonNumber000": "002", "EpisodeNumber": 9,
+    "EpisodeNumber00": "09", "EpisodeNumber000": "009", "Provider_tvdb": "70533",
+    "Provider_imdb": "tt0098936", "RunTime": "00:48:00",
+}
+
+
+def test_loads_dumps():
+    body = codec.dumps(JELLYFIN_ITEM_ADDED)
+    assert isinstance(body, bytes)
+    assert codec.loads(body) == JELLYFIN_ITEM_ADDED
+    assert codec.loads(body.decode()) == JELLYFIN_ITEM_ADDED
+
+def test_decode_error():
+    try:
+        codec.loads(b"{not json")
+        assert False
+    except codec.DecodeError:
+        pass
+
+def test_envelope():
+    assert codec.unpack(codec.pack("#room:example.com", "**hi** 🎬", "hi 🎬")) == ("#room:example.com", "**hi** 🎬", "hi 🎬")
+    assert codec.unpack(codec.pack("#room:example.com", "hi")) == ("#room:example.com", "hi", None)
+
+def test_envelope_invalid():
+    for frames in [[b"1", b"room"], [b"2", b"room", b"msg"]]:
+        try:
+            codec.unpack(frames)
+            assert False
+        except ValueError:
+            pass
+
+
+def bench(f, n=2000):
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return (time.perf_counter() - start) / n
+
+def test_codec_benchmark(monkeypatch):
+    body = json.dumps(JELLYFIN_ITEM_ADDED).encode()
+    msg = "📺️ Twin Peaks: [S02E09](https://jellyfin.example.com/web/index.html#!/details?id=def456)"
+    plain = "📺️ Twin Peaks S02E09"
+
+    def stdlib_request():
+        # what Webhook._middleware_json did before: decode to text, then parse
+        json.loads(body.decode())
+
+    def codec_request():
+        codec.loads(body)
+
+    def json_envelope():
+        z_data = json.dumps({'room': "#room:example.com", 'msg': msg, 'plain': plain})
+        m = json.loads(z_data)
+        return (m['room'], m['msg'], m.get('plain'))
+
+    def frames_envelope():
+        return codec.unpack(codec.pack("#room:example.com", msg, plain))
+
+    req_before, req_after = bench(stdlib_request), bench(codec_request)
+    env_before, env_after = bench(json_envelope), bench(frames_envelope)
+    print(f"\nrequest body, json: {req_before * 1e6:.2f}us, {codec.BACKEND}: {req_after * 1e6:.2f}us")
+    print(f"envelope, json: {env_before * 1e6:.2f}us, frames: {env_after * 1e6:.2f}us")
+
+    assert json_envelope() == frames_envelope()
+
+    # the envelope is never encoded to or decoded from json
+    calls = []
+    for name in ["dumps", "loads"]:
+        f = getattr(json, name)
+        monkeypatch.setattr(json, name, lambda data, *a, f=f, name=name, **kw: calls.append((name, type(data))) or f(data, *a, **kw))
+    frames_envelope()
+    assert calls == []
+    # and the request body is parsed once, as bytes
+    codec_request()
+    if codec.BACKEND == "json":
+        assert calls == [("loads", bytes)]
+    else:
+        assert calls == []
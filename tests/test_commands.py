@@ -0,0 +1,102 @@
+import asyncio
+
+from notflixbot.commands import CommandRunner
+
+
+class Notify:
+    def __init__(self):
+        self.msgs = []
+
+    async def __call__(self, room_id, msg):
+        self.msgs.append((room_id, msg))
+
+
+def test_commands_run_in_order_per_room():
+    done = []
+
+    def command(room, n, delay):
+        async def handler():
+            await asyncio.sleep(delay)
+            done.append((room, n))
+        return handler
+
+    async def run():
+        runner = CommandRunner(Notify(), max_per_user=10)
+        # the first command in !a is the slowest, but !b doesnt wait for it
+        runner.submit("!a", "@u", "!cmd", command("!a", 1, 0.05))
+        runner.submit("!a", "@u", "!cmd", command("!a", 2, 0.0))
+        runner.submit("!b", "@u", "!cmd", command("!b", 1, 0.01))
+        await asyncio.sleep(0.1)
+        return runner.stats()
+
+    stats = asyncio.run(run())
+    assert done == [("!b", 1), ("!a", 1), ("!a", 2)]
+    assert stats['completed'] == 3
+    assert stats['queued'] == 0
+
+def test_submit_doesnt_wait():
+    async def run():
+        runner = CommandRunner(Notify())
+        started = asyncio.get_running_loop().time()
+        runner.submit("!a", "@u", "!add", lambda: asyncio.sleep(1.0))
+        elapsed = asyncio.get_running_loop().time() - started
+        await runner.close()
+        return elapsed
+
+    assert asyncio.run(run()) < 0.1
+
+def test_timeout_and_failure():
+    notify = Notify()
+
+    async def crash():
+        return 1 / 0
+
+    async def run():
+        runner = CommandRunner(notify, timeout=0.01)
+        runner.submit("!a", "@u", "!add", lambda: asyncio.sleep(1.0))
+        runner.submit("!a", "@u", "!crash", crash)
+        await asyncio.sleep(0.1)
+        return runner.stats()
+
+    stats = asyncio.run(run())
+    assert stats['timed_out'] == 1
+    assert stats['failed'] == 1
+    assert [m for _, m in notify.msgs] == ["❌ `!add` timed out", "❌ `!crash` failed"]
+
+def test_per_user_limit():
+    notify = Notify()
+
+    async def run():
+        runner = CommandRunner(notify, max_per_user=2)
+        results = [runner.submit("!a", "@u", "!add", lambda: asyncio.sleep(0.01)) for _ in range(3)]
+        results.append(runner.submit("!a", "@other", "!add", lambda: asyncio.sleep(0.01)))
+        await asyncio.sleep(0.1)
+        # and again once the earlier ones are done
+        results.append(runner.submit("!a", "@u", "!add", lambda: asyncio.sleep(0.01)))
+        await runner.close()
+        return results
+
+    assert asyncio.run(run()) == [True, True, False, True, True]
+    assert len(notify.msgs) == 1
+
+def test_close_cancels_running_commands():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run():
+        runner = CommandRunner(Notify())
+        runner.submit("!a", "@u", "!add", slow)
+        runner.submit("!a", "@u", "!add", slow)
+        await asyncio.sleep(0.01)
+        await runner.close()
+        return runner.stats()
+
+    stats = asyncio.run(run())
+    assert cancelled == [True]
+    assert stats['queued'] == 0
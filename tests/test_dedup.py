@@ -0,0 +1,70 @@
+from notflixbot.dedup import Dedup
+from tests.helpers import FakeClock
+
+
+def playback(user, item, device="tv"):
+    return {'NotificationUsername': user, 'ItemId': item, 'DeviceName': device}
+
+
+def test_alternating_duplicates():
+    dedup = Dedup(window=60.0, clock=FakeClock())
+    a = playback("ben", "item1", "tv")
+    b = playback("anna", "item2", "phone")
+
+    assert not dedup.is_duplicate("jellyfin_playback", "#room", "ben is playing", a)
+    assert not dedup.is_duplicate("jellyfin_playback", "#room", "anna is playing", b)
+    assert dedup.is_duplicate("jellyfin_playback", "#room", "ben is playing", a)
+    assert dedup.is_duplicate("jellyfin_playback", "#room", "anna is playing", b)
+    # same payload to another room
+    assert not dedup.is_duplicate("jellyfin_playback", "#other", "ben is playing", a)
+    assert dedup.stats()['suppressed'] == 2
+
+def test_window():
+    clock = FakeClock()
+    dedup = Dedup(window=60.0, clock=clock)
+    assert not dedup.is_duplicate("jellyfin_session", "#room", "online", {})
+    clock.now = 59.0
+    assert dedup.is_duplicate("jellyfin_session", "#room", "online", {})
+    clock.now = 61.0
+    assert not dedup.is_duplicate("jellyfin_session", "#room", "online", {})
+
+def test_fingerprint_policy_and_unknown_sources():
+    dedup = Dedup(policies={'incoming': {'fields': None, 'window': 10.0}}, clock=FakeClock())
+    assert not dedup.is_duplicate("incoming", "#room", "backup done", {'text': "backup done"})
+    assert dedup.is_duplicate("incoming", "#room", "backup done", {'text': "backup done"})
+    assert not dedup.is_duplicate("incoming", "#room", "backup failed")
+    # no policy, never suppressed
+    assert not dedup.is_duplicate("radarr", "#room", "movie")
+    assert not dedup.is_duplicate("radarr", "#room", "movie")
+
+def test_bounded_by_entries_and_bytes():
+    dedup = Dedup(maxsize=10, clock=FakeClock())
+    for i in range(100):
+        dedup.is_duplicate("jellyfin_session", f"#room{i}", "online", {})
+    assert len(dedup) == 10
+    assert dedup.stats()['evictions'] == 90
+
+    dedup = Dedup(max_bytes=1000, clock=FakeClock())
+    for i in range(100):
+        dedup.is_duplicate("jellyfin_session", f"#{'x' * 100}{i}", "online", {})
+    assert dedup.stats()['bytes'] <= 1000
+    assert len(dedup) < 10
+
+def test_forget():
+    dedup = Dedup(clock=FakeClock())
+    assert not dedup.is_duplicate("jellyfin_session", "#room", "online", {})
+    dedup.forget("jellyfin_session", "#room", "online", {})
+    assert not dedup.is_duplicate("jellyfin_session", "#room", "online", {})
+
+def test_expiry_with_different_windows():
+    clock = FakeClock()
+    dedup = Dedup(window=600.0, policies={'incoming': {'fields': None, 'window': 10.0}}, clock=clock)
+    # a long window first, then short ones behind it
+    dedup.is_duplicate("jellyfin_session", "#room", "online", {})
+    for i in range(5):
+        dedup.is_duplicate("incoming", "#room", f"msg {i}")
+    assert len(dedup) == 6
+    clock.now = 11.0
+    dedup.is_duplicate("incoming", "#room", "msg 5")
+    assert len(dedup) == 2
+    assert dedup.is_duplicate("jellyfin_session", "#room", "online", {})
@@ -0,0 +1,86 @@
+import asyncio
+
+from notflixbot.dispatch import RoomDispatcher
+
+
+def test_rooms_are_delivered_in_parallel_and_in_order():
+    delivered = []
+
+    async def deliver(items):
+        room, n = items[0]
+        if room == "!slow":
+            await asyncio.sleep(0.05)
+        delivered.extend(items)
+
+    async def run():
+        d = RoomDispatcher(deliver, max_workers=4)
+        for n in range(3):
+            await d.submit("!slow", ("!slow", n))
+            await d.submit("!fast", ("!fast", n))
+        depths = d.depths()
+        await asyncio.sleep(0.3)
+        return depths
+
+    depths = asyncio.run(run())
+    assert depths == {'!slow': 3, '!fast': 3}
+    # fast room isnt held up by the slow one
+    assert delivered[:3] == [("!fast", 0), ("!fast", 1), ("!fast", 2)]
+    assert [n for r, n in delivered if r == "!slow"] == [0, 1, 2]
+
+def test_max_workers():
+    running = []
+    peak = []
+
+    async def deliver(items):
+        running.append(items)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(items)
+
+    async def run():
+        d = RoomDispatcher(deliver, max_workers=2)
+        for n in range(6):
+            await d.submit(f"!room{n}", n)
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert max(peak) == 2
+
+def test_retry_keeps_order():
+    delivered = []
+    attempts = []
+
+    async def deliver(items):
+        attempts.extend(items)
+        if items == [0] and len(attempts) == 1:
+            raise ConnectionError("homeserver down")
+        delivered.extend(items)
+
+    async def run():
+        d = RoomDispatcher(deliver, retry_delay=0.01)
+        for n in range(3):
+            await d.submit("!room", n)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert delivered == [0, 1, 2]
+    assert attempts == [0, 0, 1, 2]
+
+def test_bursts_are_coalesced():
+    batches = []
+
+    async def deliver(items):
+        batches.append(items)
+
+    async def run():
+        d = RoomDispatcher(deliver, max_batch=10, batch_window=0.05)
+        for n in range(25):
+            await d.submit("!room", n)
+        await d.submit("!other", "alone")
+        await asyncio.sleep(0.3)
+
+    asyncio.run(run())
+    room = [b for b in batches if b[0] != "alone"]
+    assert [len(b) for b in room] == [10, 10, 5]
+    assert sum(room, []) == list(range(25))
+    assert ["alone"] in batches
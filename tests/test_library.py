@@ -0,0 +1,60 @@
+from notflixbot.library import Library
+from notflixbot.search import TitleIndex
+from tests.helpers import FakeClock
+
+MOVIES = [
+    {'id': 1, 'title': "The Matrix", 'year': 1999, 'tmdbId': 603, 'imdbId': "tt0133093"},
+    {'id': 2, 'title': "The Matrix Reloaded", 'year': 2003, 'tmdbId': 604, 'imdbId': "tt0234215"},
+    {'id': 3, 'title': "No tmdb id"},
+]
+
+
+def test_lookups():
+    library = Library()
+    assert not library.loaded
+    library.replace(MOVIES)
+
+    assert len(library) == 2
+    assert library.get(imdb_id="tt0133093")['title'] == "The Matrix"
+    assert library.get(tmdb_id=604)['release_year'] == "2003"
+    assert library.get(imdb_id="tt404") is None
+    assert library.stats()['hits'] == 2
+
+def test_add_and_remove():
+    library = Library()
+    library.replace(MOVIES)
+
+    library.add({'id': 4, 'title': "The Matrix Revolutions", 'year': 2003, 'tmdbId': 605, 'imdbId': "tt0242653"})
+    assert library.get(imdb_id="tt0242653")['tmdb_id'] == 605
+
+    # the imdb id changed in radarr
+    library.add(dict(MOVIES[0], imdbId="tt9999999"))
+    assert library.get(imdb_id="tt0133093") is None
+    assert library.get(imdb_id="tt9999999")['tmdb_id'] == 603
+
+    library.remove(603)
+    assert library.get(imdb_id="tt9999999") is None
+    assert len(library) == 2
+
+def test_stale():
+    clock = FakeClock(1000.0)
+    library = Library(ttl=60, clock=clock)
+    assert library.is_stale()
+    library.replace(MOVIES)
+    assert not library.is_stale()
+    clock.now += 61
+    assert library.is_stale()
+    assert library.stats()['age'] == 61
+
+def test_titles():
+    titles = TitleIndex()
+    library = Library(titles=titles)
+    library.replace(MOVIES)
+    assert titles.search("matrix reloaded")[0].year == "2003"
+
+    # reloaded without the first one
+    library.replace(MOVIES[1:])
+    assert [m.title for m in titles.search("the matrix")] == ["The Matrix Reloaded"]
+
+    library.remove(604)
+    assert len(titles) == 0
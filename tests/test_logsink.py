@@ -0,0 +1,96 @@
+import json
+import time
+
+import pytest
+from loguru import logger
+
+from notflixbot.config import setup_logger
+from notflixbot.errors import ConfigError
+from notflixbot.logsink import AccessLogSampler, BatchSink, Destination
+
+
+def add_sink(sink):
+    return logger.add(sink, level="DEBUG", format="{message}")
+
+
+def test_batch_sink(tmp_path):
+    logfile = tmp_path / "notflixbot.log"
+    jsonfile = tmp_path / "notflixbot.json"
+    access = tmp_path / "access.log"
+    sink = BatchSink([
+        Destination(str(logfile), logger.level("INFO").no),
+        Destination(str(jsonfile), logger.level("INFO").no, serialize=True),
+        Destination(str(access), logger.level("INFO").no, access_log=True),
+    ])
+    handler_id = add_sink(sink)
+
+    logger.debug("not written")
+    logger.info("hello")
+    logger.bind(access_log=True).success("127.0.0.1 - GET - /metrics - 200")
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception("oops")
+    logger.remove(handler_id)
+
+    lines = logfile.read_text().splitlines()
+    assert lines[0].endswith(" - hello")
+    assert " | ERROR    | " in lines[1] and lines[1].endswith(" - oops")
+    assert "ZeroDivisionError" in lines[-1]
+
+    records = [json.loads(line) for line in jsonfile.read_text().splitlines()]
+    assert [r['message'] for r in records] == ["hello", "oops"]
+    assert records[0]['exception'] is None
+    assert "ZeroDivisionError" in records[1]['exception']
+
+    assert access.read_text().endswith("| SUCCESS - 127.0.0.1 - GET - /metrics - 200\n")
+    assert sink.stats()['records'] == 4
+
+def test_full_queue_drops(tmp_path):
+    logfile = tmp_path / "notflixbot.log"
+    sink = BatchSink([Destination(str(logfile), 0)], batch_size=1000, flush_interval=60, max_queue=10)
+    handler_id = add_sink(sink)
+    for i in range(20):
+        logger.info(f"line {i}")
+    assert sink.stats()['dropped'] == 10
+    logger.remove(handler_id)
+
+    assert len(logfile.read_text().splitlines()) == 10
+
+def test_sampler():
+    sampler = AccessLogSampler({'/ruok': 0.25, '/metrics': 0.0})
+    assert sum(sampler.keep("/ruok", 200) for _ in range(100)) == 25
+    assert not any(sampler.keep("/metrics", 200) for _ in range(10))
+    assert sampler.keep("/metrics", 500)
+    assert sampler.keep("/incoming/{token}", 200)
+
+def test_sampler_falls_back_to_path():
+    # with a base_url, /ruok is answered without a route
+    sampler = AccessLogSampler({'/ruok': 0.0})
+    assert not sampler.keep("unmatched", 200, "/ruok")
+    assert sampler.keep("unmatched", 200, "/nope")
+    assert sampler.keep("unmatched", 503, "/ruok")
+
+def test_invalid_mode():
+    with pytest.raises(ConfigError):
+        setup_logger({'level': "INFO", 'mode': "nope"}, False)
+
+def test_logging_overhead(tmp_path):
+    n = 2000
+
+    def per_call(handler_id):
+        start = time.perf_counter()
+        for i in range(n):
+            logger.bind(access_log=True).success(f"127.0.0.1 - GET - /incoming - {i}")
+        elapsed = (time.perf_counter() - start) / n
+        logger.remove(handler_id)
+        return elapsed
+
+    enqueue = per_call(logger.add(
+        str(tmp_path / "enqueue.log"), enqueue=True, serialize=True,
+        filter=lambda r: 'access_log' in r['extra']))
+    batch = per_call(add_sink(BatchSink([
+        Destination(str(tmp_path / "batch.log"), 0, access_log=True, serialize=True)])))
+
+    print(f"\nper call: enqueue {enqueue * 1e6:.1f}us, batch {batch * 1e6:.1f}us")
+    assert len((tmp_path / "batch.log").read_text().splitlines()) == n
@@ -0,0 +1,124 @@
+import asyncio
+from types import SimpleNamespace
+
+from nio import MegolmEvent, RoomMessageText, RoomSendError, RoomSendResponse
+from nio.client.base_client import ClientCallback
+
+from notflixbot.matrix import PollTimeout, SendScheduler, TokenBucket, sync_filter
+from tests.helpers import FakeClock
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2.0, burst=2, clock=clock)
+    assert bucket.delay() == 0.0
+    assert bucket.delay() == 0.0
+    assert bucket.delay() == 0.5
+    clock.now = 0.5
+    assert bucket.delay() == 0.0
+
+def test_token_bucket_pause():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=100.0, burst=10, clock=clock)
+    bucket.pause(2.0)
+    assert bucket.delay() == 2.0
+    clock.now = 2.0
+    assert bucket.delay() == 0.0
+
+
+def make_scheduler(responses, **kwargs):
+    calls = []
+
+    async def send(room_id, **kw):
+        calls.append((room_id, kw['tx_id']))
+        resp = responses.pop(0)
+        if isinstance(resp, Exception):
+            raise resp
+        return resp
+
+    kwargs.setdefault('backoff', 0.001)
+    return SendScheduler(send, rate=1000.0, burst=100, room_rate=1000.0,
+                         room_burst=100, **kwargs), calls
+
+
+def test_scheduler_honours_retry_after():
+    ok = RoomSendResponse("$event", "!room")
+    limited = RoomSendError("slow down", "M_LIMIT_EXCEEDED", retry_after_ms=20)
+    scheduler, calls = make_scheduler([limited, ok])
+
+    resp = asyncio.run(scheduler.send("!room", message_type="m.room.message"))
+    assert resp is ok
+    assert len(calls) == 2
+    assert scheduler.stats() == {'sent': 1, 'retried': 1, 'rate_limited': 1, 'dropped': 0}
+
+def test_scheduler_retries_transient():
+    ok = RoomSendResponse("$event", "!room")
+    scheduler, calls = make_scheduler([asyncio.TimeoutError(), ok])
+
+    assert asyncio.run(scheduler.send("!room")) is ok
+    assert scheduler.retried == 1
+    # the homeserver deduplicates the retry if the first one got through
+    assert calls[0] == calls[1]
+
+def test_scheduler_new_tx_id_per_message():
+    ok = RoomSendResponse("$event", "!room")
+    scheduler, calls = make_scheduler([ok, ok])
+
+    async def two():
+        await scheduler.send("!room")
+        await scheduler.send("!room")
+
+    asyncio.run(two())
+    assert calls[0][1] != calls[1][1]
+
+def test_scheduler_drops_permanent_errors():
+    forbidden = RoomSendError("not in room", "M_FORBIDDEN")
+    forbidden.transport_response = SimpleNamespace(status=403)
+    scheduler, calls = make_scheduler([forbidden])
+
+    assert asyncio.run(scheduler.send("!room")) is forbidden
+    assert len(calls) == 1
+    assert scheduler.dropped == 1
+
+def test_scheduler_gives_up():
+    err = RoomSendError("bad gateway")
+    scheduler, calls = make_scheduler([err] * 3, max_retries=2)
+
+    assert asyncio.run(scheduler.send("!room")) is err
+    assert len(calls) == 3
+    assert scheduler.dropped == 1
+    assert scheduler.retried == 2
+
+
+def test_sync_filter_from_callbacks():
+    callbacks = [
+        ClientCallback(None, (RoomMessageText,)),
+        ClientCallback(None, (MegolmEvent,)),
+    ]
+    f = sync_filter(callbacks)
+    types = f['room']['timeline']['types']
+    assert "m.room.message" in types
+    assert "m.room.encrypted" in types
+    assert "m.room.encryption" in types
+    assert "m.reaction" not in types
+    assert f['presence'] == {'not_types': ["*"]}
+    assert f['room']['ephemeral'] == {'not_types': ["*"]}
+    assert f['room']['state']['lazy_load_members'] is True
+
+def test_sync_filter_unknown_event_class():
+    class SomeEvent:
+        pass
+    f = sync_filter([ClientCallback(None, (SomeEvent,))])
+    assert 'types' not in f['room']['timeline']
+
+def test_poll_timeout():
+    poll = PollTimeout(min_timeout=3000, max_timeout=30000)
+    assert poll.timeout == 30000
+    for _ in range(5):
+        poll.failed()
+    assert poll.timeout == 3000
+    poll.succeeded()
+    assert poll.timeout == 6000
+    for _ in range(5):
+        poll.succeeded()
+    assert poll.timeout == 30000
@@ -0,0 +1,247 @@
+import asyncio
+import json
+import time
+
+from aiohttp.test_utils import TestServer
+
+from notflixbot import config
+from notflixbot.matrix import MatrixClient
+from notflixbot.outbox import Outbox
+from tests.fake_homeserver import API, SERVER_NAME, FakeHomeserver
+
+USER_ID = f"@notflixbot:{SERVER_NAME}"
+
+
+def make_config(tmp_path, homeserver_url, ratelimit=None, startup_concurrency=8):
+    creds_path = tmp_path / "credentials.json"
+    with open(creds_path, 'w') as f:
+        json.dump({'user_id': USER_ID, 'device_id': "BENCHDEVICE", 'access_token': "abc123"}, f)
+
+    if ratelimit is None:
+        ratelimit = {'rate': 10000, 'burst': 1000, 'room_rate': 10000, 'room_burst': 1000}
+    return config.Config({
+        'matrix': {
+            'homeserver': homeserver_url,
+            'user_id': USER_ID,
+            'device_name': "bench",
+            'rooms': [f"#room0:{SERVER_NAME}"],
+            'room_workers': 8,
+            'startup_concurrency': startup_concurrency,
+            'ratelimit': ratelimit,
+        },
+        'webhook': {'tokens': {'123abc': f"#room0:{SERVER_NAME}"}},
+        'notflixbot': {
+            'radarr_url': "http://radarr.invalid",
+            'radarr_api_key': "abc123",
+            'themoviedb_api_key': "def456",
+            'invidious_url': "http://invidious.invalid",
+        },
+        'admin_rooms': [f"#room0:{SERVER_NAME}"],
+        'credentials_path': str(creds_path),
+        'storage_path': str(tmp_path / "store"),
+        'log': {'level': "WARNING"},
+    }, "config-test.json")
+
+
+async def run_bot(tmp_path, hs, f, **kwargs):
+    """Starts MatrixClient against the fake homeserver the same way
+    `notflixbot start` does, and calls `f(matrix, outbox, started_at)`
+    """
+    async with TestServer(hs.app) as server:
+        conf = make_config(tmp_path, str(server.make_url("")).rstrip("/"), **kwargs)
+        outbox = Outbox.from_config(conf)
+        matrix = MatrixClient(conf, outbox)
+
+        started_at = time.monotonic()
+        await matrix.auth()
+        tasks = [
+            asyncio.create_task(matrix._after_first_sync()),
+            asyncio.create_task(matrix.sync_forever()),
+            asyncio.create_task(matrix.webhook_poller()),
+        ]
+        try:
+            return await f(matrix, outbox, started_at)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await matrix.close()
+            outbox.close()
+
+
+def test_startup_to_first_message(tmp_path):
+    hs = FakeHomeserver(USER_ID, rooms=20, members=200, latency=0.002)
+
+    async def startup(matrix, outbox, started_at):
+        await hs.wait_for_sent(1)
+        room_id, _, content, sent_at = hs.sent[0]
+        return room_id, content, sent_at - started_at
+
+    room_id, content, elapsed = asyncio.run(run_bot(tmp_path, hs, startup))
+    print(f"\nstartup to first message (20 rooms, 200 members): {elapsed * 1000:.0f}ms")
+    assert room_id == f"!room0:{SERVER_NAME}"
+    assert "notflixbot" in content['body']
+
+def test_startup_warms_up_rooms_concurrently(tmp_path):
+    hs = FakeHomeserver(USER_ID, rooms=16, members=5, latency=0.01)
+
+    async def startup(matrix, outbox, started_at):
+        await hs.wait_for_sent(1)
+        return matrix.admin_room_ids
+
+    admin_room_ids = asyncio.run(run_bot(tmp_path, hs, startup, startup_concurrency=4))
+    assert admin_room_ids == [f"!room0:{SERVER_NAME}"]
+    in_flight = hs.max_in_flight[f"{API}/rooms/{{room_id}}/joined_members"]
+    assert 1 < in_flight <= 4
+
+def test_sustained_send_throughput(tmp_path):
+    hs = FakeHomeserver(USER_ID, rooms=5, members=10, latency=0.002)
+    n = 200
+
+    async def send_many(matrix, outbox, started_at):
+        await hs.wait_for_sent(1)
+        start = time.monotonic()
+        # like concurrent webhook requests
+        await asyncio.gather(*[
+            outbox.put(f"#room{i % 5}:{SERVER_NAME}", f"message {i}") for i in range(n)
+        ])
+        await hs.wait_for_sent(n + 1)
+        return time.monotonic() - start
+
+    elapsed = asyncio.run(run_bot(tmp_path, hs, send_many))
+    print(f"\nsustained send throughput: {n / elapsed:.0f} msg/s")
+    # in order within each room
+    bodies = [c['body'] for _, _, c, _ in hs.sent_to(f"!room1:{SERVER_NAME}")]
+    assert bodies == [f"message {i}" for i in range(1, n, 5)]
+
+def test_send_when_rate_limited(tmp_path):
+    hs = FakeHomeserver(USER_ID, rooms=1, members=2, send_rate=20.0, send_burst=2)
+    n = 20
+
+    async def send_many(matrix, outbox, started_at):
+        await hs.wait_for_sent(1)
+        await asyncio.gather(*[
+            outbox.put(f"#room0:{SERVER_NAME}", f"message {i}") for i in range(n)
+        ])
+        await hs.wait_for_sent(n + 1)
+        # before shutting down, which sends another message
+        return matrix.stats()['sender'], hs.rate_limited
+
+    stats, rate_limited = asyncio.run(run_bot(tmp_path, hs, send_many))
+    assert rate_limited > 0
+    assert stats['rate_limited'] == rate_limited
+    assert stats['dropped'] == 0
+    bodies = [c['body'] for _, _, c, _ in hs.sent_to(f"!room0:{SERVER_NAME}")][1:n + 1]
+    assert bodies == [f"message {i}" for i in range(n)]
+
+def test_send_during_homeserver_outage(tmp_path):
+    hs = FakeHomeserver(USER_ID, rooms=1, members=2)
+    ratelimit = {'rate': 10000, 'burst': 1000, 'room_rate': 10000, 'room_burst': 1000, 'max_retries': 1}
+    n = 3
+
+    async def send_many(matrix, outbox, started_at):
+        await hs.wait_for_sent(1)
+        # more than SendScheduler retries, so the dispatcher has to try again
+        hs.send_errors = 3
+        for i in range(n):
+            await outbox.put(f"#room0:{SERVER_NAME}", f"message {i}")
+        await hs.wait_for_sent(n + 1)
+        while len(outbox):
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run_bot(tmp_path, hs, send_many, ratelimit=ratelimit))
+    assert hs.send_errors == 0
+    # in order, none of them were dropped
+    bodies = [c['body'] for _, _, c, _ in hs.sent_to(f"!room0:{SERVER_NAME}")][1:n + 1]
+    assert bodies == [f"message {i}" for i in range(n)]
+
+def test_alias_not_cached_after_502(tmp_path):
+    hs = FakeHomeserver(USER_ID, rooms=2, members=2)
+
+    async def send(matrix, outbox, started_at):
+        await hs.wait_for_sent(1)
+        hs.directory_errors = 1
+        await outbox.put(f"#room1:{SERVER_NAME}", "hello")
+        await hs.wait_for_sent(2)
+
+    asyncio.run(run_bot(tmp_path, hs, send))
+    assert hs.directory_errors == 0
+    assert [c['body'] for _, _, c, _ in hs.sent_to(f"!room1:{SERVER_NAME}")] == ["hello"]
+
+def test_sync_uses_uploaded_filter(tmp_path):
+    hs = FakeHomeserver(USER_ID, rooms=1, members=2)
+
+    async def startup(matrix, outbox, started_at):
+        await hs.wait_for_sent(1)
+        # wait for a long-poll
+        while hs.requests.get(f"{API}/sync", 0) < 3:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run_bot(tmp_path, hs, startup))
+    assert len(hs.filters) == 1
+    room = hs.filters["1"]['room']
+    assert "m.room.message" in room['timeline']['types']
+    assert room['ephemeral'] == {'not_types': ["*"]}
+    # the first sync doesnt wait
+    assert hs.sync_timeouts[0] == 0
+    assert 30000 in hs.sync_timeouts
+
+def test_send_to_encrypted_room(tmp_path):
+    hs = FakeHomeserver(USER_ID, rooms=1, members=3, encrypted=True)
+
+    async def startup(matrix, outbox, started_at):
+        await hs.wait_for_sent(1)
+        return hs.sent[0]
+
+    room_id, event_type, content, _ = asyncio.run(run_bot(tmp_path, hs, startup))
+    assert event_type == "m.room.encrypted"
+    assert content['algorithm'] == "m.megolm.v1.aes-sha2"
+
+
+def test_restart_resumes_from_stored_sync_token(tmp_path):
+    hs = FakeHomeserver(USER_ID, rooms=2, members=50, encrypted=True)
+
+    async def startup(matrix, outbox, started_at):
+        await hs.wait_for_sent(1)
+        return matrix.stats()['first_sync']
+
+    async def restart():
+        first = await run_bot(tmp_path, hs, startup)
+        full_state_syncs = hs.full_state_syncs
+        # nothing happened in the rooms while the bot was down
+        for room in hs.rooms.values():
+            room.timeline.clear()
+        hs.sent.clear()
+        second = await run_bot(tmp_path, hs, startup)
+        return first, second, full_state_syncs
+
+    first, second, full_state_syncs = asyncio.run(restart())
+    print(f"\nfirst sync: {first['ms']}ms full state, {second['ms']}ms incremental")
+    assert first['full_state'] is True
+    assert second['full_state'] is False
+    assert second['rooms'] == 2
+    assert full_state_syncs == hs.full_state_syncs == 1
+    # the room is known to be encrypted even though its state wasnt synced
+    room_id, event_type, _, _ = hs.sent[0]
+    assert room_id == f"!room0:{SERVER_NAME}"
+    assert event_type == "m.room.encrypted"
+
+
+def test_full_state_sync_when_token_is_rejected(tmp_path):
+    hs = FakeHomeserver(USER_ID, rooms=1, members=2)
+    # a different homeserver doesnt know the token in the store
+    other = FakeHomeserver(USER_ID, rooms=1, members=2)
+
+    def startup(hs):
+        async def f(matrix, outbox, started_at):
+            await hs.wait_for_sent(1)
+            return matrix.stats()['first_sync']
+        return f
+
+    async def restart():
+        await run_bot(tmp_path, hs, startup(hs))
+        return await run_bot(tmp_path, other, startup(other))
+
+    stats = asyncio.run(restart())
+    assert stats['full_state'] is True
+    assert other.full_state_syncs == 1
@@ -0,0 +1,66 @@
+import json
+
+from notflixbot.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter():
+    c = Counter("test_total", "A test counter", ["route"])
+    c.inc(route="/incoming")
+    c.inc(2, route="/incoming")
+    assert c.get(route="/incoming") == 3
+    assert 'test_total{route="/incoming"} 3' in c.render()
+
+def test_gauge_function():
+    depth = [5]
+    g = Gauge("test_depth", "A test gauge")
+    g.set_function(lambda: depth[0])
+    depth[0] = 7
+    assert g.get() == 7
+    assert "test_depth 7" in g.render()
+
+def test_histogram():
+    h = Histogram("test_seconds", "A test histogram", ["phase"], buckets=(0.1, 1.0))
+    h.observe(0.05, phase="http")
+    h.observe(0.1, phase="http")
+    h.observe(5.0, phase="http")
+    lines = h.render().splitlines()
+    assert 'test_seconds_bucket{phase="http",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{phase="http",le="1"} 2' in lines
+    assert 'test_seconds_bucket{phase="http",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{phase="http"} 3' in lines
+    assert h.count(phase="http") == 3
+
+def test_label_escaping():
+    c = Counter("test_escape_total", "Escaping", ["path"])
+    c.inc(path='a"b\\c')
+    assert 'path="a\\"b\\\\c"' in c.render()
+
+def test_registry():
+    r = Registry()
+    r.register(Counter("a_total", "a"))
+    r.register(Counter("b_total", "b"))
+    text = r.render()
+    assert "# TYPE a_total counter" in text
+    assert "# TYPE b_total counter" in text
+    try:
+        r.register(Counter("a_total", "again"))
+        assert False
+    except ValueError:
+        pass
+
+def test_registry_with_workers():
+    r = Registry()
+    c = r.register(Counter("req_total", "Requests", ["route"]))
+    h = r.register(Histogram("lat_seconds", "Latency", buckets=(0.1, 1.0)))
+    c.inc(route="/a")
+    h.observe(0.5)
+    # as if sent over zmq by another process
+    other = json.loads(json.dumps(r.snapshot()))
+
+    text = r.render({'webhook-0': other})
+    assert 'req_total{route="/a"} 1' in text
+    assert 'req_total{route="/a",worker="webhook-0"} 1' in text
+    assert 'lat_seconds_bucket{worker="webhook-0",le="1"} 1' in text
+    assert 'lat_seconds_count{worker="webhook-0"} 1' in text
+    # one HELP/TYPE per metric
+    assert text.count("# TYPE req_total counter") == 1
@@ -0,0 +1,257 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from notflixbot.cache import SqliteCache
+from notflixbot.errors import TvdbError
+from notflixbot.notflix import Notflix, format_add_results, format_have_results
+from tests.helpers import FakeClock
+
+TMDB_FIND = {
+    'movie_results': [{
+        'id': 603,
+        'title': 'The Matrix',
+        'original_title': 'The Matrix',
+        'release_date': '1999-03-30',
+        'poster_path': '/poster.jpg',
+        'backdrop_path': '/backdrop.jpg',
+        'vote_average': 8.2,
+    }],
+    'tv_results': [],
+}
+
+
+def make_app(radarr_status=201):
+    calls = {'find': 0, 'movie': 0}
+
+    async def find(request):
+        calls['find'] += 1
+        assert request.query['external_source'] == "imdb_id"
+        return web.json_response(TMDB_FIND)
+
+    async def movie(request):
+        calls['movie'] += 1
+        j = await request.json()
+        assert j['imdbId'] == "tt0133093"
+        assert j['TmdbId'] == 603
+        return web.json_response(j, status=radarr_status)
+
+    app = web.Application()
+    app.router.add_get("/3/find/{imdb_id}", find)
+    app.router.add_post("/radarr/movie", movie)
+    return app, calls
+
+
+async def with_notflix(app, f, cache=None):
+    async with TestServer(app) as server:
+        notflix = Notflix({
+            'radarr_url': str(server.make_url("/radarr")),
+            'radarr_api_key': "abc123",
+            'themoviedb_api_key': "def456",
+        }, cache=cache)
+        notflix.tvdb.api_base_url = str(server.make_url("/3/"))
+        try:
+            return await f(notflix)
+        finally:
+            await notflix.close()
+
+
+def test_add_imdb_url():
+    app, calls = make_app()
+
+    async def add(notflix):
+        return await notflix.add_many(["https://www.imdb.com/title/tt0133093/"], "neo")
+
+    [result] = asyncio.run(with_notflix(app, add))
+    assert result.status == "added"
+    assert result.item['title'] == "The Matrix"
+    assert result.item['release_year'] == "1999"
+    assert calls == {'find': 1, 'movie': 1}
+
+def test_add_exists():
+    app, _ = make_app(radarr_status=400)
+
+    async def add(notflix):
+        return await notflix.add_many(["https://www.imdb.com/title/tt0133093/"])
+
+    [result] = asyncio.run(with_notflix(app, add))
+    assert result.status == "exists"
+
+def test_connections_are_reused():
+    app, calls = make_app()
+
+    async def add_many(notflix):
+        await asyncio.gather(*[
+            notflix.tvdb.search_imdb_id("tt0133093") for _ in range(10)
+        ])
+        return notflix.upstream._session.connector
+
+    connector = asyncio.run(with_notflix(app, add_many))
+    assert calls['find'] == 10
+    assert connector.limit_per_host == 4
+
+
+def make_bulk_app(existing=(), import_status=200, library=None):
+    calls = {'find': 0, 'import': 0, 'movie': 0, 'library': 0}
+
+    async def find(request):
+        calls['find'] += 1
+        imdb_id = request.match_info['imdb_id']
+        if imdb_id == "tt404":
+            return web.json_response({'movie_results': [], 'tv_results': []})
+        n = int(imdb_id[2:])
+        return web.json_response({'movie_results': [dict(
+            TMDB_FIND['movie_results'][0], id=n, title=f"Movie {n}")], 'tv_results': []})
+
+    async def movie_import(request):
+        calls['import'] += 1
+        if import_status != 200:
+            return web.json_response({}, status=import_status)
+        movies = await request.json()
+        return web.json_response([
+            {'tmdbId': m['TmdbId'], 'title': m['Title']} for m in movies if m['TmdbId'] not in existing
+        ])
+
+    async def movie(request):
+        calls['movie'] += 1
+        j = await request.json()
+        return web.json_response(j, status=400 if j['TmdbId'] in existing else 201)
+
+    async def movies(request):
+        calls['library'] += 1
+        if library is None:
+            return web.json_response({}, status=404)
+        return web.json_response(library)
+
+    app = web.Application()
+    app.router.add_get("/3/find/{imdb_id}", find)
+    app.router.add_post("/radarr/movie/import", movie_import)
+    app.router.add_post("/radarr/movie", movie)
+    app.router.add_get("/radarr/movie", movies)
+    return app, calls
+
+
+def test_add_many():
+    app, calls = make_bulk_app(existing={2})
+    urls = [
+        "https://www.imdb.com/title/tt0000001/", "tt0000002", "tt404",
+        "https://example.com/nope", "tt0000001", "tt0000003",
+    ]
+
+    async def add(notflix):
+        return await notflix.add_many(urls, "neo")
+
+    results = asyncio.run(with_notflix(app, add))
+    assert [(r.imdb_id, r.status) for r in results] == [
+        ("tt0000001", "added"), ("tt0000002", "error"), ("tt404", "error"),
+        ("https://example.com/nope", "error"), ("tt0000003", "added"),
+    ]
+    # one lookup per movie, and one request to radarr
+    assert calls == {'find': 4, 'import': 1, 'movie': 0, 'library': 1}
+
+    summary = format_add_results(results)
+    assert summary.startswith("2 added, 0 already existed, 3 failed")
+    assert "- Added: Movie 1 (1999)" in summary
+    # the name of each result, not of the one before it
+    assert "- Failed: Movie 2 (1999): not added by radarr" in summary
+    assert "- Failed: `tt404`: " in summary
+
+def test_add_many_without_import():
+    app, calls = make_bulk_app(existing={2}, import_status=404)
+
+    async def add(notflix):
+        return await notflix.add_many(["tt0000001", "tt0000002"])
+
+    results = asyncio.run(with_notflix(app, add))
+    assert [r.status for r in results] == ["added", "exists"]
+    assert calls == {'find': 2, 'import': 1, 'movie': 2, 'library': 1}
+
+def test_add_one():
+    app, calls = make_bulk_app()
+
+    async def add(notflix):
+        return await notflix.add_many(["tt0000001"])
+
+    results = asyncio.run(with_notflix(app, add))
+    assert format_add_results(results) == "Added: Movie 1 (1999)"
+    assert calls['movie'] == 1
+
+
+def test_add_many_from_library():
+    library = [
+        {'id': 1, 'title': "Movie 1", 'year': 1999, 'tmdbId': 1, 'imdbId': "tt0000001"},
+        # radarr doesnt always know the imdb id
+        {'id': 2, 'title': "Movie 2", 'year': 1999, 'tmdbId': 2},
+    ]
+    app, calls = make_bulk_app(library=library)
+
+    async def add(notflix):
+        first = await notflix.add_many(["tt0000001", "tt0000002", "tt0000003"])
+        # now radarr has movie 3 too
+        again = await notflix.add_many(["tt0000003"])
+        return first, again
+
+    first, again = asyncio.run(with_notflix(app, add))
+    assert [r.status for r in first] == ["exists", "exists", "added"]
+    assert first[0].item['title'] == "Movie 1"
+    assert [r.status for r in again] == ["exists"]
+    # movie 1 wasnt looked up, and only movie 3 was posted to radarr
+    assert calls == {'find': 2, 'import': 0, 'movie': 1, 'library': 1}
+
+def test_have():
+    library = [{'id': 1, 'title': "The Matrix", 'year': 1999, 'tmdbId': 603, 'imdbId': "tt0133093"}]
+    app, calls = make_bulk_app(library=library)
+
+    async def have(notflix):
+        notflix.jellyfin_item_added("The Matrix Reloaded", 2003)
+        return await notflix.have("matrix")
+
+    matches = asyncio.run(with_notflix(app, have))
+    assert format_have_results("matrix", matches) == "- The Matrix (1999)\n- The Matrix Reloaded (2003)"
+    assert format_have_results("nope", []) == "Nothing like 'nope'"
+    assert calls['library'] == 1
+
+def test_library_load_failure_is_retried_later():
+    app, calls = make_bulk_app()
+
+    async def add(notflix):
+        await notflix.add_many(["tt0000001"])
+        await notflix.add_many(["tt0000002"])
+        return notflix.library.loaded
+
+    assert asyncio.run(with_notflix(app, add)) is False
+    assert calls['library'] == 1
+    assert calls['movie'] == 2
+
+
+def test_tmdb_cache(tmp_path):
+    app, calls = make_bulk_app()
+    clock = FakeClock(1000.0)
+    cache = SqliteCache(str(tmp_path / "tmdb.db"), ttl=60, stale_ttl=600, clock=clock)
+
+    async def lookups(notflix):
+        tmdb = notflix.tvdb
+        first = await tmdb.search_imdb_id("tt0000001")
+        again = await tmdb.search_imdb_id("tt0000001")
+        assert calls['find'] == 1
+
+        # stale, returned straight away and refreshed in the background
+        clock.now += 120
+        stale = await tmdb.search_imdb_id("tt0000001")
+        await asyncio.gather(*tmdb._revalidating.values())
+        assert calls['find'] == 2
+        assert cache.get("tt0000001")[1] is True
+
+        # no results are cached too
+        for _ in range(2):
+            try:
+                await tmdb.search_imdb_id("tt404")
+            except TvdbError:
+                pass
+        assert calls['find'] == 3
+        return first, again, stale
+
+    first, again, stale = asyncio.run(with_notflix(app, lookups, cache))
+    assert first == again == stale
+    assert first['title'] == "Movie 1"
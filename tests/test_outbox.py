@@ -0,0 +1,95 @@
+import asyncio
+
+from notflixbot.outbox import Outbox
+
+
+def test_outbox_put_get_ack(tmp_path):
+    async def run():
+        outbox = Outbox(str(tmp_path / "outbox.db"))
+        await outbox.put("#room:example.com", "**hi**", "hi")
+        await outbox.put("#room:example.com", "second")
+        first = await outbox.get()
+        second = await outbox.get()
+        outbox.ack(first.id)
+        outbox.ack(second.id)
+        outbox.close()
+        return first, second, len(outbox)
+
+    first, second, depth = asyncio.run(run())
+    assert first.msg == "**hi**"
+    assert first.plain == "hi"
+    assert second.plain is None
+    assert depth == 0
+
+def test_outbox_replays_unacked(tmp_path):
+    path = str(tmp_path / "outbox.db")
+
+    async def put_and_crash():
+        outbox = Outbox(path)
+        for i in range(3):
+            await outbox.put("#room:example.com", f"msg {i}")
+        item = await outbox.get()
+        outbox.ack(item.id)
+        # got this one, but never sent it
+        await outbox.get()
+        outbox.close()
+
+    async def restart():
+        outbox = Outbox(path)
+        items = [await outbox.get() for _ in range(len(outbox))]
+        outbox.close()
+        return items
+
+    asyncio.run(put_and_crash())
+    items = asyncio.run(restart())
+    assert [i.msg for i in items] == ["msg 1", "msg 2"]
+
+def test_outbox_get_waits_for_put(tmp_path):
+    async def run():
+        outbox = Outbox(str(tmp_path / "outbox.db"))
+        getter = asyncio.ensure_future(outbox.get())
+        await asyncio.sleep(0.01)
+        assert not getter.done()
+        await outbox.put("#room:example.com", "wake up")
+        item = await asyncio.wait_for(getter, 1.0)
+        outbox.close()
+        return item
+
+    assert asyncio.run(run()).msg == "wake up"
+
+def test_outbox_bounded(tmp_path):
+    async def run():
+        outbox = Outbox(str(tmp_path / "outbox.db"), maxsize=2)
+        for i in range(5):
+            await outbox.put("#room:example.com", f"msg {i}")
+        items = [await outbox.get() for _ in range(len(outbox))]
+        stats = outbox.stats()
+        outbox.close()
+        return items, stats
+
+    items, stats = asyncio.run(run())
+    assert [i.msg for i in items] == ["msg 3", "msg 4"]
+    assert stats['dropped'] == 3
+
+def test_outbox_batches_commits(tmp_path):
+    async def run():
+        outbox = Outbox(str(tmp_path / "outbox.db"), flush_interval=0.02)
+        commits = []
+        db = outbox._db
+
+        class CountingDb:
+            def __getattr__(self, name):
+                return getattr(db, name)
+
+            def commit(self):
+                commits.append(1)
+                db.commit()
+
+        outbox._db = CountingDb()
+        await asyncio.gather(*[
+            outbox.put("#room:example.com", f"msg {i}") for i in range(20)
+        ])
+        outbox.close()
+        return len(commits)
+
+    assert asyncio.run(run()) == 1
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from notflixbot.errors import ConfigError
+from notflixbot.phrases import PhraseMatcher
+from tests.helpers import FakeClock
+
+
+def test_default_phrases():
+    phrases = PhraseMatcher()
+    assert phrases.match("Are you alive?", "!room") == "no im a `robot`"
+    assert phrases.match("  im a robot ", "!room") == "FILTHY LIES"
+    # only whole messages
+    assert phrases.match("are you alive, bot?", "!room") is None
+    assert phrases.match("hello", "!room") is None
+
+def test_prefix_and_substring():
+    phrases = PhraseMatcher([
+        {'trigger': "cheese", 'response': "did someone say 🧀?", 'match': "substring"},
+        {'trigger': "good morning", 'response': "morning!", 'match': "prefix"},
+        {'trigger': "good", 'response': "good", 'match': "prefix"},
+    ])
+    assert phrases.match("I love CHEESE so much", "!room") == "did someone say 🧀?"
+    assert phrases.match("good morning everyone", "!room") == "morning!"
+    assert phrases.match("good night", "!room") == "good"
+    assert phrases.match("not good", "!room") is None
+
+def test_rooms():
+    phrases = PhraseMatcher([
+        {'trigger': "ping", 'response': "pong", 'rooms': ["#ops:example.com"]},
+    ])
+    assert phrases.match("ping", "!abc", "#ops:example.com") == "pong"
+    assert phrases.match("ping", "!def", "#random:example.com") is None
+
+def test_rooms_resolved():
+    phrases = PhraseMatcher([
+        {'trigger': "ping", 'response': "pong", 'rooms': ["#ops:example.com"]},
+        {'trigger': "pong", 'response': "ping", 'rooms': ["!xyz"]},
+    ])
+    assert phrases.aliases() == {"#ops:example.com"}
+    # a room that doesnt know its canonical alias
+    assert phrases.match("ping", "!abc") is None
+    phrases.resolve({"#ops:example.com": "!abc"})
+    assert phrases.match("ping", "!abc") == "pong"
+    assert phrases.match("ping", "!def", "#ops:example.com") == "pong"
+    assert phrases.match("pong", "!xyz") == "ping"
+
+def test_cooldown():
+    clock = FakeClock()
+    phrases = PhraseMatcher([
+        {'trigger': "cheese", 'response': "🧀", 'match': "substring", 'cooldown': 60},
+    ], clock=clock)
+    assert phrases.match("cheese", "!a") == "🧀"
+    assert phrases.match("more cheese", "!a") is None
+    # per room
+    assert phrases.match("cheese", "!b") == "🧀"
+    clock.now = 61.0
+    assert phrases.match("cheese", "!a") == "🧀"
+    assert phrases.stats()['cooling_down'] == 1
+
+def test_invalid_config():
+    with pytest.raises(ConfigError):
+        PhraseMatcher([{'trigger': "x", 'response': "y", 'match': "regex"}])
+    with pytest.raises(ConfigError):
+        PhraseMatcher([{'trigger': "x"}])
+
+def test_benchmark_many_triggers():
+    triggers = [{'trigger': f"keyword{i}", 'response': str(i), 'match': "substring"} for i in range(1000)]
+    phrases = PhraseMatcher(triggers)
+    msg = "nothing to see here, just a normal message in a busy room " * 4
+    phrases.match(msg, "!room")
+
+    n = 2000
+    start = time.perf_counter()
+    for _ in range(n):
+        phrases.match(msg, "!room")
+    elapsed = time.perf_counter() - start
+    print(f"\nphrase matching, 1000 triggers: {elapsed / n * 1e6:.1f}us per message")
+    assert phrases.match("i said keyword999 twice", "!room") == "999"
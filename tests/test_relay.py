@@ -0,0 +1,97 @@
+import asyncio
+
+import zmq.asyncio
+
+from notflixbot.outbox import Outbox
+from notflixbot.relay import ZmqSink, ZmqSource
+
+
+def test_sink_to_source(tmp_path):
+    addr = f"ipc://{tmp_path}/webhook.sock"
+
+    async def run():
+        ctx = zmq.asyncio.Context()
+        outbox = Outbox(str(tmp_path / "outbox.db"))
+        source = ZmqSource(ctx, addr, outbox)
+        sink = ZmqSink(ctx, addr)
+        task = asyncio.ensure_future(source.run())
+        try:
+            await sink.put("#room:example.com", "**hi**", "hi")
+            await sink.put("#room:example.com", "second")
+            items = [await asyncio.wait_for(outbox.get(), 2.0) for _ in range(2)]
+            # let the last put() in the source commit
+            await asyncio.sleep(outbox.flush_interval * 2)
+        finally:
+            task.cancel()
+            sink.close()
+            source.close()
+            outbox.close()
+            ctx.destroy()
+        return items, sink.stats(), source.stats()
+
+    items, sink_stats, source_stats = asyncio.run(run())
+    assert [(i.msg, i.plain) for i in items] == [("**hi**", "hi"), ("second", None)]
+    assert sink_stats['sent'] == 2
+    assert source_stats['received'] == 2
+
+def test_source_writes_batches(tmp_path):
+    addr = f"ipc://{tmp_path}/webhook.sock"
+    n = 100
+
+    async def run():
+        ctx = zmq.asyncio.Context()
+        outbox = Outbox(str(tmp_path / "outbox.db"))
+        source = ZmqSource(ctx, addr, outbox)
+        sink = ZmqSink(ctx, addr)
+        try:
+            for i in range(n):
+                await sink.put("#room:example.com", f"msg {i}")
+            # everything is queued on the socket before the source starts
+            await asyncio.sleep(0.1)
+            task = asyncio.ensure_future(source.run())
+            items = [await asyncio.wait_for(outbox.get(), 2.0) for _ in range(n)]
+            task.cancel()
+        finally:
+            sink.close()
+            source.close()
+            outbox.close()
+            ctx.destroy()
+        return items, source.stats()
+
+    items, stats = asyncio.run(run())
+    assert [i.msg for i in items] == [f"msg {i}" for i in range(n)]
+    assert stats['received'] == n
+    assert stats['batches'] < n
+
+
+def test_metrics_from_webhook_processes(tmp_path):
+    addr = f"ipc://{tmp_path}/webhook.sock"
+
+    async def run():
+        ctx = zmq.asyncio.Context()
+        outbox = Outbox(str(tmp_path / "outbox.db"))
+        source = ZmqSource(ctx, addr, outbox)
+        sink = ZmqSink(ctx, addr)
+        tasks = [
+            asyncio.ensure_future(source.run()),
+            asyncio.ensure_future(sink.push_metrics("webhook-0", interval=0.05)),
+        ]
+        try:
+            for _ in range(100):
+                if source.metrics():
+                    break
+                await asyncio.sleep(0.02)
+            return source.metrics(), source.stats()
+        finally:
+            for task in tasks:
+                task.cancel()
+            sink.close()
+            source.close()
+            outbox.close()
+            ctx.destroy()
+
+    metrics, stats = asyncio.run(run())
+    assert list(metrics) == ["webhook-0"]
+    assert "notflixbot_zmq_sent_total" in metrics["webhook-0"]
+    # not messages for the outbox
+    assert stats['received'] == 0
@@ -0,0 +1,61 @@
+import time
+
+from markdown import markdown
+
+from notflixbot.render import MarkdownRenderer
+
+MESSAGES = [
+    "`iamok`",
+    "🎬 [The Matrix](https://jellyfin.example.com/web/index.html#!/details?id=abc) (1999)",
+    "📺️ Twin Peaks: [S02E09](https://jellyfin.example.com/web/index.html#!/details?id=def)",
+    "- I am: `@notflixbot:example.com`\n- You are: `@neo:example.com`",
+    "🎥 `neo` is playing [_The Matrix_](https://jellyfin.example.com/) from tv (Jellyfin Web)",
+]
+
+
+def test_render_same_as_markdown():
+    renderer = MarkdownRenderer()
+    for msg in MESSAGES * 2:
+        assert renderer.render(msg) == markdown(msg)
+
+def test_render_is_reset_between_uses():
+    renderer = MarkdownRenderer(cache_size=0)
+    # reference style links would leak into the next message
+    # if the instance wasnt reset
+    renderer.render("[x]: https://example.com\n\n[link][x]")
+    assert renderer.render("[link][x]") == markdown("[link][x]")
+
+def test_render_long_messages_arent_cached():
+    renderer = MarkdownRenderer(max_cached_len=10)
+    renderer.render("a" * 11)
+    assert renderer.stats()['size'] == 0
+
+
+def bench(f, n=200):
+    start = time.perf_counter()
+    for _ in range(n):
+        for msg in MESSAGES:
+            f(msg)
+    return (time.perf_counter() - start) / (n * len(MESSAGES))
+
+def test_render_benchmark(monkeypatch):
+    before = bench(markdown)
+    uncached = bench(MarkdownRenderer(cache_size=0).render)
+    renderer = MarkdownRenderer()
+    cached = bench(renderer.render)
+
+    print(f"\nmarkdown(): {before * 1e6:.1f}us/msg")
+    print(f"MarkdownRenderer, no cache: {uncached * 1e6:.1f}us/msg")
+    print(f"MarkdownRenderer, cached: {cached * 1e6:.1f}us/msg")
+
+    # every message was only converted the first time
+    stats = renderer.stats()
+    assert stats['misses'] == len(MESSAGES)
+    assert stats['hits'] == 199 * len(MESSAGES)
+
+    converted = []
+    convert = renderer._md.convert
+    monkeypatch.setattr(renderer._md, "convert", lambda msg: converted.append(msg) or convert(msg))
+    for msg in MESSAGES:
+        renderer.render(msg)
+    assert converted == []
@@ -0,0 +1,68 @@
+import random
+import string
+import time
+
+from notflixbot.search import TitleIndex, normalize
+
+TITLES = [
+    ("The Matrix", 1999),
+    ("The Matrix Reloaded", 2003),
+    ("The Matrix Revolutions", 2003),
+    ("Amélie", 2001),
+    ("Spider-Man: Into the Spider-Verse", 2018),
+    ("Metrix", 2020),
+]
+
+
+def make_index():
+    index = TitleIndex()
+    for title, year in TITLES:
+        index.add(title, year, "radarr")
+    return index
+
+
+def test_normalize():
+    assert normalize("Amélie") == "amelie"
+    assert normalize("Spider-Man: Into the Spider-Verse") == "spider man into the spider verse"
+
+def test_search():
+    index = make_index()
+    assert [m.title for m in index.search("matrix")][:3] == [
+        "The Matrix", "The Matrix Reloaded", "The Matrix Revolutions"]
+    assert index.search("amelie")[0].title == "Amélie"
+    # typos
+    assert index.search("spiderman into spiderverse")[0].year == "2018"
+    assert index.search("matirx reloded")[0].title == "The Matrix Reloaded"
+    assert index.search("nothing like it") == []
+    assert index.search("") == []
+
+def test_sources():
+    index = make_index()
+    index.add("The Matrix", 1999, "jellyfin")
+    assert index.search("the matrix")[0].sources == ["jellyfin", "radarr"]
+
+    index.remove("The Matrix", 1999, "radarr")
+    assert index.search("the matrix")[0].sources == ["jellyfin"]
+    index.remove("The Matrix", 1999, "jellyfin")
+    assert index.search("the matrix")[0].title == "The Matrix Reloaded"
+    assert len(index) == len(TITLES) - 1
+
+def test_search_benchmark():
+    rng = random.Random(1)
+
+    def word():
+        return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9)))
+
+    words = [word() for _ in range(3000)] + ["the", "of", "a", "and"] * 100
+    index = TitleIndex()
+    titles = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 5))) for _ in range(20000)]
+    for i, title in enumerate(titles):
+        index.add(title, 1950 + i % 70, "radarr")
+
+    queries = [rng.choice(titles) for _ in range(200)] + [t[:6] for t in rng.sample(titles, 200)]
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query)
+    elapsed = (time.perf_counter() - start) / len(queries)
+    print(f"\n{len(index)} titles: {elapsed * 1e6:.0f}us per search")
+    assert index.search(titles[0])[0].title == titles[0]
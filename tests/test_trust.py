@@ -0,0 +1,72 @@
+import asyncio
+from types import SimpleNamespace
+
+from nio import KeysQueryResponse
+from nio.crypto import TrustState
+
+from notflixbot.trust import TrustManager
+
+BOT = "@notflixbot:example.com"
+
+
+class FakeNio:
+    def __init__(self, devices):
+        self.user_id = BOT
+        # user_id -> {device_id: device}
+        self.device_store = {
+            u: {d: SimpleNamespace(device_id=d, user_id=u, trust_state=TrustState.unset) for d in devs}
+            for u, devs in devices.items()
+        }
+        self.verified = []
+        self.rooms = dict()
+        self.should_query_keys = False
+
+    def verify_device(self, device):
+        device.trust_state = TrustState.verified
+        self.verified.append((device.user_id, device.device_id))
+
+    def add_device(self, user_id, device_id):
+        self.device_store.setdefault(user_id, {})[device_id] = SimpleNamespace(
+            device_id=device_id, user_id=user_id, trust_state=TrustState.unset)
+
+
+def test_devices_are_only_looked_at_once():
+    nio = FakeNio({"@a:example.com": ["A1", "A2"], BOT: ["BOT1"]})
+    trust = TrustManager(nio)
+
+    trust.add_users(["@a:example.com", BOT])
+    assert sorted(nio.verified) == [("@a:example.com", "A1"), ("@a:example.com", "A2")]
+
+    # in another room
+    trust.add_users(["@a:example.com"])
+    assert len(nio.verified) == 2
+    assert trust.stats() == {'devices': 2, 'trusted': 2, 'pending_users': 0}
+
+def test_new_device_after_keys_query():
+    nio = FakeNio({"@a:example.com": ["A1"]})
+    trust = TrustManager(nio)
+    trust.add_users(["@a:example.com"])
+
+    trust.device_lists_changed(["@a:example.com"])
+    nio.add_device("@a:example.com", "A2")
+    resp = KeysQueryResponse({}, {})
+    resp.changed = {"@a:example.com": {}}
+    trust.keys_queried(resp)
+
+    assert nio.verified == [("@a:example.com", "A1"), ("@a:example.com", "A2")]
+
+def test_before_send_trusts_pending_users():
+    nio = FakeNio({"@a:example.com": ["A1"]})
+    nio.rooms["!room"] = SimpleNamespace(encrypted=True, members_synced=True)
+    trust = TrustManager(nio)
+    trust.device_lists_changed(["@a:example.com"])
+
+    asyncio.run(trust.before_send("!room"))
+    assert nio.verified == [("@a:example.com", "A1")]
+
+def test_disabled():
+    nio = FakeNio({"@a:example.com": ["A1"]})
+    trust = TrustManager(nio, enabled=False)
+    trust.add_users(["@a:example.com"])
+    assert trust.trust_user("@a:example.com") == 0
+    assert nio.verified == []
@@ -0,0 +1,190 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+from loguru import logger
+
+from notflixbot.emojis import FOLDER
+from notflixbot.notflix import Notflix
+from notflixbot.webhook import Webhook
+from tests.helpers import read_config
+
+
+class FakeSink:
+    def __init__(self):
+        self.msgs = []
+
+    async def put(self, room, msg, plain=None):
+        self.msgs.append((room, msg, plain))
+
+
+async def with_client(f, conf=None, notflix=None):
+    if conf is None:
+        conf = read_config()
+    sink = FakeSink()
+    webhook = Webhook(conf, sink, notflix)
+    async with TestClient(TestServer(webhook._app)) as client:
+        await f(client)
+    return sink
+
+
+def test_ruok():
+    async def ruok(client):
+        r = await client.get("/ruok")
+        assert r.status == 200
+        assert await r.json() == {'ruok': 'iamok'}
+
+    asyncio.run(with_client(ruok))
+
+def test_ruok_not_in_access_log_with_base_url():
+    conf = read_config()
+    conf.webhook_base_url = "/notflix/"
+    lines = []
+    handler_id = logger.add(lines.append, filter=lambda r: 'access_log' in r['extra'])
+
+    async def ruok(client):
+        for _ in range(3):
+            r = await client.get("/ruok")
+            assert r.status == 200
+        r = await client.post("/notflix/incoming/nope", json={'text': "hello"})
+        assert r.status == 403
+
+    try:
+        asyncio.run(with_client(ruok, conf))
+    finally:
+        logger.remove(handler_id)
+    assert len(lines) == 1
+    assert "/notflix/incoming/nope - 403" in lines[0]
+
+def test_incoming():
+    async def incoming(client):
+        r = await client.post("/incoming/123abc", json={'text': "hello", 'prefix': "test"})
+        assert r.status == 200
+
+    sink = asyncio.run(with_client(incoming))
+    assert sink.msgs == [("#room:example.com", "`[test]` hello", None)]
+
+def test_invalid_token():
+    async def forbidden(client):
+        r = await client.post("/incoming/nope", json={'text': "hello"})
+        assert r.status == 403
+
+    sink = asyncio.run(with_client(forbidden))
+    assert sink.msgs == []
+
+def test_invalid_json():
+    async def bad_json(client):
+        r = await client.post("/incoming/123abc", data=b"{not json")
+        assert r.status == 400
+
+    asyncio.run(with_client(bad_json))
+
+def test_metrics():
+    text = []
+
+    async def metrics(client):
+        await client.post("/incoming/123abc", json={'text': "hello"})
+        r = await client.get("/metrics")
+        assert r.status == 403
+        r = await client.get("/metrics", headers={'Webhook-Token': "123abc"})
+        assert r.status == 200
+        text.append(await r.text())
+
+    asyncio.run(with_client(metrics))
+    assert 'notflixbot_webhook_requests_total{route="/incoming/{token}",method="POST",status="200"}' in text[0]
+    assert 'notflixbot_webhook_request_seconds_bucket{route="/incoming/{token}",status="200",le="0.001"}' in text[0]
+
+def test_metrics_with_workers():
+    conf = read_config()
+    text = []
+
+    async def metrics(client):
+        r = await client.get("/metrics", headers={'Webhook-Token': "123abc"})
+        assert r.status == 200
+        text.append(await r.text())
+
+    async def run():
+        webhook = Webhook(conf, FakeSink())
+        webhook.worker_metrics = lambda: {'webhook-0': {'notflixbot_zmq_sent_total': [[[], 3]]}}
+        async with TestClient(TestServer(webhook._app)) as client:
+            await metrics(client)
+
+        # the webhook processes send their metrics to the bot instead
+        worker = Webhook(conf, FakeSink(), metrics=False)
+        async with TestClient(TestServer(worker._app)) as client:
+            r = await client.get("/metrics", headers={'Webhook-Token': "123abc"})
+            assert r.status == 404
+
+    asyncio.run(run())
+    assert 'notflixbot_zmq_sent_total{worker="webhook-0"} 3' in text[0]
+
+def test_jellyfin_playback_dedup():
+    def playback(user, device):
+        return {
+            'NotificationType': "PlaybackStart", 'ItemType': "Movie", 'ServerUrl': "https://jellyfin.example.com",
+            'ItemId': "abc", 'Name': "Movie", 'NotificationUsername': user, 'DeviceName': device,
+            'ClientName': "Jellyfin Web",
+        }
+
+    async def alternating(client):
+        for _ in range(3):
+            for user in ["ben", "anna"]:
+                r = await client.post("/jellyfin/123abc", json=playback(user, "tv"))
+                assert r.status == 200
+
+    sink = asyncio.run(with_client(alternating))
+    assert len(sink.msgs) == 2
+
+def test_add_needs_urls():
+    async def bad_add(client):
+        r = await client.post("/add/123abc", json={'urls': "tt0133093"})
+        assert r.status == 400
+
+    sink = asyncio.run(with_client(bad_add))
+    assert sink.msgs == []
+
+def test_radarr_updates_library():
+    notflix = Notflix(read_config().notflixbot)
+    movie = {'id': 1, 'title': "The Matrix", 'year': 1999, 'tmdbId': 603, 'imdbId': "tt0133093"}
+
+    async def radarr(client):
+        r = await client.post("/radarr", json={'eventType': "Grab", 'movie': movie, 'token': "123abc"})
+        assert r.status == 200
+        assert notflix.library.get(imdb_id="tt0133093")['title'] == "The Matrix"
+
+        r = await client.post("/radarr", json={'eventType': "MovieDelete", 'movie': movie, 'token': "123abc"})
+        assert r.status == 200
+        assert notflix.library.get(imdb_id="tt0133093") is None
+        await notflix.close()
+
+    sink = asyncio.run(with_client(radarr, notflix=notflix))
+    assert sink.msgs == [("#room:example.com", f"{FOLDER} downloading 'The Matrix (1999)'", None)]
+
+def test_jellyfin_movie_added_to_titles():
+    notflix = Notflix(read_config().notflixbot)
+    item_added = {
+        'NotificationType': "ItemAdded", 'ItemType': "Movie", 'ServerUrl': "https://jellyfin.example.com",
+        'ItemId': "abc", 'Name': "The Matrix (1999)", 'Year': 1999,
+    }
+
+    async def added(client):
+        r = await client.post("/jellyfin/123abc", json=item_added)
+        assert r.status == 200
+        await notflix.close()
+
+    asyncio.run(with_client(added, notflix=notflix))
+    match = notflix.titles.search("matrix")[0]
+    assert (match.title, match.year, match.sources) == ("The Matrix", "1999", ["jellyfin"])
+
+def test_radarr_without_shared_notflix(tmp_path):
+    conf = read_config()
+    conf.tmdb_cache_path = str(tmp_path / "tmdb.db")
+    movie = {'id': 1, 'title': "The Matrix", 'year': 1999, 'tmdbId': 603, 'imdbId': "tt0133093"}
+
+    async def radarr(client):
+        r = await client.post("/radarr", json={'eventType': "Download", 'movie': movie, 'token': "123abc"})
+        assert r.status == 200
+
+    sink = asyncio.run(with_client(radarr, conf))
+    assert len(sink.msgs) == 1
+    # a webhook process doesnt build a Notflix (and its cache) for this
+    assert not (tmp_path / "tmdb.db").exists()
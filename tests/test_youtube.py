@@ -0,0 +1,69 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from notflixbot.youtube import Youtube
+
+
+def make_app():
+    calls = []
+
+    async def video(request):
+        calls.append(request.match_info['ytid'])
+        # slow enough for concurrent lookups to overlap
+        await asyncio.sleep(0.05)
+        return web.json_response({'title': "Never Gonna Give You Up"})
+
+    app = web.Application()
+    app.router.add_get("/api/v1/videos/{ytid}", video)
+    return app, calls
+
+
+async def with_youtube(app, f, **config):
+    async with TestServer(app) as server:
+        yt = Youtube({'invidious_url': str(server.make_url("/")), **config})
+        try:
+            return await f(yt)
+        finally:
+            await yt.upstream.close()
+
+
+def test_get_youtube_video_id():
+    yt = Youtube({'invidious_url': "https://iv.example.com"})
+    assert yt.get_youtube_video_id("https://www.youtube.com/watch?v=dQw4w9WgXcQ") == "dQw4w9WgXcQ"
+    assert yt.get_youtube_video_id("https://youtu.be/dQw4w9WgXcQ") == "dQw4w9WgXcQ"
+
+def test_unfurl_cached():
+    app, calls = make_app()
+
+    async def unfurl_twice(yt):
+        await yt.unfurl("look https://youtu.be/dQw4w9WgXcQ")
+        return await yt.unfurl("https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+
+    msg, plain = asyncio.run(with_youtube(app, unfurl_twice))
+    assert plain == "🎥 Never Gonna Give You Up"
+    assert "/watch?v=dQw4w9WgXcQ" in msg
+    assert calls == ["dQw4w9WgXcQ"]
+
+def test_unfurl_coalesced():
+    app, calls = make_app()
+
+    async def unfurl_concurrently(yt):
+        return await asyncio.gather(*[
+            yt.unfurl("https://youtu.be/dQw4w9WgXcQ") for _ in range(5)
+        ])
+
+    results = asyncio.run(with_youtube(app, unfurl_concurrently))
+    assert len(set(results)) == 1
+    assert calls == ["dQw4w9WgXcQ"]
+
+def test_unfurl_timeout():
+    app, calls = make_app()
+
+    async def unfurl(yt):
+        return await yt.unfurl("https://youtu.be/dQw4w9WgXcQ")
+
+    # shorter than the lookup takes
+    assert asyncio.run(with_youtube(app, unfurl, youtube_timeout=0.01)) is None
+    assert calls == ["dQw4w9WgXcQ"]